@@ -0,0 +1,103 @@
+import argparse
+import time
+
+from src import server
+from src.packet import Packet, PacketType
+
+# Catch-up traffic: anti-entropy exchanges and the messages they bring
+CATCH_UP_BYTES = ('chat_bytes_out_total{type="sync"}', 'chat_bytes_out_total{type="message"}')
+
+
+def flood(node, count: int, tag: str) -> int:
+    size = 0
+    for i in range(count):
+        message = Packet(PacketType.MESSAGE, 's:bench:{} {}'.format(tag, i))
+        node.received.add(message.id)
+        node.catchup.add(message)
+        node.send(message)
+        size += len(message.payload)
+    return size
+
+
+def drain(node, count: int, timeout: float) -> list:
+    messages = []
+    deadline = time.monotonic() + timeout
+    while len(messages) < count and time.monotonic() < deadline:
+        try:
+            messages.append(node.got_messages.get(timeout=0.1))
+        except Exception:
+            pass
+    return messages
+
+
+def catch_up_bytes(node) -> int:
+    snapshot = node.metrics.snapshot()
+    return sum(snapshot.get(key, 0) for key in CATCH_UP_BYTES)
+
+
+# Waits until the node sent no catch-up traffic for `quiet` seconds, longer than the catch-up tick,
+# the exchange is over then.
+def resynced(node, quiet: float, timeout: float) -> int:
+    sent = catch_up_bytes(node)
+    changed = time.monotonic()
+    deadline = changed + timeout
+    while time.monotonic() - changed < quiet and time.monotonic() < deadline:
+        time.sleep(0.1)
+        if catch_up_bytes(node) != sent:
+            sent = catch_up_bytes(node)
+            changed = time.monotonic()
+    return sent
+
+
+# c has to catch up from b alone, so the peer manager keeps the chain as it is.
+def chain_node(chat_addr, port: int) -> server.Server:
+    chat = server.Server(chat_addr, port)
+    chat.peer_manager.target_degree = 0
+    return chat
+
+
+# A node that saw `history` messages goes away while `missed` more are sent, then comes back
+# on a new port with its history and catches up from a neighbor.
+def run(port: int, history: int, missed: int) -> tuple:
+    a = chain_node(None, port)
+    a.run()
+    b = chain_node(('127.0.0.1', port), port + 1)
+    b.run()
+    c = chain_node(('127.0.0.1', port + 1), port + 2)
+    c.run()
+    time.sleep(2)
+    flood(a, history, 'old')
+    seen = drain(c, history, 30)
+    drain(b, history, 30)
+    c.close()
+    time.sleep(1)
+    missed_bytes = flood(a, missed, 'new')
+    drain(b, missed, 30)
+    sent = resynced(b, 2, 30)
+    start = time.monotonic()
+    c = chain_node(('127.0.0.1', port + 1), port + 3)
+    for message in seen:
+        c.catchup.add(message)
+    c.run()
+    got = drain(c, missed, 30)
+    elapsed = time.monotonic() - start
+    # both sides of the exchange, c's summaries are all it costs when nothing was missed
+    transferred = resynced(b, 2, 30) - sent + catch_up_bytes(c)
+    for node in (c, b, a):
+        node.close()
+    return len(got), elapsed, transferred, missed_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--history', help='Messages seen before going offline', type=int, default=2000)
+    parser.add_argument('--port', help='First port', type=int, default=21000)
+    args = parser.parse_args()
+    print('{:>7} {:>9} {:>9} {:>14} {:>12}'.format('missed', 'received', 'seconds', 'exchange bytes', 'missed bytes'))
+    for i, missed in enumerate((0, 10, 100, 1000)):
+        got, elapsed, transferred, missed_bytes = run(args.port + i * 10, args.history, missed)
+        print('{:>7} {:>9} {:>9.2f} {:>14} {:>12}'.format(missed, got, elapsed, transferred, missed_bytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+import argparse
+import json
+import multiprocessing
+import queue
+import random
+import resource
+import statistics
+import threading
+import time
+
+from src import client
+from src.packet import Packet, PacketType
+
+
+def build_topology(name: str, count: int, degree: int, seed: int) -> list:
+    rng = random.Random(seed)
+    edges = []
+    for i in range(1, count):
+        if name == 'chain':
+            edges.append([i - 1])
+        elif name == 'star':
+            edges.append([0])
+        else:
+            edges.append(rng.sample(range(i), min(i, degree)))
+    return [[]] + edges
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Node:
+    def __init__(self, index: int, port: int, neighbors: list, engine: str, dissemination: str, sequencing=False):
+        self.index = index
+        chat_addr = ('127.0.0.1', neighbors[0]) if neighbors else None
+        self.server = client.get_engine(engine)(chat_addr, port, dissemination, sequencing=sequencing)
+        # the topology is the one under test, the peer manager must not add links to it
+        self.server.peer_manager.target_degree = 0
+        for neighbor in neighbors[1:]:
+            self.server._connect('127.0.0.1', neighbor)
+        self.sent = 0
+        self.arrivals = 0
+        self.latencies = []
+        self._stopped = threading.Event()
+        process = self.server._process
+
+        def counting(message, source=None):
+            if message.type is PacketType.MESSAGE:
+                self.arrivals += 1
+            process(message, source)
+        self.server._process = counting
+
+    def run(self):
+        self.server.run()
+        threading.Thread(name='bench receiving', target=self._receive).start()
+
+    def _receive(self):
+        while not self._stopped.is_set():
+            try:
+                message = self.server.got_messages.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            parts = message.data.split(':')
+            if parts[1].startswith('bench'):
+                self.latencies.append(time.perf_counter() - float(parts[-1]))
+
+    def load(self, rate: float, duration: float, start_at: float):
+        if rate <= 0:
+            return
+        interval = 1 / rate
+        next_at = start_at
+        while next_at < start_at + duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            message = Packet(PacketType.MESSAGE, 's:bench{}:{}:{}'.format(self.index, self.sent, time.perf_counter()),
+                             self.server.new_id())
+            self.server.received.add(message.id)
+            self.server.send(message)
+            self.sent += 1
+            next_at += interval
+
+    def results(self) -> dict:
+        return {
+            'index': self.index,
+            'sent': self.sent,
+            'delivered': len(self.latencies),
+            'arrivals': self.arrivals,
+            'sent_bytes': self.server.sent_bytes,
+            'latencies': self.latencies,
+        }
+
+    def close(self):
+        self._stopped.set()
+        self.server.close()
+
+
+def usage() -> tuple:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024
+
+
+def node_process(pipe, index, port, neighbors, engine, dissemination, sequencing):
+    node = Node(index, port, neighbors, engine, dissemination, sequencing)
+    node.run()
+    pipe.send('ready')
+    rate, duration, start_at, grace = pipe.recv()
+    cpu = usage()[0]
+    node.load(rate, duration, start_at)
+    time.sleep(max(0, start_at + duration + grace - time.perf_counter()))
+    results = node.results()
+    results['cpu_seconds'], results['rss_mb'] = usage()[0] - cpu, usage()[1]
+    pipe.send(results)
+    pipe.recv()
+    node.close()
+
+
+def receive(pipe, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not pipe.poll(0.5):
+        if not process.is_alive() or time.monotonic() > deadline:
+            raise RuntimeError('Node process {} is not responding'.format(process.pid))
+    return pipe.recv()
+
+
+def run_processes(args, topology: list) -> list:
+    pipes = []
+    processes = []
+    for index, neighbors in enumerate(topology):
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=node_process, args=(
+            child, index, args.port + index, [args.port + i for i in neighbors], args.engine, args.dissemination,
+            args.sequencing))
+        process.start()
+        receive(parent, process)
+        pipes.append(parent)
+        processes.append(process)
+    time.sleep(args.settle)
+    start_at = time.perf_counter() + 0.5
+    for pipe in pipes:
+        pipe.send((args.rate / len(pipes), args.duration, start_at, args.grace))
+    results = [receive(pipe, process, args.duration + args.grace + 60) for pipe, process in zip(pipes, processes)]
+    for pipe in pipes:
+        pipe.send('close')
+    for process in processes:
+        process.join(10)
+        if process.is_alive():
+            process.terminate()
+    return results
+
+
+def run_in_process(args, topology: list) -> list:
+    nodes = []
+    for index, neighbors in enumerate(topology):
+        node = Node(index, args.port + index, [args.port + i for i in neighbors], args.engine, args.dissemination,
+                    args.sequencing)
+        node.run()
+        nodes.append(node)
+    time.sleep(args.settle)
+    cpu = usage()[0]
+    start_at = time.perf_counter() + 0.5
+    senders = [threading.Thread(target=node.load, args=(args.rate / len(nodes), args.duration, start_at))
+               for node in nodes]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    time.sleep(max(0, start_at + args.duration + args.grace - time.perf_counter()))
+    cpu_seconds, rss = usage()[0] - cpu, usage()[1]
+    results = []
+    for node in nodes:
+        result = node.results()
+        result['cpu_seconds'], result['rss_mb'] = cpu_seconds / len(nodes), rss
+        results.append(result)
+    for node in reversed(nodes):
+        node.close()
+    return results
+
+
+def summarize(args, results: list) -> dict:
+    latencies = sorted(latency for result in results for latency in result.pop('latencies'))
+    sent = sum(result['sent'] for result in results)
+    delivered = len(latencies)
+    arrivals = sum(result['arrivals'] for result in results)
+    return {
+        'sent': sent,
+        'delivered': delivered,
+        'delivery_ratio': delivered / (sent * (len(results) - 1)) if sent else 0.0,
+        'delivered_per_second': delivered / args.duration,
+        'latency_ms': {
+            'mean': statistics.mean(latencies) * 1000 if latencies else 0.0,
+            'p50': percentile(latencies, 0.5) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'p999': percentile(latencies, 0.999) * 1000,
+            'max': latencies[-1] * 1000 if latencies else 0.0,
+        },
+        'duplicate_ratio': (arrivals - delivered) / delivered if delivered else 0.0,
+        'cpu_seconds': sum(result['cpu_seconds'] for result in results),
+        'max_rss_mb': max(result['rss_mb'] for result in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=8)
+    parser.add_argument('--topology', choices=['chain', 'star', 'mesh'], default='mesh')
+    parser.add_argument('--degree', help='Links of every new node in a mesh', type=int, default=2)
+    parser.add_argument('--rate', help='Messages per second over all nodes', type=float, default=200)
+    parser.add_argument('--duration', help='Seconds of load', type=float, default=10)
+    parser.add_argument('--grace', help='Seconds to wait for deliveries after the load', type=float, default=3)
+    parser.add_argument('--settle', help='Seconds to wait after the nodes are connected', type=float, default=2)
+    parser.add_argument('--engine', choices=sorted(client.ENGINES), default='threads')
+    parser.add_argument('--dissemination', choices=['flood', 'plumtree'], default='flood')
+    parser.add_argument('--sequencing', help='Send messages with sequenced IDs', action='store_true')
+    parser.add_argument('--in-process', help='Run all nodes in this process, CPU and RSS are then totals',
+                        action='store_true')
+    parser.add_argument('--port', help='Port of the first node', type=int, default=26000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+    topology = build_topology(args.topology, args.nodes, args.degree, args.seed)
+    results = (run_in_process if args.in_process else run_processes)(args, topology)
+    summary = summarize(args, results)
+    report = {'config': vars(args), 'topology': topology, 'summary': summary, 'nodes': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    latency = summary['latency_ms']
+    print('{} {} nodes, {}, {}: sent {}, delivered {} ({:.1%}), {:.0f} msg/s'.format(
+        args.topology, args.nodes, args.engine, args.dissemination, summary['sent'], summary['delivered'],
+        summary['delivery_ratio'], summary['delivered_per_second']))
+    print('latency ms: p50 {:.2f}, p99 {:.2f}, p999 {:.2f}, max {:.2f}'.format(
+        latency['p50'], latency['p99'], latency['p999'], latency['max']))
+    print('duplicates per delivery {:.2f}, cpu {:.2f} s, max rss {:.1f} MB'.format(
+        summary['duplicate_ratio'], summary['cpu_seconds'], summary['max_rss_mb']))
+    for result in results:
+        print('  node {index:>3}: sent {sent:>6} delivered {delivered:>7} arrivals {arrivals:>7} '
+              'cpu {cpu_seconds:>6.2f} s rss {rss_mb:>6.1f} MB'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
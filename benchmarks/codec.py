@@ -0,0 +1,167 @@
+import argparse
+import sys
+import time
+import tracemalloc
+
+from src import codec
+from src.message import MessageType, parse_message
+from src.packet import HEADER, Packet, PacketType
+
+TEXTS = {
+    'shared': 's:user:' + 'hello world ' * 8,
+    'private': 'p:friend:user:' + 'привет: мир ' * 8,
+}
+
+
+# Packet and Message before the codec: dict-backed objects and lookup tables built on every parse.
+class LegacyPacket:
+    def __init__(self, t: PacketType, data='', msg_id=None):
+        self.type = t
+        self._id = msg_id
+        self._data = None
+        self._payload = None
+        self.frame_size = None
+        if isinstance(data, str):
+            self._data = data
+        else:
+            self._payload = bytes(data)
+
+    @staticmethod
+    def to_bytes(x: int) -> str:
+        s = ''
+        for i in range(8):
+            s += chr(x % 255 + 1)
+            x //= 255
+        return s
+
+    @staticmethod
+    def to_int(s: str) -> int:
+        if len(s) != 8:
+            raise ValueError('Incorrect length of string')
+        x = 0
+        for i in range(8):
+            x += (ord(s[i]) - 1) * (255 ** i)
+        return x
+
+    @property
+    def data(self) -> str:
+        if self._data is None:
+            self._data = self._payload.decode()
+        return self._data
+
+    @property
+    def payload(self) -> bytes:
+        if self._payload is None:
+            self._payload = self._data.encode()
+        return self._payload
+
+    def encode(self, version=1) -> bytes:
+        if version == 1:
+            return bytes(self.type.value + self.to_bytes(self._id) + self.to_bytes(len(self.data)) + self.data,
+                         'utf-8')
+        return HEADER.pack(version, self.type.value.encode(), self._id, len(self.payload)) + self.payload
+
+    @staticmethod
+    def decode(frame: bytes, version=1):
+        if version == 1:
+            types = dict(map(lambda x: (x.value, x), PacketType))
+            byte_string = frame.decode()
+            size = LegacyPacket.to_int(byte_string[9:17])
+            message = LegacyPacket(types[byte_string[0]], byte_string[17:17 + size],
+                                   LegacyPacket.to_int(byte_string[1:9]))
+        else:
+            frame_version, t, msg_id, size = HEADER.unpack_from(frame)
+            message = LegacyPacket(PacketType(t.decode()), frame[HEADER.size:HEADER.size + size], msg_id)
+        message.frame_size = len(frame)
+        return message
+
+
+class LegacyMessage:
+    def __init__(self, type: MessageType, source: str):
+        self.type = type
+        self.source = source
+        self.nickname = ''
+        self.addressee = ''
+
+    @staticmethod
+    def parse(source: str):
+        types = dict(map(lambda x: (x.value, x), MessageType))
+        parsed = source.split(':')
+        t = types[parsed[0]]
+        ind = 1
+        addressee = None
+        if t is MessageType.PRIVATE:
+            addressee = parsed[ind]
+            ind += 1
+        nickname = parsed[ind]
+        ind += 1
+        message = LegacyMessage(t, ':'.join(parsed[ind:]))
+        message.nickname = nickname
+        message.addressee = addressee
+        return message
+
+
+def measure(function, count: int, repeat=3) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count / best
+
+
+# Blocks and bytes still allocated per item after parsing, i.e. what the parsed objects cost.
+def allocations(function, count: int) -> tuple:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = function()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    del result
+    return blocks / count, size / count
+
+
+def object_size(obj) -> int:
+    return sys.getsizeof(obj) + (sys.getsizeof(obj.__dict__) if hasattr(obj, '__dict__') else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', help='Packets per run', type=int, default=20000)
+    args = parser.parse_args()
+    print('{:>8} {:>8} {:>8} {:>12} {:>12} {:>8} {:>10} {:>10}'.format(
+        'text', 'version', 'codec', 'parse p/s', 'message p/s', 'encode', 'blocks/p', 'bytes/p'))
+    for name, text in TEXTS.items():
+        packets = [Packet(PacketType.MESSAGE, text) for _ in range(args.count)]
+        for version in (1, 2):
+            frames = [p.encode(version) for p in packets]
+            texts = [p.data for p in packets]
+            legacy = [LegacyPacket(p.type, p.data, p.id) for p in packets]
+            rows = [
+                ('legacy',
+                 lambda: [LegacyPacket.decode(frame, version) for frame in frames],
+                 lambda: [LegacyMessage.parse(t) for t in texts],
+                 lambda: b''.join([p.encode(version) for p in legacy]),
+                 lambda: [(m, m.data) for m in (LegacyPacket.decode(frame, version) for frame in frames)]),
+                ('new',
+                 lambda: codec.parse_many(frames, version),
+                 lambda: codec.parse_messages(texts),
+                 lambda: b''.join([p.encode(version) for p in packets]),
+                 lambda: [(m, m.data) for m in codec.parse_many(frames, version)]),
+            ]
+            for label, parse, messages, encode, parsed in rows:
+                blocks, size = allocations(parsed, args.count)
+                print('{:>8} {:>8} {:>8} {:>12.0f} {:>12.0f} {:>7.0f}k {:>10.1f} {:>10.1f}'.format(
+                    name, version, label, measure(parse, args.count), measure(messages, args.count),
+                    measure(encode, args.count) / 1000, blocks, size))
+    print('object bytes: packet {} -> {}, message {} -> {}'.format(
+        object_size(LegacyPacket(PacketType.MESSAGE, '', 1)), object_size(Packet(PacketType.MESSAGE, '', 1)),
+        object_size(LegacyMessage(MessageType.SHARED, '')), object_size(parse_message('s:a:b'))))
+
+
+if __name__ == '__main__':
+    main()
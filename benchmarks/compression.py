@@ -0,0 +1,84 @@
+import argparse
+import random
+import time
+
+from src import compression
+from src import packet
+from src.packet import Packet, PacketType
+
+WORDS = ('привет как дела что нового сегодня вечером встречаемся у входа ok hello see you later '
+         'thanks sure maybe tomorrow the build is green again').split()
+
+
+# Traffic of one link: mostly chat messages, with presence, peer lists and control packets in between.
+def make_traffic(count: int, rng: random.Random) -> list:
+    nicknames = ['user{}'.format(i) for i in range(50)]
+    packets = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.7:
+            text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 15)))
+            if rng.random() < 0.1:
+                data = 'p:{}:{}:{}'.format(rng.choice(nicknames), rng.choice(nicknames), text)
+            else:
+                data = 's:{}:{}'.format(rng.choice(nicknames), text)
+            packets.append(Packet(PacketType.MESSAGE, data))
+        elif kind < 0.8:
+            lines = ['{}{}:{}'.format(rng.choice('+-'), rng.randint(1, 5), rng.choice(nicknames))
+                     for _ in range(rng.randint(1, 3))]
+            packets.append(Packet(PacketType.PRESENCE, '\n'.join(['u'] + lines)))
+        elif kind < 0.85:
+            packets.append(Packet(PacketType.PRESENCE, 'd\n{}'.format(rng.getrandbits(64))))
+        elif kind < 0.9:
+            packets.append(Packet(PacketType.ONLINE, rng.choice(nicknames)))
+        elif kind < 0.95:
+            packets.append(Packet(PacketType.IP, '/127.0.0.1:{}/192.168.0.{}:9090'.format(
+                rng.randint(9000, 9999), rng.randint(2, 254))))
+        else:
+            ids = [rng.getrandbits(60) for _ in range(rng.randint(1, 8))]
+            packets.append(Packet(PacketType.IHAVE, packet.encode_ids(ids)))
+    return packets
+
+
+def make_batches(packets: list, batch: int, version: int) -> list:
+    frames = [packet.encode(packet, version) for packet in packets]
+    return [b''.join(frames[i:i + batch]) for i in range(0, len(frames), batch)]
+
+
+def run(batches: list, level: int, threshold: int) -> tuple:
+    deflater = compression.Deflater(level, threshold)
+    start = time.process_time()
+    blocks = [deflater.pack(data) for data in batches]
+    pack = time.process_time() - start
+    inflater = compression.Inflater()
+    start = time.process_time()
+    for block in blocks:
+        inflater.feed(block)
+    unpack = time.process_time() - start
+    return sum(map(len, blocks)), pack, unpack
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', help='Packets of traffic', type=int, default=50000)
+    parser.add_argument('--batches', nargs='+', help='Frames per coalesced batch', type=int, default=[1, 8, 64])
+    parser.add_argument('--levels', nargs='+', help='zlib levels', type=int, default=[1, 6, 9])
+    parser.add_argument('--threshold', help='Batches shorter than this go raw', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    packets = make_traffic(args.count, random.Random(args.seed))
+    raw = sum(map(len, make_batches(packets, 1, 2)))
+    print('{} packets, {:.2f} MB as version 2 frames'.format(args.count, raw / 2 ** 20))
+    print('{:>6} {:>6} {:>10} {:>8} {:>14} {:>14}'.format(
+        'batch', 'level', 'wire MB', 'saved', 'deflate ms/MB', 'inflate ms/MB'))
+    for batch in args.batches:
+        batches = make_batches(packets, batch, 3)
+        for level in args.levels:
+            size, pack, unpack = run(batches, level, args.threshold)
+            megabytes = raw / 2 ** 20
+            print('{:>6} {:>6} {:>10.2f} {:>7.1%} {:>14.1f} {:>14.1f}'.format(
+                batch, level, size / 2 ** 20, 1 - size / raw, pack * 1000 / megabytes, unpack * 1000 / megabytes))
+
+
+if __name__ == '__main__':
+    main()
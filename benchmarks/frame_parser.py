@@ -0,0 +1,60 @@
+import argparse
+import time
+
+from src import framing
+from src.packet import Packet, PacketType
+
+
+class LegacyDecoder:
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        self._buffer.extend(data)
+        frames = []
+        while True:
+            try:
+                size = Packet.get_data_size(self._buffer)
+            except ValueError:
+                return frames
+            packets = self._buffer.decode()
+            if len(self._buffer.decode()) < 1 + 8 + 8 + size:
+                return frames
+            frames.append(bytes(packets[:1 + 8 + 8 + size], 'utf-8'))
+            self._buffer = bytearray(packets[1 + 8 + 8 + size:], 'utf-8')
+
+
+def make_burst(count: int) -> bytes:
+    return b''.join(bytes(Packet(PacketType.MESSAGE, 's:user{}:hi'.format(i))) for i in range(count))
+
+
+def chunks(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def measure(decoder_class, burst: list, repeat: int) -> float:
+    frames = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decoder = decoder_class()
+        for chunk in burst:
+            frames += len(decoder.feed(chunk))
+    return frames / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recv_size', help='Bytes per recv call', type=int, default=4096)
+    parser.add_argument('--bursts', nargs='+', help='Packets per burst', type=int, default=[1, 100, 10000])
+    args = parser.parse_args()
+    print('{:>8} {:>14} {:>14} {:>8}'.format('burst', 'legacy fr/s', 'decoder fr/s', 'speedup'))
+    for count in args.bursts:
+        burst = chunks(make_burst(count), args.recv_size)
+        repeat = max(1, 20000 // count)
+        legacy = measure(LegacyDecoder, burst, repeat)
+        decoder = measure(framing.FrameDecoder, burst, repeat)
+        print('{:>8} {:>14.0f} {:>14.0f} {:>7.1f}x'.format(count, legacy, decoder, decoder / legacy))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import statistics
+import time
+
+from src import server
+from src.packet import Packet, PacketType
+
+
+def get_engine(name: str):
+    if name == 'asyncio':
+        from src import aio_server
+        return aio_server.AsyncServer
+    return server.Server
+
+
+def build_chain(engine, count: int, port: int) -> list:
+    nodes = []
+    for i in range(count):
+        chat_addr = None if i == 0 else ('127.0.0.1', port + i - 1)
+        node = engine(chat_addr, port + i)
+        node.peer_manager.target_degree = 0
+        node.run()
+        nodes.append(node)
+    return nodes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--nodes', help='Length of the chain', type=int, default=5)
+    parser.add_argument('--messages', help='Messages sent one after another', type=int, default=50)
+    parser.add_argument('--port', help='First port of the chain', type=int, default=20000)
+    args = parser.parse_args()
+    nodes = build_chain(get_engine(args.engine), args.nodes, args.port)
+    time.sleep(3)
+    latencies = []
+    for i in range(args.messages):
+        message = Packet(PacketType.MESSAGE, 's:bench:{}'.format(i))
+        start = time.perf_counter()
+        nodes[0].received.add(message.id)
+        nodes[0].send(message)
+        while True:
+            if nodes[-1].got_messages.get(timeout=10).data == message.data:
+                break
+        latencies.append(time.perf_counter() - start)
+    for node in nodes:
+        node.close()
+    hops = args.nodes - 1
+    print('engine {}, {} hops, {} messages'.format(args.engine, hops, len(latencies)))
+    print('end to end: mean {:.2f} ms, p50 {:.2f} ms, max {:.2f} ms'.format(
+        statistics.mean(latencies) * 1000, statistics.median(latencies) * 1000, max(latencies) * 1000))
+    print('per hop: mean {:.2f} ms'.format(statistics.mean(latencies) * 1000 / hops))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import contextlib
+import io
+import multiprocessing
+import queue
+import threading
+import time
+
+from src import client
+from src.packet import Packet, PacketType
+from benchmarks.cluster import percentile, receive
+
+
+def join(engine, seed_port: int, port: int, results: list, nodes: list):
+    start = time.perf_counter()
+    try:
+        nodes.append(engine(('127.0.0.1', seed_port), port))
+        results.append((time.perf_counter() - start, None))
+    except OSError as e:
+        results.append((time.perf_counter() - start, type(e).__name__))
+
+
+# Joiners are spread over processes, so the seed is measured rather than one interpreter starting hundreds of nodes.
+def joiners(pipe, engine_name: str, seed_port: int, ports: list):
+    engine = client.get_engine(engine_name)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pipe.send('ready')
+        start_at = pipe.recv()
+        time.sleep(max(0, start_at - time.time()))
+        results = []
+        nodes = []
+        threads = [threading.Thread(target=join, args=(engine, seed_port, port, results, nodes)) for port in ports]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pipe.send(results)
+        pipe.recv()
+        for node in nodes:
+            node.close()
+
+
+# A probe node keeps sending to the seed while the others join, the seed has to keep delivering.
+def probe(node, rate: float, stopped: threading.Event):
+    while not stopped.is_set():
+        message = Packet(PacketType.MESSAGE, 's:probe:{}'.format(time.perf_counter()))
+        node.received.add(message.id)
+        node.send(message)
+        time.sleep(1 / rate)
+
+
+def watch(node, latencies: list, stopped: threading.Event):
+    while not stopped.is_set():
+        try:
+            message = node.got_messages.get(timeout=0.2)
+        except queue.Empty:
+            continue
+        latencies.append(time.perf_counter() - float(message.data.split(':')[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', help='Nodes joining at once', type=int, default=200)
+    parser.add_argument('--processes', help='Processes the joiners run in', type=int, default=8)
+    parser.add_argument('--engine', choices=sorted(client.ENGINES), default='threads')
+    parser.add_argument('--rate', help='Probe messages per second during the joins', type=float, default=100)
+    parser.add_argument('--port', help='Port of the seed node, joiners take the next ones', type=int, default=23000)
+    args = parser.parse_args()
+    engine = client.get_engine(args.engine)
+    with contextlib.redirect_stdout(io.StringIO()):
+        seed = engine(None, args.port)
+        seed.run()
+        prober = engine(('127.0.0.1', args.port), args.port + 1)
+        prober.run()
+        workers = []
+        for i in range(args.processes):
+            ports = list(range(args.port + 2 + i, args.port + 2 + args.nodes, args.processes))
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=joiners, args=(child, args.engine, args.port, ports))
+            process.start()
+            workers.append((parent, process))
+        for pipe, process in workers:
+            receive(pipe, process)
+        time.sleep(0.5)
+        while not seed.got_messages.empty():
+            seed.got_messages.get()
+        stopped = threading.Event()
+        latencies = []
+        threading.Thread(target=watch, args=(seed, latencies, stopped)).start()
+        threading.Thread(target=probe, args=(prober, args.rate, stopped)).start()
+        start_at = time.time() + 0.5
+        for pipe, process in workers:
+            pipe.send(start_at)
+        results = []
+        for pipe, process in workers:
+            results.extend(receive(pipe, process, 600))
+        elapsed = time.time() - start_at
+        stopped.set()
+        time.sleep(0.5)
+        connected = len(seed.peers()) - 1
+        for pipe, process in workers:
+            pipe.send('close')
+        for pipe, process in workers:
+            process.join(30)
+            if process.is_alive():
+                process.terminate()
+        prober.close()
+        seed.close()
+    durations = sorted(duration for duration, error in results if error is None)
+    errors = [error for duration, error in results if error is not None]
+    print('{}: {} of {} nodes joined in {:.3f} s, seed has {} of their links'.format(
+        args.engine, len(durations), args.nodes, elapsed, connected))
+    if errors:
+        print('failed: ' + ', '.join('{} {}'.format(errors.count(e), e) for e in sorted(set(errors))))
+    print('join ms: p50 {:.1f}, p99 {:.1f}, max {:.1f}'.format(
+        percentile(durations, 0.5) * 1000, percentile(durations, 0.99) * 1000,
+        durations[-1] * 1000 if durations else 0.0))
+    latencies.sort()
+    print('probe messages through the seed meanwhile: {}, ms p50 {:.1f}, p99 {:.1f}, max {:.1f}'.format(
+        len(latencies), percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        latencies[-1] * 1000 if latencies else 0.0))
+
+
+if __name__ == '__main__':
+    main()
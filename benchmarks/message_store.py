@@ -0,0 +1,45 @@
+import argparse
+import contextlib
+import os
+import random
+import tempfile
+import time
+
+from src import store
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def measure(directory: str, count: int):
+    text = 's:user:' + 'hello world ' * 4
+    messages = store.MessageStore(directory)
+    start = time.time() - count
+    elapsed, _ = timed(lambda: [messages.append(random.getrandbits(63), text, start + i) for i in range(count)])
+    print('append      {:>10.0f} msg/s'.format(count / elapsed))
+    messages.close()
+    print('on disk     {:>10.1f} MB'.format(sum(os.path.getsize(os.path.join(directory, name))
+                                                for name in os.listdir(directory)) / 1e6))
+    elapsed, messages = timed(lambda: store.MessageStore(directory))
+    print('reopen      {:>10.1f} ms ({} messages)'.format(elapsed * 1000, len(messages)))
+    elapsed, records = timed(lambda: messages.last(500))
+    print('last 500    {:>10.2f} ms'.format(elapsed * 1000))
+    elapsed, records = timed(lambda: messages.since(start + count - 1000))
+    print('since T     {:>10.2f} ms ({} messages)'.format(elapsed * 1000, len(records)))
+    messages.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', help='Stored messages', type=int, default=1000000)
+    parser.add_argument('--dir', help='Store directory, a temporary one that is removed afterwards by default',
+                        default=None)
+    args = parser.parse_args()
+    with (tempfile.TemporaryDirectory() if args.dir is None else contextlib.nullcontext(args.dir)) as directory:
+        measure(directory, args.count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import argparse
+import collections
+import contextlib
+import io
+import multiprocessing
+import random
+import time
+
+from src import client
+from benchmarks.cluster import receive
+
+PREFIX = 'chat_packets_out_total{type="'
+
+
+def packets_out(nodes: list) -> collections.Counter:
+    counts = collections.Counter()
+    for node in nodes:
+        for key, value in node.metrics.snapshot().items():
+            if key.startswith(PREFIX):
+                counts[key[len(PREFIX):-2]] += value
+    return counts
+
+
+# A worker starts the nodes it is told to, each joining the node given with it, and answers
+# with the packets its nodes sent so far whenever it is asked.
+def worker(pipe, engine_name: str):
+    engine = client.get_engine(engine_name)
+    nodes = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        while True:
+            command, *rest = pipe.recv()
+            if command == 'join':
+                port, parent = rest
+                node = engine(('127.0.0.1', parent) if parent is not None else None, port)
+                node.run()
+                nodes.append(node)
+                pipe.send('joined')
+            elif command == 'count':
+                pipe.send(packets_out(nodes))
+            else:
+                break
+        for node in nodes:
+            node.close()
+
+
+def count(workers: list) -> collections.Counter:
+    for pipe, process in workers:
+        pipe.send(('count',))
+    total = collections.Counter()
+    for pipe, process in workers:
+        total += receive(pipe, process)
+    return total
+
+
+# Every node joins a random earlier one. Once the mesh settled the packets of an idle window are
+# counted, then one more node joins and the packets of a window as long are counted again.
+def run(args) -> tuple:
+    rng = random.Random(args.seed)
+    workers = []
+    for _ in range(args.processes):
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=worker, args=(child, args.engine))
+        process.start()
+        workers.append((parent, process))
+    start = time.perf_counter()
+    for i in range(args.nodes):
+        pipe, process = workers[i % len(workers)]
+        pipe.send(('join', args.port + i, args.port + rng.randrange(i) if i else None))
+        receive(pipe, process, 60)
+    built = time.perf_counter() - start
+    time.sleep(args.settle)
+    before = count(workers)
+    time.sleep(args.window)
+    idle = count(workers) - before
+    engine = client.get_engine(args.engine)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        joiner = engine(('127.0.0.1', args.port + rng.randrange(args.nodes)), args.port + args.nodes)
+        joiner.run()
+        joined = time.perf_counter() - start
+        before = count(workers)
+        own = packets_out([joiner])
+        time.sleep(args.window)
+        join = count(workers) - before + packets_out([joiner]) - own
+        links = len(joiner.peers())
+        known = len(joiner.ip_list)
+        joiner.close()
+    for pipe, process in workers:
+        pipe.send(('close',))
+    for pipe, process in workers:
+        process.join(30)
+        if process.is_alive():
+            process.terminate()
+    return built, joined, links, known, idle, join
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', help='Nodes of the mesh', type=int, default=100)
+    parser.add_argument('--processes', help='Processes the nodes run in', type=int, default=8)
+    parser.add_argument('--engine', choices=sorted(client.ENGINES), default='asyncio')
+    parser.add_argument('--settle', help='Seconds between building the mesh and counting', type=float, default=5)
+    parser.add_argument('--window', help='Seconds the packets are counted for', type=float, default=5)
+    parser.add_argument('--port', help='Port of the first node, the others take the next ones', type=int,
+                        default=27000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    built, joined, links, known, idle, join = run(args)
+    print('{} nodes built in {:.1f} s, the new node joined in {:.1f} ms, has {} links and knows {} addresses'.format(
+        args.nodes, built, joined * 1000, links, known))
+    print('{:>14} {:>10} {:>10}'.format('type', 'idle', 'join'))
+    for t in sorted(set(idle) | set(join)):
+        print('{:>14} {:>10} {:>10}'.format(t, idle[t], join[t]))
+    print('{:>14} {:>10} {:>10}'.format('total', sum(idle.values()), sum(join.values())))
+
+
+if __name__ == '__main__':
+    main()
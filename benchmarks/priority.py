@@ -0,0 +1,114 @@
+import argparse
+import contextlib
+import io
+import queue
+import socket
+import threading
+import time
+
+from src import client
+from src.packet import Packet, PacketType
+from benchmarks.cluster import percentile
+
+
+def sock(connection):
+    if hasattr(connection, 'get_extra_info'):
+        return connection.get_extra_info('socket')
+    return connection
+
+
+# Small socket buffers, so that what the receiver can't take yet waits in the sender's queues.
+def narrow(node, size: int):
+    for connection in node.peers():
+        sock(connection).setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+        sock(connection).setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+
+
+# Roster updates of `entries` nicknames with a new version each time, so every line is work for the receiver.
+def storm(node, connection, entries: int, stopped: threading.Event, sent: list):
+    version = 1
+    while not stopped.is_set():
+        version += 1
+        lines = ['u'] + ['+{}:storm{}'.format(version, i) for i in range(entries)]
+        node.send_to(connection, Packet(PacketType.PRESENCE, '\n'.join(lines)))
+        sent[0] += 1
+        if sent[0] % 50 == 0:
+            time.sleep(0.001)
+
+
+def chat(node, rate: float, duration: float) -> int:
+    start = time.perf_counter()
+    count = int(rate * duration)
+    for i in range(count):
+        time.sleep(max(0.0, start + i / rate - time.perf_counter()))
+        message = Packet(PacketType.MESSAGE, 's:bench:{}'.format(time.perf_counter()))
+        node.received.add(message.id)
+        node.send(message)
+    return count
+
+
+def collect(node, stopped: threading.Event, latencies: list):
+    while not stopped.is_set():
+        try:
+            message = node.got_messages.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        latencies.append(time.perf_counter() - float(message.data.split(':')[-1]))
+
+
+def phase(sender, receiver, args, stormy: bool) -> tuple:
+    latencies = []
+    sent = [0]
+    stopped = threading.Event()
+    collecting = threading.Event()
+    threads = [threading.Thread(target=collect, args=(receiver, collecting, latencies))]
+    if stormy:
+        threads.append(threading.Thread(target=storm, args=(sender, sender.peers()[0], args.entries, stopped, sent)))
+    for thread in threads:
+        thread.start()
+    count = chat(sender, args.rate, args.duration)
+    stopped.set()
+    time.sleep(args.grace)
+    collecting.set()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), count, sent[0], len(sender.peers())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=sorted(client.ENGINES), default='threads')
+    parser.add_argument('--rate', help='Chat messages per second', type=float, default=50)
+    parser.add_argument('--duration', help='Seconds of each phase', type=float, default=5)
+    parser.add_argument('--entries', help='Roster lines in one presence packet of the storm', type=int, default=200)
+    parser.add_argument('--buffer', help='Socket buffer bytes of the link', type=int, default=32768)
+    parser.add_argument('--grace', help='Seconds to wait for the last messages', type=float, default=3)
+    parser.add_argument('--port', help='Port of the receiver, the sender takes the next one', type=int,
+                        default=22500)
+    args = parser.parse_args()
+    engine = client.get_engine(args.engine)
+    with contextlib.redirect_stdout(io.StringIO()):
+        receiver = engine(None, args.port)
+        receiver.run()
+        sender = engine(('127.0.0.1', args.port), args.port + 1)
+        for node in (receiver, sender):
+            node.peer_manager.target_degree = 0
+        sender.run()
+        time.sleep(1)
+        narrow(sender, args.buffer)
+        narrow(receiver, args.buffer)
+        results = [phase(sender, receiver, args, stormy) for stormy in (False, True)]
+        sender.close()
+        receiver.close()
+    print('{} engine, {:.0f} chat messages/s, storm of {}-line presence updates'.format(
+        args.engine, args.rate, args.entries))
+    print('{:>8} {:>10} {:>10} {:>10} {:>10} {:>12} {:>6}'.format(
+        'phase', 'delivered', 'p50 ms', 'p99 ms', 'max ms', 'storm pkts', 'links'))
+    for name, (latencies, sent, storm_packets, links) in zip(('quiet', 'storm'), results):
+        print('{:>8} {:>10} {:>10.1f} {:>10.1f} {:>10.1f} {:>12} {:>6}'.format(
+            name, '{}/{}'.format(len(latencies), sent), percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000, latencies[-1] * 1000 if latencies else 0.0, storm_packets, links))
+
+
+if __name__ == '__main__':
+    main()
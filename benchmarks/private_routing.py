@@ -0,0 +1,112 @@
+import argparse
+import contextlib
+import io
+import queue
+import random
+import time
+
+from src import client
+from src.packet import Packet, PacketType
+from benchmarks.cluster import build_topology
+
+MESSAGES_OUT = 'chat_packets_out_total{type="message"}'
+
+
+def build(engine, topology: list, port: int) -> list:
+    nodes = []
+    for index, neighbors in enumerate(topology):
+        node = engine(('127.0.0.1', port + neighbors[0]) if neighbors else None, port + index)
+        # the topology is the one under test, the peer manager must not add links to it
+        node.peer_manager.target_degree = 0
+        for neighbor in neighbors[1:]:
+            node._connect('127.0.0.1', port + neighbor)
+        node.run()
+        node.presence.join('user{}'.format(index))
+        nodes.append(node)
+    return nodes
+
+
+def converge(nodes: list, timeout: float) -> float:
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if all(len(node.router) >= len(nodes) - 1 for node in nodes):
+            break
+        time.sleep(0.1)
+    return time.perf_counter() - start
+
+
+def messages_out(nodes: list) -> int:
+    return sum(node.metrics.snapshot().get(MESSAGES_OUT, 0) for node in nodes)
+
+
+def drain(nodes: list):
+    for node in nodes:
+        while True:
+            try:
+                node.got_messages.get_nowait()
+            except queue.Empty:
+                break
+
+
+# Sends the messages one after another and waits until each of them reached its addressee,
+# or every node for a shared message. Returns the packets sent per message and the deliveries.
+def measure(nodes: list, pairs: list, private: bool, timeout: float) -> tuple:
+    drain(nodes)
+    before = messages_out(nodes)
+    delivered = 0
+    for sender, addressee in pairs:
+        if private:
+            data = 'p:user{}:user{}:bench'.format(addressee, sender)
+            receivers = [nodes[addressee]]
+        else:
+            data = 's:user{}:bench'.format(sender)
+            receivers = [node for i, node in enumerate(nodes) if i != sender]
+        message = Packet(PacketType.MESSAGE, data)
+        nodes[sender].received.add(message.id)
+        nodes[sender].send(message)
+        deadline = time.perf_counter() + timeout
+        for receiver in receivers:
+            try:
+                while receiver.got_messages.get(timeout=max(0.0, deadline - time.perf_counter())).id != message.id:
+                    pass
+                delivered += 1
+            except queue.Empty:
+                pass
+    time.sleep(0.5)
+    return (messages_out(nodes) - before) / len(pairs), delivered
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=30)
+    parser.add_argument('--topology', choices=['chain', 'star', 'random'], default='random')
+    parser.add_argument('--degree', help='Links a node of the random topology opens', type=int, default=2)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--engine', choices=sorted(client.ENGINES), default='threads')
+    parser.add_argument('--timeout', help='Seconds a message may take to arrive', type=float, default=5)
+    parser.add_argument('--port', help='Port of the first node, the others take the next ones', type=int,
+                        default=23000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    topology = build_topology(args.topology, args.nodes, args.degree, args.seed)
+    pairs = [tuple(rng.sample(range(args.nodes), 2)) for _ in range(args.messages)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        nodes = build(client.get_engine(args.engine), topology, args.port)
+        converged = converge(nodes, 60)
+        hops = [nodes[sender].router.get('user{}'.format(addressee)) for sender, addressee in pairs]
+        private, private_delivered = measure(nodes, pairs, True, args.timeout)
+        shared, shared_delivered = measure(nodes, pairs, False, args.timeout)
+        for node in nodes:
+            node.close()
+    known = [route.distance for route in hops if route is not None]
+    print('{} nodes ({}), routes converged in {:.1f} s, mean route length {:.2f} hops'.format(
+        args.nodes, args.topology, converged, sum(known) / len(known) if known else 0.0))
+    print('{:>10} {:>12} {:>12}'.format('message', 'packets/msg', 'delivered'))
+    print('{:>10} {:>12.2f} {:>12}'.format('private', private, '{}/{}'.format(private_delivered, len(pairs))))
+    print('{:>10} {:>12.2f} {:>12}'.format('shared', shared, '{}/{}'.format(
+        shared_delivered, len(pairs) * (args.nodes - 1))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import contextlib
+import io
+import queue
+import socket
+import threading
+import time
+
+from src import client
+from src.packet import Packet, PacketType
+from benchmarks.cluster import percentile
+
+
+# Nodes that accept connections and never answer the handshake, and ports nobody listens on.
+def bad_candidates(port: int, silent: int, dead: int) -> tuple:
+    listeners = []
+    for i in range(silent):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', port + i))
+        listener.listen(16)
+        listeners.append(listener)
+    return listeners, ['127.0.0.1:{}'.format(port + i) for i in range(silent + dead)]
+
+
+def probe(node, stopped: threading.Event):
+    while not stopped.is_set():
+        message = Packet(PacketType.MESSAGE, 's:probe:{}'.format(time.perf_counter()))
+        node.received.add(message.id)
+        node.send(message)
+        time.sleep(0.01)
+
+
+def first_arrival(node, after: float, timeout: float, results: list):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            message = node.got_messages.get(timeout=0.05)
+        except queue.Empty:
+            continue
+        if float(message.data.split(':')[-1]) >= after:
+            results.append(time.perf_counter() - after)
+            return
+
+
+# Every node joins the seed, so the seed is the parent of all of them. Once the links are up
+# the seed is closed and one node keeps sending, a node is recovered when a probe sent after
+# the failure reaches it.
+def run(engine, args) -> tuple:
+    listeners, bad = bad_candidates(args.port + args.nodes + 1, args.silent, args.dead)
+    seed = engine(None, args.port)
+    seed.run()
+    nodes = []
+    for i in range(args.nodes):
+        node = engine(('127.0.0.1', args.port), args.port + 1 + i)
+        node.peer_manager.target_degree = args.degree
+        node.run()
+        nodes.append(node)
+    time.sleep(args.settle)
+    for node in nodes:
+        for address in bad:
+            node.ip_list.add(address)
+    stopped = threading.Event()
+    start = time.perf_counter()
+    seed.close()
+    threading.Thread(target=probe, args=(nodes[0], stopped)).start()
+    results = []
+    waiters = [threading.Thread(target=first_arrival, args=(node, start, args.timeout, results))
+               for node in nodes[1:]]
+    for waiter in waiters:
+        waiter.start()
+    for waiter in waiters:
+        waiter.join()
+    stopped.set()
+    attempts = sum(node.metrics.snapshot().get('chat_reconnect_attempts_total', 0) for node in nodes)
+    for node in nodes:
+        node.close()
+    for listener in listeners:
+        listener.close()
+    return sorted(results), attempts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', help='Nodes that lose their parent', type=int, default=10)
+    parser.add_argument('--silent', help='Candidates that never answer the handshake', type=int, default=10)
+    parser.add_argument('--dead', help='Candidates nobody listens on', type=int, default=10)
+    parser.add_argument('--degree', help='Target degree of the peer manager, 0 repairs the parent link only',
+                        type=int, default=0)
+    parser.add_argument('--engine', choices=sorted(client.ENGINES), default='threads')
+    parser.add_argument('--settle', help='Seconds between the joins and the failure', type=float, default=3)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--port', help='Port of the seed, the others take the next ones', type=int, default=25000)
+    args = parser.parse_args()
+    with contextlib.redirect_stdout(io.StringIO()):
+        results, attempts = run(client.get_engine(args.engine), args)
+    print('{}: {} of {} nodes recovered, {} connection attempts'.format(
+        args.engine, len(results), args.nodes - 1, attempts))
+    print('recovery ms: p50 {:.1f}, p99 {:.1f}, max {:.1f}'.format(
+        percentile(results, 0.5) * 1000, percentile(results, 0.99) * 1000,
+        results[-1] * 1000 if results else 0.0))
+
+
+if __name__ == '__main__':
+    main()
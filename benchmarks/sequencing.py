@@ -0,0 +1,117 @@
+import argparse
+import contextlib
+import io
+import queue
+import random
+import time
+import tracemalloc
+
+from src import client
+from src import dedup
+from src import packet
+from src.packet import Packet, PacketType
+from benchmarks.hop_latency import build_chain
+
+
+def fill(cache, ids: list):
+    for msg_id in ids:
+        if msg_id not in cache:
+            cache.add(msg_id)
+
+
+# Memory is traced in one run and time is taken in another, tracing slows the lookups down.
+def dedup_cost(cache_class, ids: list) -> tuple:
+    tracemalloc.start()
+    cache = cache_class()
+    fill(cache, ids)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    fill(cache_class(), ids)
+    return memory, (time.perf_counter() - start) / len(ids)
+
+
+def dedup_ids(messages: int, origins: int, sequenced: bool) -> list:
+    if not sequenced:
+        return [random.randint(0, packet.MAX_ID - 1) for _ in range(messages)]
+    return [packet.sequenced_id(origin, sequence)
+            for sequence in range(messages // origins) for origin in range(origins)]
+
+
+# The last node of a chain loses a share of the messages that reach it for the first time.
+def lossy_chain(engine, args, sequencing: bool) -> tuple:
+    rng = random.Random(args.seed)
+    nodes = build_chain(engine, 3, args.port + (10 if sequencing else 0))
+    for node in nodes:
+        node.sequencing = sequencing
+    last = nodes[-1]
+    process = last._process
+
+    def losing(message, source=None):
+        if message.type is PacketType.MESSAGE and message.id not in last.received and rng.random() < args.loss:
+            return
+        process(message, source)
+    last._process = losing
+    time.sleep(2)
+    sent = []
+    for i in range(args.count):
+        message = Packet(PacketType.MESSAGE, 's:bench:{}'.format(i), nodes[0].new_id())
+        nodes[0].received.add(message.id)
+        nodes[0].send(message)
+        sent.append(message.data)
+        time.sleep(args.interval)
+    delivered = []
+    deadline = time.perf_counter() + args.grace
+    while len(delivered) < len(sent):
+        try:
+            delivered.append(last.got_messages.get(timeout=max(0.0, deadline - time.perf_counter())).data)
+        except queue.Empty:
+            break
+    snapshot = last.metrics.snapshot()
+    for node in nodes:
+        node.close()
+    in_order = 0
+    highest = -1
+    for data in delivered:
+        number = int(data.split(':')[-1])
+        if number > highest:
+            in_order += 1
+            highest = number
+    return (len(delivered), in_order, snapshot.get('chat_retransmit_requests_total', 0),
+            snapshot.get('chat_sequence_gaps_skipped_total', 0))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', help='IDs put into the dedup caches', type=int, default=200000)
+    parser.add_argument('--origins', help='Origins the sequenced IDs come from', type=int, default=100)
+    parser.add_argument('--count', help='Messages sent along the lossy chain', type=int, default=500)
+    parser.add_argument('--loss', help='Share of new messages the last node of the chain loses', type=float,
+                        default=0.05)
+    parser.add_argument('--interval', help='Seconds between two messages of the chain', type=float, default=0.002)
+    parser.add_argument('--grace', help='Seconds to wait for the last messages', type=float, default=5)
+    parser.add_argument('--engine', choices=sorted(client.ENGINES), default='threads')
+    parser.add_argument('--port', help='First port of the chain', type=int, default=21500)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    print('dedup of {} messages, sequenced ones from {} origins'.format(args.messages, args.origins))
+    print('{:>24} {:>12} {:>14}'.format('cache', 'memory KiB', 'ns per lookup'))
+    for name, cache_class, sequenced in (('DedupCache, random', dedup.DedupCache, False),
+                                         ('Sequenced, random', dedup.SequencedDedupCache, False),
+                                         ('Sequenced, sequenced', dedup.SequencedDedupCache, True)):
+        memory, seconds = dedup_cost(cache_class, dedup_ids(args.messages, args.origins, sequenced))
+        print('{:>24} {:>12.0f} {:>14.0f}'.format(name, memory / 1024, seconds * 1e9))
+    print()
+    print('{} messages along a chain of 3, the last node loses {:.0%} of them'.format(args.count, args.loss))
+    print('{:>12} {:>10} {:>10} {:>12} {:>8}'.format('ids', 'delivered', 'in order', 'retransmits', 'skipped'))
+    engine = client.get_engine(args.engine)
+    for sequencing in (False, True):
+        with contextlib.redirect_stdout(io.StringIO()):
+            delivered, in_order, retransmits, skipped = lossy_chain(engine, args, sequencing)
+        print('{:>12} {:>10} {:>10} {:>12} {:>8}'.format(
+            'sequenced' if sequencing else 'random', delivered, in_order, retransmits, skipped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CHILD = '''
+import json, resource, sys, time
+start = time.perf_counter()
+{code}
+print(json.dumps([time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]))
+'''
+
+# Both start and stop the same node, the GUI one also brings up a Tk root window.
+SCENARIOS = {
+    'headless relay': '''
+from src import headless, client
+node = client.get_engine('threads')(None, {port})
+node.run()
+node.close()
+''',
+    'gui': '''
+from src import gui, client
+node = client.get_engine('threads')(None, {port})
+node.run()
+root = gui.Tk()
+root.update()
+root.destroy()
+node.close()
+''',
+}
+# Scenarios that need a display
+GRAPHICAL = ('gui',)
+
+
+def run(code: str) -> tuple:
+    output = subprocess.run([sys.executable, '-c', CHILD.format(code=code)], check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', help='Port for the headless node', type=int, default=22000)
+    args = parser.parse_args()
+    print('{:>15} {:>12} {:>10}'.format('scenario', 'startup ms', 'RSS MB'))
+    for name, code in SCENARIOS.items():
+        if name in GRAPHICAL and not os.environ.get('DISPLAY'):
+            print('{:>15} {:>23}'.format(name, 'skipped, no DISPLAY'))
+            continue
+        results = [run(code.format(port=args.port + i)) for i in range(args.runs)]
+        print('{:>15} {:>12.1f} {:>10.1f}'.format(name, statistics.median(r[0] for r in results) * 1000,
+                                                  statistics.median(r[1] for r in results) / 1024))
+
+
+if __name__ == '__main__':
+    main()
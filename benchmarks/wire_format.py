@@ -0,0 +1,41 @@
+import argparse
+import time
+
+from src import framing
+from src.packet import Packet, PacketType
+
+PAYLOADS = {
+    'ascii': 's:user:' + 'hello world ' * 8,
+    'cyrillic': 's:пользователь:' + 'привет, мир ' * 8,
+}
+
+
+def measure(function, count: int) -> float:
+    start = time.perf_counter()
+    function()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', help='Packets per run', type=int, default=20000)
+    args = parser.parse_args()
+    print('{:>9} {:>8} {:>12} {:>12} {:>12}'.format('payload', 'version', 'encode p/s', 'decode p/s', 'bytes/frame'))
+    for name, text in PAYLOADS.items():
+        packets = [Packet(PacketType.MESSAGE, text) for _ in range(args.count)]
+        for version in (1, 2):
+            encode = measure(lambda: [p.encode(version) for p in packets], args.count)
+            stream = b''.join(p.encode(version) for p in packets)
+
+            def decode():
+                decoder = framing.FrameDecoder(version)
+                for i in range(0, len(stream), 4096):
+                    for frame in decoder.feed(stream[i:i + 4096]):
+                        Packet.decode(frame, version).payload
+
+            print('{:>9} {:>8} {:>12.0f} {:>12.0f} {:>12.1f}'.format(
+                name, version, encode, measure(decode, args.count), len(stream) / args.count))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,29 @@
-from src import gui
+import argparse
 
 
 def main():
-    '''
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', nargs=1, help='Port on your computer', type=int)
     parser.add_argument('--chat_ip', nargs=2, help='Another user host and port', type=str)
-    args = parser.parse_args()
-    chat_port = 9090
-    if args.port is not None:
-        chat_port = args.port[0]
+    parser.add_argument('--headless', action='store_true', help='Run without GUI, see python -m src.headless -h')
+    args, rest = parser.parse_known_args()
+    if args.headless:
+        from src import headless
+        argv = list(rest)
+        if args.port is not None:
+            argv += ['--port', str(args.port[0])]
+        if args.chat_ip is not None:
+            argv += ['--peer', '{}:{}'.format(*args.chat_ip)]
+        headless.main(argv)
+        return
+    from src import gui
     addr = None
     if args.chat_ip is not None:
-        host = args.chat_ip[0]
-        port = int(args.chat_ip[1])
-        addr = (host, port)
-    # app = gui.Interface(addr, chat_port)
-    '''
-    app = gui.Interface()
+        addr = (args.chat_ip[0], int(args.chat_ip[1]))
+    if args.port is None and addr is None:
+        app = gui.Interface()
+    else:
+        app = gui.Interface(addr, args.port[0] if args.port is not None else 9090)
     app.run()
 
 
@@ -0,0 +1,294 @@
+import asyncio
+import concurrent.futures
+import queue
+import threading
+import time
+
+from src.packet import Packet, PacketType
+from src.writer import LinkQueue
+from src import codec
+from src import framing
+from src import packet
+from src import queues
+from src import server
+
+
+# Protocol handling is inherited from server.Server, only the socket work runs on the loop.
+class AsyncServer(server.Server):
+    def __init__(self, chat_addr=None, server_port=None, dissemination='flood', compression=True, sequencing=False):
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(name='network', target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        self._acceptor = None
+        self._deflaters = {}
+        self._flushing = set()
+        self._flush_lock = threading.Lock()
+        self.handshake_timeout = 5
+        # bytes a transport may buffer before _flush waits for it to drain, the rest waits in
+        # the link queue where chat can still overtake it
+        self.write_buffer = 1 << 14
+        self.processing_slice = 0.001
+        self._received = asyncio.Event()
+        self._room = asyncio.Event()
+        super().__init__(chat_addr, server_port, dissemination, compression, sequencing)
+        asyncio.run_coroutine_threadsafe(self._process_received(), self._loop)
+
+    def run(self):
+        asyncio.run_coroutine_threadsafe(self._serve(), self._loop).result()
+        self._gossiping.run()
+        self._presence_updater.run()
+        self._catching_up.run()
+        self._routing.run()
+        self._ordering.run()
+        self._managing.run()
+
+    async def _serve(self):
+        if self._acceptor is None:
+            self._acceptor = await asyncio.start_server(self._accept_peer, sock=self._receive_socket)
+
+    # Yields to the readers once it has been processing for `processing_slice` seconds, so a run of
+    # big presence packets doesn't keep them from draining the sockets and queueing new chat ahead.
+    async def _process_received(self):
+        while not self._closed:
+            deadline = time.perf_counter() + self.processing_slice
+            while time.perf_counter() < deadline:
+                try:
+                    message, source = self.receiving_queue.get_nowait()
+                except queue.Empty:
+                    self._received.clear()
+                    await self._received.wait()
+                    break
+                self._room.set()
+                if source not in self._connections:
+                    continue
+                try:
+                    self._process(message, source)
+                except server.MALFORMED:
+                    self._drop_connection(source)
+            else:
+                await asyncio.sleep(0)
+
+    def _queue_broadcast(self, message: Packet, source) -> bool:
+        self._loop.call_soon_threadsafe(self._broadcast, message, source)
+        return True
+
+    # Frames wait in the link queue, whichever thread writes them, until the loop gets to _flush.
+    # It hands them to the transport in batches while the transport buffers less than
+    # write_buffer bytes, a compressed link sends every batch as one block. So chat is queued
+    # ahead of the bulk that is waiting, not behind the callbacks of every earlier frame.
+    # Frames are counted as sent there, the ones dropped over high_water never are.
+    def _write(self, connection, frame: bytes) -> bool:
+        frames = self._senders.get(connection)
+        if frames is None or connection.is_closing():
+            return False
+        if not frames.put(frame, queues.FRAME_PRIORITIES.get(self._frame_type(connection, frame), 0)):
+            return False
+        with self._flush_lock:
+            if connection in self._flushing:
+                return True
+            self._flushing.add(connection)
+        self._loop.call_soon_threadsafe(self._flush, connection)
+        return True
+
+    def _add_link(self, connection, version: int):
+        self._versions[connection] = version
+        self._senders[connection] = LinkQueue(self.high_water, self.overflow)
+        connection.transport.set_write_buffer_limits(self.write_buffer)
+        deflater = self._deflater(version)
+        if deflater is not None:
+            self._deflaters[connection] = deflater
+
+    # One batch per call, so the loop gets to chat in between batches of bulk.
+    def _flush(self, connection):
+        frames = self._senders.get(connection)
+        if frames is not None and not connection.is_closing():
+            if connection.transport.get_write_buffer_size() > self.write_buffer:
+                self._loop.create_task(self._drain(connection))
+                return
+            batch = frames.batch()
+            if batch:
+                data = b''.join(batch)
+                deflater = self._deflaters.get(connection)
+                connection.write(data if deflater is None else deflater.pack(data))
+                for frame in batch:
+                    self._count_out(connection, frame)
+            with self._flush_lock:
+                if frames.queued_bytes:
+                    self._loop.call_soon(self._flush, connection)
+                    return
+        with self._flush_lock:
+            self._flushing.discard(connection)
+
+    async def _drain(self, connection):
+        try:
+            await connection.drain()
+        except OSError:
+            with self._flush_lock:
+                self._flushing.discard(connection)
+            return
+        self._flush(connection)
+
+    def _connect(self, chat_host, chat_port: int):
+        self._attempt(chat_host, chat_port).result()
+
+    # The future gets the writer once the link is established.
+    def _attempt(self, chat_host, chat_port: int) -> concurrent.futures.Future:
+        if self._closed:
+            raise ConnectionAbortedError('Server is closed')
+        return asyncio.run_coroutine_threadsafe(self._connect_async(chat_host, chat_port), self._loop)
+
+    async def _connect_async(self, chat_host, chat_port: int):
+        try:
+            stream, writer = await asyncio.wait_for(asyncio.open_connection(chat_host, chat_port),
+                                                    self.handshake_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Connection to {}:{} timed out'.format(chat_host, chat_port))
+        decoder = framing.FrameDecoder()
+        writer.write(bytes(Packet(PacketType.CONNECTION, str(self.protocol_version))))
+        try:
+            info = await self._read_packet(stream, decoder)
+        except asyncio.TimeoutError:
+            writer.close()
+            raise TimeoutError('Handshake with {}:{} timed out'.format(chat_host, chat_port))
+        except OSError:
+            writer.close()
+            raise
+        if self._closed:
+            writer.close()
+            raise ConnectionAbortedError('Server is closed')
+        if info.type is not PacketType.CONFIRMATION:
+            writer.close()
+            raise ConnectionRefusedError('Unexpected handshake reply: ' + repr(info))
+        writer.write(bytes(Packet(PacketType.CONFIRMATION, str(self._server_port))))
+        decoder.version = packet.negotiate_version(info.data, self.protocol_version)
+        self._add_link(writer, decoder.version)
+        self._connections.append(writer)
+        self.presence.connected(writer)
+        self.catchup.connected(writer)
+        self.router.connected(writer)
+        if self._par_conn is None:
+            self._par_conn = writer
+        print('connected')
+        self._loop.create_task(self._serve_peer(stream, writer, decoder))
+        address = '{}:{}'.format(chat_host, chat_port)
+        self.ip_list.add(address)
+        self.peer_manager.connected(writer, address, True)
+        if decoder.version > 1:
+            self.peer_manager.ask(writer)
+        else:
+            # old peers parse the handshake with a single recv
+            self._loop.call_later(server.LEGACY_DELAY, self.peer_manager.ask, writer)
+        return writer
+
+    async def _accept_peer(self, stream, writer):
+        decoder = framing.FrameDecoder()
+        try:
+            info = await self._read_packet(stream, decoder)
+            if info.type is not PacketType.CONNECTION:
+                writer.close()
+                return
+            version = packet.negotiate_version(info.data, self.protocol_version)
+            writer.write(bytes(Packet(PacketType.CONFIRMATION, str(version) if version > 1 else '')))
+            info = await self._read_packet(stream, decoder)
+            if info.type is not PacketType.CONFIRMATION:
+                writer.close()
+                return
+        except (OSError, asyncio.TimeoutError):
+            writer.close()
+            return
+        if self._closed:
+            writer.close()
+            return
+        host = writer.get_extra_info('peername')[0]
+        decoder.version = version
+        self._add_link(writer, version)
+        self._connections.append(writer)
+        self.router.connected(writer)
+        self.ip_list.add(host + ':' + info.data)
+        self.peer_manager.connected(writer, host + ':' + info.data, False)
+        print('accepted')
+        await self._serve_peer(stream, writer, decoder)
+
+    async def _read_packet(self, stream, decoder) -> Packet:
+        frames = decoder.feed(b'', 1)
+        while not frames:
+            chunk = await asyncio.wait_for(stream.read(self.packet_size), self.handshake_timeout)
+            if not chunk:
+                raise ConnectionResetError('Connection closed during handshake')
+            frames = decoder.feed(chunk, 1)
+        return packet.decode(frames[0], decoder.version)
+
+    # Readers only queue what they decode, _process_received takes it by priority class, so chat
+    # doesn't wait behind the presence and gossip read before it. A full class of blocking
+    # overflow stops the reader, and TCP flow control pushes back on the peer.
+    async def _serve_peer(self, stream, writer, decoder):
+        chunk = b''
+        try:
+            while True:
+                for message in codec.parse_many(decoder.feed(chunk), decoder.version):
+                    while self.receiving_queue.full((message, writer)) and not self._closed:
+                        self._room.clear()
+                        await self._room.wait()
+                    self.receiving_queue.put_nowait((message, writer))
+                    self._received.set()
+                chunk = await stream.read(self.packet_size)
+                if not chunk:
+                    break
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._drop_connection(writer)
+
+    def _drop_connection(self, writer):
+        if writer in self._connections:
+            self._connections.remove(writer)
+        self._versions.pop(writer, None)
+        self._deflaters.pop(writer, None)
+        self._senders.pop(writer, None)
+        with self._flush_lock:
+            self._flushing.discard(writer)
+        self.dissemination.forget(writer)
+        self.presence.forget(writer)
+        self.catchup.forget(writer)
+        self.router.forget(writer)
+        self.metrics.forget(writer)
+        writer.close()
+        parent = writer is self._par_conn
+        if parent:
+            self._par_conn = None
+        self.peer_manager.forget(writer, parent)
+
+    def _disconnect(self, writer):
+        self._loop.call_soon_threadsafe(self._drop_connection, writer)
+
+    async def _shutdown(self):
+        self._closed = True
+        self._received.set()
+        self._room.set()
+        for writer in self._connections:
+            writer.close()
+        self._connections.clear()
+        if self._acceptor is not None:
+            self._acceptor.close()
+        else:
+            self._receive_socket.close()
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=self.handshake_timeout)
+            # attempts to silent peers would only end with their handshake timeout
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    def close(self):
+        self.metrics.close()
+        self._presence_updater.stop()
+        self._catching_up.stop()
+        self._routing.stop()
+        self._ordering.stop()
+        self._gossiping.stop()
+        self._managing.stop()
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
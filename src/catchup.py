@@ -0,0 +1,206 @@
+import bisect
+import collections
+import functools
+import json
+import operator
+import threading
+import time
+
+from src import packet
+from src.packet import Packet, PacketType
+
+SUMMARY = 'S'
+IDS = 'I'
+IDS_REPLY = 'i'
+WANT = 'W'
+BATCH = 'B'
+
+
+# Anti-entropy over the messages of the last `window` seconds, run when a link comes up.
+# A summary line describes a range of the ID space by the (count, XOR of IDs) of each
+# of its `fanout` subranges. A subrange that differs is described again until one side
+# has at most `leaf` IDs in it, then that side lists its IDs and the other one asks
+# for what it lacks with WANT and answers with the IDs the first side lacks.
+# Packets go back in BATCH frames of up to batch_bytes, so a resync costs
+# a few summaries per level plus the missed packets themselves.
+# Caught up messages are delivered locally without being flooded again: instead the node
+# starts the same exchange with its other neighbors, which only transfers what they miss too.
+# Private messages are not kept, a resync would hand them to any neighbor. One that still
+# comes in a batch is delivered only to its users and passed on along the route otherwise.
+class AntiEntropy:
+    def __init__(self, server, window=600, max_messages=20000, fanout=16, leaf=32, batch_bytes=1 << 16):
+        self._server = server
+        self.window = window
+        self.max_messages = max_messages
+        self.fanout = fanout
+        self.leaf = leaf
+        self.batch_bytes = batch_bytes
+        self.caught_up = 0
+        self._ids = []
+        self._messages = {}
+        self._arrivals = collections.deque()
+        self._new_links = []
+        self._resync = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, message: Packet, arrival=None):
+        if self._server.router.private(message):
+            return
+        if arrival is None:
+            arrival = time.time()
+        with self._lock:
+            if message.id in self._messages:
+                return
+            self._messages[message.id] = message
+            self._arrivals.append((arrival, message.id))
+            bisect.insort(self._ids, message.id)
+            if len(self._messages) > self.max_messages:
+                self._remove(self._arrivals.popleft()[1])
+
+    def _remove(self, msg_id: int):
+        del self._messages[msg_id]
+        del self._ids[bisect.bisect_left(self._ids, msg_id)]
+
+    def _range(self, lo: int, hi: int) -> list:
+        return self._ids[bisect.bisect_left(self._ids, lo):bisect.bisect_left(self._ids, hi)]
+
+    @staticmethod
+    def _split(lo: int, hi: int, parts: int) -> list:
+        step = (hi - lo + parts - 1) // parts
+        return [(start, min(start + step, hi)) for start in range(lo, hi, step)]
+
+    def _digest(self, lo: int, hi: int) -> str:
+        ids = self._range(lo, hi)
+        return '{}:{:x}'.format(len(ids), functools.reduce(operator.xor, ids, 0))
+
+    def _describe(self, lo: int, hi: int) -> str:
+        return ' '.join([str(lo), str(hi)] + [self._digest(*part) for part in self._split(lo, hi, self.fanout)])
+
+    def connected(self, connection):
+        if self._server.version(connection) >= 2:
+            with self._lock:
+                self._new_links.append(connection)
+
+    def forget(self, connection):
+        with self._lock:
+            self._new_links = [link for link in self._new_links if link is not connection]
+
+    def handle(self, message: Packet, source) -> bool:
+        if message.type is not PacketType.SYNC:
+            return False
+        kind, _, data = message.data.partition('\n')
+        if kind == SUMMARY:
+            self._on_summary(data, source)
+        elif kind in (IDS, IDS_REPLY):
+            self._on_ids(data, source, kind == IDS)
+        elif kind == WANT:
+            self._on_want(packet.decode_ids(data), source)
+        elif kind == BATCH:
+            self._on_batch(json.loads(data), source)
+        return True
+
+    def _on_summary(self, data: str, source):
+        described = [SUMMARY]
+        listed = [IDS]
+        with self._lock:
+            for line in data.split('\n'):
+                lo, hi, *digests = line.split()
+                lo, hi = int(lo), int(hi)
+                if not digests or not 0 <= lo < hi <= packet.ID_LIMIT:
+                    raise ValueError('Bad summary line: ' + line)
+                for (start, end), digest in zip(self._split(lo, hi, len(digests)), digests):
+                    if self._digest(start, end) == digest:
+                        continue
+                    ids = self._range(start, end)
+                    if len(ids) <= self.leaf or end - start <= self.fanout:
+                        listed.append('{} {} {}'.format(start, end, packet.encode_ids(ids)))
+                    else:
+                        described.append(self._describe(start, end))
+        if len(described) > 1:
+            self._server.send_to(source, Packet(PacketType.SYNC, '\n'.join(described)))
+        if len(listed) > 1:
+            self._server.send_to(source, Packet(PacketType.SYNC, '\n'.join(listed)))
+
+    def _on_ids(self, data: str, source, reply: bool):
+        wanted = []
+        listed = [IDS_REPLY]
+        with self._lock:
+            for line in data.split('\n'):
+                lo, hi, ids = (line.split(' ') + [''])[:3]
+                theirs = set(packet.decode_ids(ids))
+                wanted.extend(msg_id for msg_id in theirs
+                              if msg_id not in self._messages and msg_id not in self._server.received)
+                extra = [msg_id for msg_id in self._range(int(lo), int(hi)) if msg_id not in theirs]
+                if reply and extra:
+                    listed.append('{} {} {}'.format(lo, hi, packet.encode_ids(extra)))
+        if wanted:
+            self._server.send_to(source, Packet(PacketType.SYNC, '{}\n{}'.format(WANT, packet.encode_ids(wanted))))
+        if len(listed) > 1:
+            self._server.send_to(source, Packet(PacketType.SYNC, '\n'.join(listed)))
+
+    def _on_want(self, ids: list, source):
+        with self._lock:
+            messages = [self._messages[msg_id] for msg_id in ids if msg_id in self._messages]
+        batch = []
+        size = 0
+        for message in messages:
+            batch.append([message.id, message.data])
+            size += len(message.payload)
+            if size >= self.batch_bytes:
+                self._send_batch(source, batch)
+                batch = []
+                size = 0
+        if batch:
+            self._send_batch(source, batch)
+
+    def _send_batch(self, connection, batch: list):
+        data = json.dumps(batch, ensure_ascii=False, separators=(',', ':'))
+        self._server.send_to(connection, Packet(PacketType.SYNC, '{}\n{}'.format(BATCH, data)))
+
+    def _on_batch(self, batch: list, source):
+        if not isinstance(batch, list):
+            raise ValueError('Bad batch')
+        new = 0
+        for msg_id, data in batch:
+            if not isinstance(msg_id, int) or not isinstance(data, str):
+                raise ValueError('Bad batch entry')
+            if not 0 <= msg_id < packet.ID_LIMIT or msg_id in self._server.received:
+                continue
+            message = Packet(PacketType.MESSAGE, data, msg_id)
+            self._server.received.add(msg_id)
+            self._server.delivered_bytes += len(message.payload)
+            new += 1
+            if not self._server.router.delivers(message):
+                self._server.send(message, source)
+                continue
+            self.add(message)
+            self._server.ordering.add(message, source)
+        if new:
+            with self._lock:
+                self.caught_up += new
+                if self._resync is None:
+                    self._resync = set()
+                self._resync.add(source)
+
+    def expire(self):
+        deadline = time.time() - self.window
+        with self._lock:
+            while self._arrivals and self._arrivals[0][0] < deadline:
+                self._remove(self._arrivals.popleft()[1])
+
+    def tick(self):
+        self.expire()
+        with self._lock:
+            new_links, self._new_links = self._new_links, []
+            resync, self._resync = self._resync, None
+            if not new_links and resync is None:
+                return
+            summary = Packet(PacketType.SYNC, '{}\n{}'.format(SUMMARY, self._describe(0, packet.ID_LIMIT)))
+        for connection in self._server.peers():
+            if self._server.version(connection) < 2:
+                continue
+            if connection in new_links or resync is not None and connection not in resync:
+                self._server.send_to(connection, summary)
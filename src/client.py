@@ -1,40 +1,136 @@
-import threading
+import importlib
+import queue
 import time
 
 from src import utils
-from src import server
+from src import codec
 from src import log
+from src import store
 from src.packet import Packet, PacketType
 from src.message import Message, MessageType
 
 
+# Imported on demand, asyncio alone takes longer to import than the rest of the package.
+ENGINES = {
+    'threads': ('src.server', 'Server'),
+    'asyncio': ('src.aio_server', 'AsyncServer'),
+}
+HISTORY_RETENTION = 30 * 24 * 3600
+# 64 segments of 65536 messages
+HISTORY_SEGMENTS = 64
+
+
+def get_engine(name: str):
+    module, cls = ENGINES[name]
+    return getattr(importlib.import_module(module), cls)
+
+
 class Client:
-    def __init__(self, nickname: str, chat_addr=None, server_port=None):
-        self.online_updater = utils.Daemon(name='online', target=self.online, timeout=10)
-        self._server = server.Server(chat_addr, server_port)
+    def __init__(self, nickname: str, chat_addr=None, server_port=None, engine='threads', dissemination='flood',
+                 history=None, compression=True, sequencing=False, history_retention=HISTORY_RETENTION):
+        self._server = get_engine(engine)(chat_addr, server_port, dissemination, compression, sequencing)
+        self._store = None
+        self.history_retention = history_retention
+        self._compacting = utils.Daemon(name='compacting', target=self._compact, timeout=3600)
+        if history is not None:
+            self._store = store.MessageStore(history, max_segments=HISTORY_SEGMENTS)
+            self._compact()
+            for record in self._store.since(time.time() - self._server.catchup.window):
+                self._server.catchup.add(Packet(PacketType.MESSAGE, record.data, record.id), record.time)
+        self._nickname = None
         self.nickname = nickname
         self._logger = log.Log('../log.txt')
-        self.users_list_lock = threading.RLock()
         self.black_list = utils.SafeSet()
-        # TODO make it safe
-        self.users_list = {}
-        self.users_list_refresher = utils.Daemon(name='users_list_refresher', target=self.refresh, timeout=5)
+        self._subscribers = []
+        self._delivering = utils.Daemon(name='delivering', target=self._deliver, timeout=0)
+
+    @property
+    def nickname(self) -> str:
+        return self._nickname
+
+    @nickname.setter
+    def nickname(self, nickname: str):
+        if self._nickname is not None:
+            self._server.presence.leave(self._nickname)
+        self._nickname = nickname
+        self._server.presence.join(nickname)
+
+    @property
+    def users_list(self):
+        return self._server.presence.online()
+
+    @property
+    def metrics(self):
+        return self._server.metrics
+
+    def subscribe_users(self, callback):
+        self._server.presence.subscribe(callback)
 
     def run(self):
-        self.online_updater.run()
-        self.users_list_refresher.run()
+        self._logger.run()
         self._server.run()
+        if self._store is not None:
+            self._compacting.run()
 
-    def get(self) -> Message:
-        if self._server.got_messages.empty():
-            return
-        message = self._server.got_messages.get()
-        self._logger.get(message)
-        if message.type is PacketType.ONLINE:
-            with self.users_list_lock:
-                self.users_list[message.data] = time.monotonic()
-            return None
-        message = Message.parse(message.data)
+    # Segments older than history_retention are deleted, max_segments bounds the rest.
+    def _compact(self):
+        if self.history_retention is not None:
+            self._store.compact(time.time() - self.history_retention)
+
+    def get(self, block=False, timeout=None) -> Message:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                message = self._server.got_messages.get(block, timeout)
+            except queue.Empty:
+                return None
+            messages = self._handle([message])
+            message = messages[0] if messages else None
+            if message is not None or not block:
+                return message
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+
+    def history(self, n=500) -> list:
+        if self._store is None:
+            return []
+        messages = codec.parse_messages([record.data for record in self._store.last(n)])
+        return [message for message in messages if message is not None and self._filter(message) is not None]
+
+    # Waits for a message like get, then takes whatever else is already queued, up to max_count packets.
+    def get_many(self, max_count=256, timeout=None) -> list:
+        try:
+            packets = [self._server.got_messages.get(True, timeout)]
+        except queue.Empty:
+            return []
+        while len(packets) < max_count:
+            try:
+                packets.append(self._server.got_messages.get_nowait())
+            except queue.Empty:
+                break
+        return self._handle(packets)
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+        self._delivering.run()
+
+    def _deliver(self):
+        for message in self.get_many(timeout=0.5):
+            for callback in self._subscribers:
+                callback(message)
+
+    def _handle(self, packets: list) -> list:
+        messages = []
+        for packet, message in zip(packets, codec.parse_messages([packet.data for packet in packets])):
+            self._logger.get(packet)
+            if message is None or self._filter(message) is None:
+                continue
+            if self._store is not None:
+                self._store.append(packet.id, packet.data)
+            messages.append(message)
+        return messages
+
+    def _filter(self, message: Message) -> Message:
         if message.nickname in self.black_list:
             return None
         if message.type is MessageType.PRIVATE and \
@@ -44,7 +140,9 @@ class Client:
 
     def send_message(self, message: Message):
         message.nickname = self.nickname
-        message = Packet(PacketType.MESSAGE, repr(message))
+        msg_id = self._server.new_id() if message.type is MessageType.SHARED else None
+        message = Packet(PacketType.MESSAGE, repr(message), msg_id)
+        self._server.catchup.add(message)
         self._server.got_messages.put(message)
         self.send(message)
 
@@ -52,16 +150,11 @@ class Client:
         self._server.received.add(message.id)
         self._server.send(message)
 
-    def online(self):
-        message = Packet(PacketType.ONLINE, self.nickname)
-        self.send(message)
-
-    def refresh(self):
-        cur_time = time.monotonic()
-        with self.users_list_lock:
-            self.users_list = dict(filter(lambda user: cur_time - user[1] < 30, self.users_list.items()))
-
     def close(self):
-        self.online_updater.stop()
-        self.users_list_refresher.stop()
+        self._delivering.stop()
+        self._compacting.stop()
+        self._server.presence.leave(self.nickname)
         self._server.close()
+        self._logger.close()
+        if self._store is not None:
+            self._store.close()
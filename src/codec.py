@@ -0,0 +1,38 @@
+import struct
+
+from src.message import parse_message
+from src.packet import HEADER, TYPE_BYTES, decode_v1, from_frame
+
+
+# Frames that can not be decoded are skipped, like a single bad frame is.
+def parse_many(frames: list, version=1) -> list:
+    messages = []
+    if version == 1:
+        for frame in frames:
+            try:
+                messages.append(decode_v1(frame))
+            except (ValueError, KeyError, IndexError):
+                pass
+        return messages
+    size = HEADER.size
+    unpack = HEADER.unpack_from
+    for frame in frames:
+        try:
+            frame_version, t, msg_id, length = unpack(frame)
+            if frame_version != version:
+                continue
+            messages.append(from_frame(TYPE_BYTES[t], msg_id, None, frame[size:size + length], len(frame)))
+        except (struct.error, KeyError):
+            pass
+    return messages
+
+
+# Texts that are not chat messages give None, so the result lines up with the texts.
+def parse_messages(texts) -> list:
+    messages = []
+    for text in texts:
+        try:
+            messages.append(parse_message(text))
+        except ValueError:
+            messages.append(None)
+    return messages
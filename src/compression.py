@@ -0,0 +1,66 @@
+import struct
+import zlib
+
+# flag, length of the block body
+BLOCK = struct.Struct('!BI')
+RAW = 0
+DEFLATE = 1
+# Small window and memory level keep the state of a link around 40 KB, chat batches are short anyway
+WBITS = 12
+MEM_LEVEL = 5
+MAX_BLOCK = 1 << 24
+
+# Strings every link carries: the high bytes of the frame length followed by the start
+# of anti-entropy, peer list, presence and chat payloads, most frequent last.
+DICTIONARY = b''.join([
+    b'\x00\x00\x00S\n0 ', b'\x00\x00I\n', b'\x00\x00i\n', b'\x00\x00W\n', b'\x00\x00B\n[[', b'","', b'"],[',
+    b'\x00\x00/127.0.0.1:', b'/192.168.', b'/10.0.', b'\x00\x00F\n*+1:', b'\x00\x00f\n*+1:',
+    b'\x00\x00d\n', b'\x00\x00u\n*+1:', b'\n*+1:', b'\n+1:', b'\n-2:',
+    '(Приватно) '.encode(), b'\x00\x00\x00p:', b'\x00\x00\x00s:',
+])
+
+
+# Compresses the batches of one link. The deflate stream runs across batches, every block ends with
+# a sync flush, so the peer can decode it as soon as it arrives and later blocks refer to earlier ones.
+# Batches shorter than threshold go raw, compressing them costs more than it saves.
+class Deflater:
+    def __init__(self, level=6, threshold=64):
+        self.threshold = threshold
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -WBITS, MEM_LEVEL, zdict=DICTIONARY)
+
+    def pack(self, data: bytes) -> bytes:
+        if len(data) < self.threshold:
+            return BLOCK.pack(RAW, len(data)) + data
+        body = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return BLOCK.pack(DEFLATE, len(body)) + body
+
+
+class Inflater:
+    def __init__(self):
+        self._buffer = bytearray()
+        self._decompressor = zlib.decompressobj(-WBITS, zdict=DICTIONARY)
+
+    def feed(self, data: bytes) -> bytes:
+        self._buffer.extend(data)
+        output = []
+        offset = 0
+        while len(self._buffer) - offset >= BLOCK.size:
+            flag, size = BLOCK.unpack_from(self._buffer, offset)
+            end = offset + BLOCK.size + size
+            if end > len(self._buffer):
+                break
+            body = bytes(self._buffer[offset + BLOCK.size:end])
+            if flag == RAW:
+                output.append(body)
+            elif flag == DEFLATE:
+                try:
+                    output.append(self._decompressor.decompress(body, MAX_BLOCK))
+                except zlib.error as e:
+                    raise ValueError('Corrupted block') from e
+                if self._decompressor.unconsumed_tail:
+                    raise ValueError('Block is too large')
+            else:
+                raise ValueError('Unknown block flag: ' + str(flag))
+            offset = end
+        del self._buffer[:offset]
+        return b''.join(output)
@@ -0,0 +1,258 @@
+import math
+import threading
+import time
+
+from src import packet
+
+MASK = 2 ** 64 - 1
+
+
+# Bits (a multiple of 8) and hash count of a Bloom filter that holds `capacity` items
+# with the given false-positive rate.
+def bloom_size(capacity: int, error: float) -> tuple:
+    bits = math.ceil(-capacity * math.log(error) / math.log(2) ** 2)
+    bits += -bits % 8
+    return bits, max(1, round(bits / capacity * math.log(2)))
+
+
+class BloomFilter:
+    def __init__(self, bits: int, hashes: int):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray(bits // 8)
+        self.filled = 0
+
+    def _positions(self, item):
+        h = hash(item) & MASK
+        h1 = (h * 0x9E3779B97F4A7C15) & MASK
+        h2 = ((h ^ (h >> 29)) * 0xBF58476D1CE4E5B9 & MASK) | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def add(self, item):
+        self.update((item,))
+
+    # Positions are computed inline, a whole expired generation is folded in at once.
+    def update(self, items):
+        array = self._array
+        bits = self.bits
+        hashes = range(self.hashes)
+        filled = 0
+        for item in items:
+            h = hash(item) & MASK
+            position = ((h * 0x9E3779B97F4A7C15) & MASK) % bits
+            step = (((h ^ (h >> 29)) * 0xBF58476D1CE4E5B9 & MASK) | 1) % bits
+            for _ in hashes:
+                byte = position >> 3
+                mask = 1 << (position & 7)
+                if not array[byte] & mask:
+                    array[byte] |= mask
+                    filled += 1
+                position += step
+                if position >= bits:
+                    position -= bits
+        self.filled += filled
+
+    def __contains__(self, item):
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self._array[byte] & (1 << bit):
+                return False
+        return True
+
+    @property
+    def false_positive_rate(self) -> float:
+        return (self.filled / self.bits) ** self.hashes
+
+
+# IDs seen during the last `retention` seconds are kept exactly in a few generations of sets.
+# When a generation expires (or the exact tier reaches `max_size`) its IDs are folded into
+# a Bloom filter, so late duplicates are still caught for another window at a fixed memory cost.
+# The filter being filled is replaced once it is a retention window old or holds the
+# expected_rate * retention IDs it is sized for, so its false-positive rate stays below
+# bloom_error however long the node runs.
+# add and __contains__ take no lock: set operations are atomic, rotation swaps whole tuples.
+class DedupCache:
+    def __init__(self, retention=300, generations=4, max_size=200000, expected_rate=100, bloom_error=1e-4):
+        self.retention = retention
+        self.max_size = max_size
+        self._span = retention / generations
+        self._generation_size = max(1, max_size // generations)
+        # both filters are looked up, each gets half of the error
+        self._bloom_capacity = max(self._generation_size, int(expected_rate * retention))
+        self._bloom_bits, self._hashes = bloom_size(self._bloom_capacity, bloom_error / 2)
+        self._generations = tuple(set() for _ in range(generations))
+        self._blooms = (BloomFilter(self._bloom_bits, self._hashes), BloomFilter(self._bloom_bits, self._hashes))
+        self._bloom_items = 0
+        self._bloom_started = time.monotonic()
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.bloom_hits = 0
+
+    def add(self, item):
+        current = self._generations[0]
+        if len(current) >= self._generation_size or time.monotonic() - self._started >= self._span:
+            self._rotate()
+            current = self._generations[0]
+        current.add(item)
+
+    def __contains__(self, item):
+        self.lookups += 1
+        for generation in self._generations:
+            if item in generation:
+                self.hits += 1
+                return True
+        for bloom in self._blooms:
+            if item in bloom:
+                self.hits += 1
+                self.bloom_hits += 1
+                return True
+        return False
+
+    def __len__(self):
+        return sum(map(len, self._generations))
+
+    def _rotate(self):
+        with self._lock:
+            now = time.monotonic()
+            steps = min(len(self._generations), int((now - self._started) // self._span))
+            if steps == 0:
+                if len(self._generations[0]) < self._generation_size:
+                    return
+                steps = 1
+            for _ in range(steps):
+                self._expire(self._generations[-1])
+                self._generations = (set(),) + self._generations[:-1]
+            self._started = now
+
+    def _expire(self, generation: set):
+        blooms = self._blooms
+        now = time.monotonic()
+        if (self._bloom_items + len(generation) > self._bloom_capacity
+                or now - self._bloom_started >= self.retention):
+            blooms = (BloomFilter(self._bloom_bits, self._hashes), blooms[0])
+            self._bloom_items = 0
+            self._bloom_started = now
+        blooms[0].update(generation)
+        self._bloom_items += len(generation)
+        self._blooms = blooms
+
+    @property
+    def hit_rate(self) -> float:
+        if not self.lookups:
+            return 0.0
+        return self.hits / self.lookups
+
+    @property
+    def false_positive_rate(self) -> float:
+        rate = 1.0
+        for bloom in self._blooms:
+            rate *= 1 - bloom.false_positive_rate
+        return 1 - rate
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self),
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'bloom_hits': self.bloom_hits,
+            'hit_rate': self.hit_rate,
+            'false_positive_rate': self.false_positive_rate,
+        }
+
+
+class SequenceWindow:
+    __slots__ = ('floor', 'high', 'bits', 'last_seen')
+
+    def __init__(self, sequence: int):
+        self.floor = sequence
+        self.high = sequence
+        self.bits = 1
+        self.last_seen = time.monotonic()
+
+
+# Sequenced IDs are kept per origin as the highest sequence number seen and a bitmap of the
+# `window` numbers below it, everything older counts as seen. So an origin costs the same
+# whatever it sent. Numbers below the first one seen of an origin (history that is caught up
+# later) and random IDs go to the generations and Bloom filters of DedupCache.
+# Origins that sent nothing for origin_ttl seconds are forgotten.
+class SequencedDedupCache(DedupCache):
+    def __init__(self, window=1024, origin_ttl=3600, **kwargs):
+        super().__init__(**kwargs)
+        self.window = window
+        self.origin_ttl = origin_ttl
+        self._mask = (1 << window) - 1
+        self._origins = {}
+        self._pruned = time.monotonic()
+        self._window_lock = threading.Lock()
+
+    @property
+    def origins(self) -> int:
+        return len(self._origins)
+
+    def add(self, item):
+        ids = packet.split_id(item)
+        if ids is None:
+            super().add(item)
+            return
+        origin, sequence = ids
+        with self._window_lock:
+            window = self._origins.get(origin)
+            if window is None:
+                self._prune()
+                self._origins[origin] = SequenceWindow(sequence)
+                return
+            if sequence < window.floor:
+                window = None
+            else:
+                offset = window.high - sequence
+                if offset <= -self.window:
+                    window.bits = 1
+                    window.high = sequence
+                elif offset < 0:
+                    window.bits = (window.bits << -offset | 1) & self._mask
+                    window.high = sequence
+                elif offset < self.window:
+                    window.bits |= 1 << offset
+                window.last_seen = time.monotonic()
+        if window is None:
+            super().add(item)
+
+    def __contains__(self, item):
+        ids = packet.split_id(item)
+        if ids is None:
+            return super().__contains__(item)
+        origin, sequence = ids
+        window = self._origins.get(origin)
+        if window is not None and sequence < window.floor:
+            return super().__contains__(item)
+        self.lookups += 1
+        if window is None:
+            return False
+        offset = window.high - sequence
+        if offset < 0 or offset < self.window and not window.bits >> offset & 1:
+            return False
+        self.hits += 1
+        return True
+
+    def __len__(self):
+        return super().__len__() + len(self._origins)
+
+    def _prune(self):
+        now = time.monotonic()
+        if now - self._pruned < 60:
+            return
+        self._pruned = now
+        deadline = now - self.origin_ttl
+        for origin in [o for o, window in self._origins.items() if window.last_seen < deadline]:
+            del self._origins[origin]
+
+    # Links to protocol version 1 peers carry IDs modulo MAX_ID, an ID that comes back
+    # over one of them is taken for a sequenced one when its origin is known.
+    def unfold(self, msg_id: int) -> int:
+        unfolded = msg_id + packet.MAX_ID
+        if unfolded < packet.ID_LIMIT and packet.split_id(unfolded)[0] in self._origins:
+            return unfolded
+        return msg_id
@@ -0,0 +1,90 @@
+import codecs
+
+from src import compression
+from src import packet
+
+HEADER_LENGTH = 1 + 8 + 8
+
+
+class FrameDecoder:
+    def __init__(self, version=1):
+        self._buffer = bytearray()
+        self._offset = 0
+        self._inflater = None
+        self._version = 1
+        self.version = version
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    # From version 3 on the stream consists of compression blocks, what the handshake left
+    # in the buffer already belongs to them.
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @version.setter
+    def version(self, version: int):
+        self._version = version
+        if version >= 3 and self._inflater is None:
+            self._inflater = compression.Inflater()
+            rest = bytes(self._buffer[self._offset:])
+            self._buffer.clear()
+            self._offset = 0
+            self._buffer.extend(self._inflater.feed(rest))
+
+    # The version may change between calls, so the handshake reads its packets with limit=1
+    # and leaves everything after them for the negotiated format.
+    def feed(self, data: bytes, limit=None) -> list:
+        if self._inflater is not None:
+            data = self._inflater.feed(data)
+        self._buffer.extend(data)
+        frame_end = self._frame_end_v1 if self._version == 1 else self._frame_end_v2
+        frames = []
+        with memoryview(self._buffer) as view:
+            while limit is None or len(frames) < limit:
+                end = frame_end(view, self._offset)
+                if end is None:
+                    break
+                frames.append(bytes(view[self._offset:end]))
+                self._offset = end
+        self._compact()
+        return frames
+
+    # Header characters are in range 1..255, so each of them takes one or two bytes of UTF-8,
+    # the size counts characters of the data, not bytes. The windows may run into the next frame,
+    # which is not UTF-8 after a switch to v2, hence surrogateescape.
+    @staticmethod
+    def _frame_end_v1(view, start: int):
+        header, consumed = codecs.utf_8_decode(view[start + 1:start + HEADER_LENGTH * 2 - 1],
+                                             'surrogateescape', False)
+        if len(header) < HEADER_LENGTH - 1:
+            return None
+        data_start = start + 1 + len(header[:HEADER_LENGTH - 1].encode())
+        size = packet.to_int(header[8:16])
+        if data_start + size > len(view):
+            return None
+        data, consumed = codecs.utf_8_decode(view[data_start:data_start + 4 * size], 'surrogateescape', False)
+        if len(data) < size:
+            return None
+        if len(data) == consumed:
+            return data_start + size
+        return data_start + len(data[:size].encode())
+
+    @staticmethod
+    def _frame_end_v2(view, start: int):
+        if len(view) - start < packet.HEADER.size:
+            return None
+        size = packet.HEADER.unpack_from(view, start)[3]
+        end = start + packet.HEADER.size + size
+        if end > len(view):
+            return None
+        return end
+
+    def _compact(self):
+        if self._offset == len(self._buffer):
+            self._buffer.clear()
+            self._offset = 0
+        elif self._offset > len(self._buffer) // 2:
+            del self._buffer[:self._offset]
+            self._offset = 0
@@ -0,0 +1,168 @@
+import collections
+import threading
+import time
+
+from src import packet
+from src.packet import Packet, PacketType
+
+GOSSIP_TYPES = (PacketType.MESSAGE, PacketType.ONLINE)
+CONTROL_TYPES = (PacketType.PRUNE, PacketType.IHAVE, PacketType.GRAFT)
+
+
+# Tree a message is spread along: the origin of a sequenced ID, otherwise the nickname of its
+# sender. Encoded as it goes in PRUNE packets, an empty key is the tree of everything else.
+def origin(message: Packet) -> str:
+    key = id_origin(message.id)
+    if key is not None:
+        return key
+    parts = message.data.split(':', 3)
+    if message.type is PacketType.ONLINE:
+        return 'n' + message.data
+    if parts[0] == 'p' and len(parts) == 4:
+        return 'n' + parts[2]
+    if len(parts) >= 3:
+        return 'n' + parts[1]
+    return ''
+
+
+def id_origin(msg_id) -> str:
+    ids = packet.split_id(msg_id) if msg_id is not None else None
+    return None if ids is None else 'o{}'.format(ids[0])
+
+
+class Flooding:
+    def __init__(self, server):
+        self._server = server
+
+    def route(self, message: Packet, source, connections) -> list:
+        return [connection for connection in connections if connection is not source]
+
+    def on_duplicate(self, message: Packet, source):
+        pass
+
+    def handle(self, message: Packet, source) -> bool:
+        return False
+
+    def forget(self, connection):
+        pass
+
+    def tick(self):
+        pass
+
+
+# Eager/lazy push in the spirit of Plumtree: a link that delivers a duplicate is pruned to lazy,
+# lazy links only get batched IHAVE announcements, and a message announced but not received
+# within graft_timeout is requested with GRAFT, which turns that link eager again.
+# Every origin (see origin()) has its own eager/lazy split, so it gets its own tree. With one
+# split for all origins, duplicates of different senders prune links of each other's shortest
+# paths, the eager links stop spanning the net and most messages take the IHAVE/GRAFT detour:
+# on an 8-node mesh of degree 3 at 100 msg/s that gave p50 570 ms against 9 ms with flooding.
+# Splits of the least recently seen origins are dropped beyond max_origins.
+# Old peers (protocol version 1) don't know the control packets and are always eager.
+class Plumtree(Flooding):
+    def __init__(self, server, graft_timeout=0.5, cache_size=1000, max_origins=1024):
+        super().__init__(server)
+        self.graft_timeout = graft_timeout
+        self.cache_size = cache_size
+        self.max_origins = max_origins
+        self._lazy = collections.OrderedDict()
+        self._cache = collections.OrderedDict()
+        self._announcements = collections.defaultdict(list)
+        self._missing = {}
+        self._lock = threading.Lock()
+
+    def _modern(self, connection) -> bool:
+        return self._server.version(connection) >= 2
+
+    def route(self, message: Packet, source, connections) -> list:
+        if message.type not in GOSSIP_TYPES:
+            return super().route(message, source, connections)
+        eager = []
+        with self._lock:
+            self._cache[message.id] = message
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            lazy = self._tree(origin(message))
+            for connection in connections:
+                if connection is source:
+                    continue
+                if connection in lazy:
+                    self._announcements[connection].append(message.id)
+                else:
+                    eager.append(connection)
+        return eager
+
+    # Lazy links of an origin's tree, the most recently used trees are kept.
+    def _tree(self, key: str) -> set:
+        lazy = self._lazy.get(key)
+        if lazy is None:
+            lazy = self._lazy[key] = set()
+            if len(self._lazy) > self.max_origins:
+                self._lazy.popitem(last=False)
+        else:
+            self._lazy.move_to_end(key)
+        return lazy
+
+    def on_duplicate(self, message: Packet, source):
+        if source is None or message.type not in GOSSIP_TYPES or not self._modern(source):
+            return
+        key = origin(message)
+        with self._lock:
+            lazy = self._tree(key)
+            if source in lazy:
+                return
+            lazy.add(source)
+        self._server.send_to(source, Packet(PacketType.PRUNE, key))
+
+    def handle(self, message: Packet, source) -> bool:
+        if message.type not in CONTROL_TYPES:
+            return False
+        if message.type is PacketType.PRUNE:
+            with self._lock:
+                self._tree(message.data).add(source)
+        elif message.type is PacketType.IHAVE:
+            now = time.monotonic()
+            with self._lock:
+                for msg_id in packet.decode_ids(message.data):
+                    if msg_id not in self._missing and msg_id not in self._server.received:
+                        self._missing[msg_id] = (source, now)
+        elif message.type is PacketType.GRAFT:
+            with self._lock:
+                messages = [self._cache[msg_id] for msg_id in packet.decode_ids(message.data) if msg_id in self._cache]
+                for cached in messages:
+                    self._tree(origin(cached)).discard(source)
+            for cached in messages:
+                self._server.send_to(source, cached)
+        return True
+
+    def forget(self, connection):
+        with self._lock:
+            for lazy in self._lazy.values():
+                lazy.discard(connection)
+            self._announcements.pop(connection, None)
+
+    def tick(self):
+        now = time.monotonic()
+        grafts = collections.defaultdict(list)
+        with self._lock:
+            announcements, self._announcements = self._announcements, collections.defaultdict(list)
+            for msg_id, (connection, since) in list(self._missing.items()):
+                if msg_id in self._server.received:
+                    del self._missing[msg_id]
+                elif now - since >= self.graft_timeout:
+                    del self._missing[msg_id]
+                    grafts[connection].append(msg_id)
+                    # the tree of a random ID is only known once the message is here
+                    key = id_origin(msg_id)
+                    if key is not None:
+                        self._tree(key).discard(connection)
+        for connection, ids in announcements.items():
+            self._server.send_to(connection, Packet(PacketType.IHAVE, packet.encode_ids(ids)))
+        for connection, ids in grafts.items():
+            self._server.send_to(connection, Packet(PacketType.GRAFT, packet.encode_ids(ids)))
+
+
+STRATEGIES = {
+    'flood': Flooding,
+    'plumtree': Plumtree,
+}
@@ -1,9 +1,10 @@
+import bisect
+import collections
 from tkinter import *
 
 from tkinter.scrolledtext import ScrolledText
 
 from src.client import Client
-from src import utils
 from src.message import Message, MessageType
 
 
@@ -78,36 +79,112 @@ class UserWindow(Tk):
         self.mainloop()
 
 
-class UserList(utils.VerticalScrolledFrame):
-    def __init__(self, root, client: Client, width=30):
+# Only the rows that fit into the frame exist as buttons, scrolling just changes their texts.
+# Joins and leaves come from the client's threads and are applied to the sorted roster on the Tk loop.
+class UserList(Frame):
+    def __init__(self, root, client: Client, width=30, row_height=26, refresh_interval=200):
         super().__init__(root, width=width)
         self._client = client
-        self._refresher = utils.Daemon('gui_user_list_refresher', target=self.refresh, timeout=2)
+        self.row_height = row_height
+        self.refresh_interval = refresh_interval
+        self.users = []
         self.buttons = []
+        self._offset = 0
+        self._pending = collections.deque()
+        self._after = None
+        self._scrollbar = Scrollbar(self, orient=VERTICAL, command=self._scroll)
+        self._scrollbar.pack(fill=Y, side=RIGHT)
+        self._rows = Frame(self)
+        self._rows.pack(fill=BOTH, side=LEFT, expand=1)
+        self._rows.bind('<Configure>', self._resize)
+        self._bind_wheel(self._rows)
 
     def run(self):
-        self._refresher.run()
+        self._client.subscribe_users(self._changed)
+        for user in self._client.users_list:
+            self._pending.append((user, True))
+        self._after = self.after(0, self.refresh)
 
-    def refresh(self):
-        for i in self.buttons:
-            i.destroy()
-        self.buttons.clear()
-        users = sorted(list(self._client.users_list.keys()))
+    def _changed(self, nickname: str, online: bool):
+        self._pending.append((nickname, online))
 
-        def make_cmd(x):
-            return lambda: self._open_profile(x)
+    def refresh(self):
+        changed = False
+        while self._pending:
+            nickname, online = self._pending.popleft()
+            i = bisect.bisect_left(self.users, nickname)
+            present = i < len(self.users) and self.users[i] == nickname
+            if online and not present:
+                self.users.insert(i, nickname)
+                changed = True
+            elif not online and present:
+                del self.users[i]
+                changed = True
+        if changed:
+            self._render()
+        self._after = self.after(self.refresh_interval, self.refresh)
+
+    def _bind_wheel(self, widget):
+        widget.bind('<MouseWheel>', self._wheel)
+        widget.bind('<Button-4>', self._wheel)
+        widget.bind('<Button-5>', self._wheel)
+
+    def _visible(self) -> int:
+        return max(1, self._rows.winfo_height() // self.row_height)
+
+    def _resize(self, event):
+        rows = event.height // self.row_height + 1
+        while len(self.buttons) < rows:
+            button = Button(self._rows, command=lambda row=len(self.buttons): self._open_row(row))
+            self._bind_wheel(button)
+            self.buttons.append(button)
+        while len(self.buttons) > rows:
+            self.buttons.pop().destroy()
+        self._render()
+
+    def _render(self):
+        visible = self._visible()
+        self._offset = max(0, min(self._offset, len(self.users) - visible))
+        for row, button in enumerate(self.buttons):
+            index = self._offset + row
+            if index < len(self.users):
+                if button.cget('text') != self.users[index]:
+                    button.config(text=self.users[index])
+                button.place(x=0, y=row * self.row_height, relwidth=1, height=self.row_height)
+            else:
+                button.place_forget()
+        if self.users:
+            self._scrollbar.set(self._offset / len(self.users), min(1, (self._offset + visible) / len(self.users)))
+        else:
+            self._scrollbar.set(0, 1)
+
+    def _scroll(self, *args):
+        if args[0] == 'moveto':
+            self._offset = int(float(args[1]) * len(self.users))
+        elif args[0] == 'scroll':
+            self._offset += int(args[1]) * (self._visible() if args[2] == 'pages' else 1)
+        self._render()
+
+    def _wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self._offset -= 3
+        else:
+            self._offset += 3
+        self._render()
 
-        for user in users:
-            cur = Button(self.interior, text=user, width=len(user) + 2, command=make_cmd(user))
-            cur.pack(fill=X)
-            self.buttons.append(cur)
+    def _open_row(self, row: int):
+        index = self._offset + row
+        if index < len(self.users):
+            self._open_profile(self.users[index])
 
     def _open_profile(self, nickname: str):
         user_window = UserWindow(nickname, self._client)
         user_window.show()
 
     def close(self):
-        self._refresher.stop()
+        if self._after is not None:
+            self.after_cancel(self._after)
+            self._after = None
 
 
 class NicknameBar(Tk):
@@ -139,22 +216,26 @@ class NicknameBar(Tk):
 
 
 class Interface:
-    def __init__(self, chat_addr=None, server_port=None):
+    def __init__(self, chat_addr=None, server_port=None, engine='threads', dissemination='flood',
+                 scrollback=5000, refresh_interval=100):
         if chat_addr is None and server_port is None:
             server_port, chat_addr = self.get_port_and_ip()
+        self.scrollback = scrollback
+        self.refresh_interval = refresh_interval
+        self._pending = collections.deque(maxlen=scrollback)
         self.buttons = []
         self.root = None
         self.main_frame = None
         self.messages_box = None
         self.message_input_box = None
         self.client = None
-        self.refresher = utils.Daemon(name='refreshing', target=self.refresh, timeout=0.1)
         self.users_list = None
         if server_port is None:
             self.close()
             return
         nickname = self.get_nickname()
-        self.client = Client(nickname, chat_addr, server_port)
+        self.client = Client(nickname, chat_addr, server_port, engine, dissemination,
+                             '../history_{}'.format(server_port))
 
     @staticmethod
     def get_port_and_ip():
@@ -228,6 +309,7 @@ class Interface:
         self.root.protocol('WM_DELETE_WINDOW', self.close)
 
         self.messages_box = MessagesList(self.main_frame, height=7, width=30, font=('Times New Roman', 11))
+        self.messages_box.tag_config('nickname', foreground='blue')
         self.messages_box.config(state=DISABLED)
         self.messages_box.pack(fill=BOTH, expand=1)
 
@@ -270,34 +352,44 @@ class Interface:
     def run(self):
         self.init_UI()
         self.client.run()
-        self.refresher.run()
+        for message in self.client.history():
+            self.get_message(message)
+        self.client.subscribe(self.get_message)
         self.users_list.run()
+        self.root.after(self.refresh_interval, self.refresh)
         self.root.mainloop()
 
-    def refresh(self):
-        message = self.client.get()
-        if message is not None:
-            self.get_message(message)
-
+    # Called from the client's delivering thread, the widget is only touched by refresh on the Tk loop.
+    # Messages that would be trimmed from the scrollback anyway are dropped from the queue right away.
     def get_message(self, message: Message):
-        nickname_start, nickname_end = message.get_nick_position()
-        message = str(message) + '\n'
+        self._pending.append(message)
+
+    def refresh(self):
+        messages = []
+        while self._pending:
+            messages.append(self._pending.popleft())
+        if messages:
+            self.show_messages(messages)
+        self.root.after(self.refresh_interval, self.refresh)
+
+    def show_messages(self, messages: list):
+        chunks = []
+        for message in messages:
+            nickname_start, nickname_end = message.get_nick_position()
+            text = str(message)
+            chunks += [text[:nickname_start], (), text[nickname_start:nickname_end], ('nickname',),
+                       text[nickname_end:] + '\n', ()]
+        need_to_scroll = self.messages_box.yview()[1] > 0.9
         self.messages_box.config(state=NORMAL)
-        need_to_scroll = False
-        if self.messages_box.yview()[1] > 0.9:
-            need_to_scroll = True
-        cur_line, cur_column = map(int, self.messages_box.index(END).split('.'))
-        cur_line -= 1
-        self.messages_box.insert(END, message)
-        self.messages_box.tag_add('nickname', '{}.{}'.format(cur_line, nickname_start),
-                                  '{}.{}'.format(cur_line, nickname_end))
-        self.messages_box.tag_config('nickname', foreground='blue')
+        self.messages_box.insert(END, *chunks)
+        lines = int(self.messages_box.index('end-1c').split('.')[0]) - 1
+        if lines > self.scrollback:
+            self.messages_box.delete('1.0', '{}.0'.format(lines - self.scrollback + 1))
         self.messages_box.config(state=DISABLED)
         if need_to_scroll:
             self.messages_box.see(END)
 
     def close(self):
-        self.refresher.stop()
         if self.users_list is not None:
             self.users_list.close()
         if self.root is not None:
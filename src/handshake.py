@@ -0,0 +1,219 @@
+import collections
+import concurrent.futures
+import errno
+import os
+import selectors
+import socket
+import time
+
+from src import framing
+from src import packet
+from src import utils
+from src.packet import Packet, PacketType
+
+HELLO = 'hello'
+CONFIRM = 'confirm'
+DONE = 'done'
+
+
+# A connection from connect/accept until it is handed over to the server.
+class Handshake:
+    def __init__(self, connection, address, initiator: bool, deadline: float):
+        self.connection = connection
+        self.address = address
+        self.initiator = initiator
+        self.deadline = deadline
+        self.decoder = framing.FrameDecoder()
+        self.state = CONFIRM if initiator else HELLO
+        self.connected = not initiator
+        self.version = 1
+        self.port = None
+        self.future = concurrent.futures.Future()
+        self.output = bytearray()
+
+
+# Runs the handshakes of a server in one thread on non-blocking sockets, so joins don't wait
+# for each other and a silent peer only costs its own timeout. The initiator sends CONNECTION with
+# the highest version it speaks, the acceptor answers CONFIRMATION with the negotiated version and
+# the initiator confirms with its listening port. Then `established` gets the handshake with
+# the socket blocking again. Other threads only queue calls, the selector is used by poll alone.
+class Handshaker(utils.Daemon):
+    def __init__(self, listener, port, established, highest=packet.PROTOCOL_VERSION, timeout=5):
+        super().__init__(name='accepting', target=self.poll, timeout=0)
+        self.port = port
+        self.highest = highest
+        self.handshake_timeout = timeout
+        self._listener = listener
+        self._established = established
+        self._handshakes = {}
+        self._calls = collections.deque()
+        self._selector = None
+        self._wakeup = self._waker = None
+
+    def __len__(self):
+        return len(self._handshakes)
+
+    def run(self):
+        if self._selector is None:
+            self._selector = selectors.DefaultSelector()
+            self._wakeup, self._waker = socket.socketpair()
+            self._wakeup.setblocking(False)
+            self._selector.register(self._wakeup, selectors.EVENT_READ)
+        super().run()
+
+    def _call(self, function):
+        self._calls.append(function)
+        if self._waker is not None:
+            try:
+                self._waker.send(b'\0')
+            except OSError:
+                pass
+
+    def listen(self):
+        def register():
+            self._listener.setblocking(False)
+            self._selector.register(self._listener, selectors.EVENT_READ)
+        self._call(register)
+
+    def connect(self, address) -> Handshake:
+        connection = socket.socket()
+        connection.setblocking(False)
+        handshake = Handshake(connection, address, True, time.monotonic() + self.handshake_timeout)
+        handshake.output += bytes(Packet(PacketType.CONNECTION, str(self.highest)))
+
+        def start():
+            try:
+                code = connection.connect_ex(address)
+            except OSError as e:
+                self._fail(handshake, e)
+                return
+            if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self._fail(handshake, OSError(code, os.strerror(code)))
+                return
+            self._handshakes[connection] = handshake
+            self._selector.register(connection, selectors.EVENT_WRITE, handshake)
+        self._call(start)
+        return handshake
+
+    def poll(self, timeout=1.0):
+        while self._calls:
+            self._calls.popleft()()
+        if self._handshakes:
+            deadline = min(handshake.deadline for handshake in self._handshakes.values())
+            timeout = max(0.0, min(timeout, deadline - time.monotonic()))
+        for key, events in self._selector.select(timeout):
+            if key.fileobj is self._wakeup:
+                self._drain()
+            elif key.fileobj is self._listener:
+                self._accept()
+            elif key.data.state is not DONE:
+                self._step(key.data, events)
+        now = time.monotonic()
+        for handshake in [h for h in self._handshakes.values() if h.deadline < now]:
+            self._fail(handshake, TimeoutError('Handshake with {}:{} timed out'.format(*handshake.address[:2])))
+
+    def _drain(self):
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                connection, address = self._listener.accept()
+            except OSError:
+                return
+            connection.setblocking(False)
+            handshake = Handshake(connection, address, False, time.monotonic() + self.handshake_timeout)
+            self._handshakes[connection] = handshake
+            self._selector.register(connection, selectors.EVENT_READ, handshake)
+
+    def _step(self, handshake: Handshake, events: int):
+        try:
+            if events & selectors.EVENT_WRITE and not handshake.connected:
+                code = handshake.connection.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code:
+                    raise OSError(code, os.strerror(code))
+                handshake.connected = True
+            if events & selectors.EVENT_READ:
+                data = handshake.connection.recv(4096)
+                if not data:
+                    raise ConnectionResetError('Connection closed during handshake')
+                frames = handshake.decoder.feed(data, 1)
+                while frames and handshake.state is not DONE:
+                    self._receive(handshake, packet.decode(frames[0], handshake.decoder.version))
+                    frames = handshake.decoder.feed(b'', 1) if handshake.state is not DONE else []
+            self._flush(handshake)
+        except (OSError, ValueError, KeyError) as e:
+            self._fail(handshake, e)
+            return
+        if handshake.state is DONE and not handshake.output:
+            self._finish(handshake)
+
+    def _receive(self, handshake: Handshake, info: Packet):
+        if handshake.state is HELLO and info.type is PacketType.CONNECTION:
+            handshake.version = packet.negotiate_version(info.data, self.highest)
+            confirmation = str(handshake.version) if handshake.version > 1 else ''
+            handshake.output += bytes(Packet(PacketType.CONFIRMATION, confirmation))
+            handshake.state = CONFIRM
+        elif handshake.state is CONFIRM and info.type is PacketType.CONFIRMATION:
+            if handshake.initiator:
+                handshake.version = packet.negotiate_version(info.data, self.highest)
+                handshake.output += bytes(Packet(PacketType.CONFIRMATION, str(self.port)))
+            else:
+                handshake.port = info.data
+            handshake.state = DONE
+        else:
+            raise ValueError('Unexpected packet during handshake: ' + repr(info))
+
+    def _flush(self, handshake: Handshake):
+        if handshake.connected and handshake.output:
+            sent = handshake.connection.send(handshake.output)
+            del handshake.output[:sent]
+        if handshake.state is DONE and not handshake.output:
+            return
+        events = selectors.EVENT_READ
+        if handshake.output or not handshake.connected:
+            events |= selectors.EVENT_WRITE
+        self._selector.modify(handshake.connection, events, handshake)
+
+    def _forget(self, handshake: Handshake):
+        self._handshakes.pop(handshake.connection, None)
+        try:
+            self._selector.unregister(handshake.connection)
+        except (KeyError, ValueError):
+            pass
+
+    def _finish(self, handshake: Handshake):
+        self._forget(handshake)
+        handshake.connection.setblocking(True)
+        handshake.decoder.version = handshake.version
+        try:
+            self._established(handshake)
+        except (OSError, ValueError) as e:
+            handshake.connection.close()
+            handshake.future.set_exception(e)
+            return
+        handshake.future.set_result(handshake.connection)
+
+    def _fail(self, handshake: Handshake, error: Exception):
+        self._forget(handshake)
+        handshake.connection.close()
+        handshake.future.set_exception(error)
+
+    # The thread closes the sockets itself once it leaves the loop.
+    def _updating(self):
+        super()._updating()
+        while self._calls:
+            self._calls.popleft()
+        for handshake in list(self._handshakes.values()):
+            self._fail(handshake, ConnectionAbortedError('Server is closed'))
+        self._selector.close()
+        self._wakeup.close()
+        self._waker.close()
+
+    def stop(self):
+        super().stop()
+        self._call(lambda: None)
@@ -0,0 +1,78 @@
+import argparse
+import sys
+import threading
+
+from src import client
+from src import gossip
+from src import peers
+from src.message import Message, MessageType
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Chat node without GUI')
+    parser.add_argument('--port', help='Port on your computer', type=int, default=9090)
+    parser.add_argument('--peer', help='Another node, host:port', type=peers.split_address)
+    parser.add_argument('--nickname', help='Join as a bot that prints messages and sends lines from stdin, '
+                                           'without it the node only relays')
+    parser.add_argument('--engine', choices=sorted(client.ENGINES), default='threads')
+    parser.add_argument('--dissemination', choices=sorted(gossip.STRATEGIES), default='flood')
+    parser.add_argument('--history', help='Directory of the message store')
+    parser.add_argument('--history-days', help='Days the message store keeps messages', type=float, default=30)
+    parser.add_argument('--no-compression', help="Don't offer compressed links to peers", dest='compression',
+                        action='store_false')
+    parser.add_argument('--sequencing', help='Send shared messages with (origin, sequence) IDs', action='store_true')
+    parser.add_argument('--metrics-port', help='Serve Prometheus metrics on localhost:PORT/metrics', type=int)
+    parser.add_argument('--metrics-log', help='Append a JSON snapshot of the metrics to this file periodically')
+    parser.add_argument('--metrics-interval', help='Seconds between metrics snapshots', type=float, default=60)
+    return parser
+
+
+def export_metrics(registry, args):
+    if args.metrics_port is not None:
+        registry.serve(args.metrics_port)
+    if args.metrics_log is not None:
+        registry.log(args.metrics_log, args.metrics_interval)
+
+
+def relay(args):
+    node = client.get_engine(args.engine)(args.peer, args.port, args.dissemination, args.compression,
+                                          args.sequencing)
+    node.run()
+    export_metrics(node.metrics, args)
+    try:
+        while True:
+            node.got_messages.get()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        node.close()
+
+
+def bot(args):
+    chat_client = client.Client(args.nickname, args.peer, args.port, args.engine, args.dissemination, args.history,
+                                args.compression, args.sequencing, args.history_days * 24 * 3600)
+    chat_client.run()
+    export_metrics(chat_client.metrics, args)
+    chat_client.subscribe(lambda message: print(message, flush=True))
+    try:
+        for line in sys.stdin:
+            line = line.rstrip('\n')
+            if line:
+                chat_client.send_message(Message(MessageType.SHARED, line))
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        chat_client.close()
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    if args.nickname is None:
+        relay(args)
+    else:
+        bot(args)
+
+
+if __name__ == '__main__':
+    main()
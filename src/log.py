@@ -1,20 +1,142 @@
+import collections
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+from src import utils
 from src import packet
 
 
+# Packets are written by a background daemon in batches, so a slow disk never blocks delivery:
+# when the queue is full new lines are dropped and counted. The file is rotated to
+# file_name.1 .. file_name.<backups> when it grows over max_bytes or gets older than max_age seconds.
+# A failed write or rotation is reported once, its lines are dropped and the file is reopened
+# for the next batch.
 class Log:
-    def __init__(self, file_name: str):
+    def __init__(self, file_name: str, history=1000, structured=False, max_bytes=10 << 20, max_age=None,
+                 backups=3, fsync_interval=5, queue_size=10000):
         self.file_name = file_name
+        self.structured = structured
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.fsync_interval = fsync_interval
+        self.messages = collections.deque(maxlen=history)
+        self.dropped = 0
+        self._lines = queue.Queue(queue_size)
+        self._file = None
+        self._size = 0
+        self._opened = 0
+        self._last_fsync = 0
+        self._failed = False
+        self._lock = threading.Lock()
         try:
-            with open(file_name, 'w') as f:
-                f.write('log started\n')
-        except FileNotFoundError:
+            self._open('w')
+        except OSError:
             print("Can't open file for logging.")
-        self.messages = []
+        self._writing = utils.Daemon(name='logging', target=self._write, timeout=0)
+
+    def _open(self, mode: str):
+        self._file = open(self.file_name, mode, encoding='utf-8')
+        if mode == 'w':
+            self._file.write('log started\n')
+        self._size = self._file.tell()
+        self._opened = time.monotonic()
+
+    def run(self):
+        self._writing.run()
 
     def get(self, message: packet.Packet):
         self.messages.append(message)
         self.save(message)
 
     def save(self, message: packet.Packet):
-        with open(self.file_name, 'a') as f:
-            print(repr(message), file=f)
+        if self._file is None and not self._failed:
+            return
+        try:
+            self._lines.put_nowait(self.format(message))
+        except queue.Full:
+            self.dropped += 1
+
+    def format(self, message: packet.Packet) -> str:
+        if self.structured:
+            return json.dumps({'time': round(time.time(), 3), 'type': message.type.value, 'id': message.id,
+                               'data': message.data}, ensure_ascii=False, separators=(',', ':')) + '\n'
+        return repr(message) + '\n'
+
+    def _write(self):
+        try:
+            lines = [self._lines.get(timeout=0.5)]
+        except queue.Empty:
+            lines = []
+        while True:
+            try:
+                lines.append(self._lines.get_nowait())
+            except queue.Empty:
+                break
+        self._flush(lines)
+
+    def _flush(self, lines: list, sync=False):
+        with self._lock:
+            try:
+                if self._file is None:
+                    if not self._failed:
+                        return
+                    self._open('a')
+                self._flush_locked(lines, sync)
+            except OSError as error:
+                self.dropped += len(lines)
+                self._fail(error)
+            else:
+                self._failed = False
+
+    def _fail(self, error: OSError):
+        if not self._failed:
+            self._failed = True
+            print("Can't write the log, lines are dropped until it works again:", error, file=sys.stderr)
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+    def _flush_locked(self, lines: list, sync: bool):
+        if lines:
+            data = ''.join(lines)
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data.encode())
+        now = time.monotonic()
+        if sync or now - self._last_fsync >= self.fsync_interval:
+            self._last_fsync = now
+            os.fsync(self._file.fileno())
+        if self._size >= self.max_bytes or self.max_age is not None and now - self._opened >= self.max_age:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            name = '{}.{}'.format(self.file_name, i)
+            if os.path.exists(name):
+                os.replace(name, '{}.{}'.format(self.file_name, i + 1))
+        if self.backups > 0:
+            os.replace(self.file_name, self.file_name + '.1')
+        self._open('w')
+
+    def close(self):
+        self._writing.stop()
+        lines = []
+        while True:
+            try:
+                lines.append(self._lines.get_nowait())
+            except queue.Empty:
+                break
+        self._flush(lines, True)
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
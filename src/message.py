@@ -7,6 +7,8 @@ class MessageType(enum.Enum):
 
 
 class Message:
+    __slots__ = ('type', 'source', 'nickname', 'addressee')
+
     def __init__(self, type: MessageType, source: str):
         self.type = type
         self.source = source
@@ -33,21 +35,22 @@ class Message:
 
     @staticmethod
     def parse(source: str):
-        types = dict(map(lambda x: (x.value, x), MessageType))
-        parsed = source.split(':')
-        try:
-            t = types[parsed[0]]
-        except KeyError:
-            raise ValueError('Unknown type of message: ' + parsed[0], source)
-        ind = 1
-        addressee = None
-        if t is MessageType.PRIVATE:
-            addressee = parsed[ind]
-            ind += 1
-        nickname = parsed[ind]
-        ind += 1
-        text = ':'.join(parsed[ind:])
-        message = Message(t, text)
-        message.nickname = nickname
-        message.addressee = addressee
-        return message
+        return parse_message(source)
+
+
+MESSAGE_TYPES = {t.value: t for t in MessageType}
+
+
+def parse_message(text: str) -> Message:
+    kind, _, rest = text.partition(':')
+    t = MESSAGE_TYPES.get(kind)
+    if t is None:
+        raise ValueError('Unknown type of message: ' + kind, text)
+    addressee = None
+    if t is MessageType.PRIVATE:
+        addressee, _, rest = rest.partition(':')
+    nickname, _, source = rest.partition(':')
+    message = Message(t, source)
+    message.nickname = nickname
+    message.addressee = addressee
+    return message
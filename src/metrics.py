@@ -0,0 +1,220 @@
+import collections
+import http.server
+import json
+import threading
+import time
+
+from src import utils
+from src.packet import PacketType
+
+METRICS = {
+    'chat_packets_in_total': ('counter', 'Packets received, by type'),
+    'chat_bytes_in_total': ('counter', 'Frame bytes received, by type'),
+    'chat_packets_out_total': ('counter', 'Packets written to connections, by type'),
+    'chat_bytes_out_total': ('counter', 'Frame bytes written to connections, by type'),
+    'chat_connection_packets_in_total': ('counter', 'Packets received, by connection'),
+    'chat_connection_bytes_in_total': ('counter', 'Frame bytes received, by connection'),
+    'chat_connection_packets_out_total': ('counter', 'Packets written, by connection'),
+    'chat_connection_bytes_out_total': ('counter', 'Frame bytes written, by connection'),
+    'chat_dedup_lookups_total': ('counter', 'Lookups in the dedup caches'),
+    'chat_dedup_hits_total': ('counter', 'Lookups that found the ID'),
+    'chat_dedup_hit_rate': ('gauge', 'Share of the lookups that found the ID'),
+    'chat_dedup_false_positive_rate': ('gauge', 'Estimated false-positive rate of the Bloom filters'),
+    'chat_queue_depth': ('gauge', 'Packets waiting in the queue, by queue and priority class'),
+    'chat_queue_dropped_total': ('counter', 'Packets a full queue dropped, by queue and priority class'),
+    'chat_connections': ('gauge', 'Open connections'),
+    'chat_amplification': ('gauge', 'Chat dissemination bytes sent to neighbors per byte of new chat messages received'),
+    'chat_reconnect_attempts_total': ('counter', 'Connection attempts of the peer manager'),
+    'chat_reconnect_failures_total': ('counter', 'Failed connection attempts of the peer manager'),
+    'chat_peer_rtt_seconds': ('gauge', 'Smoothed round trip time of PING packets, by connected peer'),
+    'chat_routes': ('gauge', 'Nicknames with a route to a neighbor'),
+    'chat_private_messages_total': ('counter', 'Private messages sent on, by path (routed, flooded, local)'),
+    'chat_sequence_origins': ('gauge', 'Origins of sequenced messages in the dedup cache'),
+    'chat_ordering_waiting': ('gauge', 'Sequenced messages waiting for their predecessors'),
+    'chat_retransmit_requests_total': ('counter', 'Requests for the messages of a sequence gap'),
+    'chat_sequence_gaps_skipped_total': ('counter', 'Sequence gaps given up'),
+    'chat_daemon_loop_seconds': ('summary', 'Duration of one daemon loop iteration'),
+    'chat_daemon_loop_seconds_max': ('gauge', 'Longest daemon loop iteration'),
+}
+
+
+# Sample keys of the packet path, built once so that counting a packet is a few dict updates.
+PACKETS_IN = {t: ('chat_packets_in_total', (('type', t.name.lower()),)) for t in PacketType}
+BYTES_IN = {t: ('chat_bytes_in_total', (('type', t.name.lower()),)) for t in PacketType}
+PACKETS_OUT = {t.value.encode(): ('chat_packets_out_total', (('type', t.name.lower()),)) for t in PacketType}
+BYTES_OUT = {t.value.encode(): ('chat_bytes_out_total', (('type', t.name.lower()),)) for t in PacketType}
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + '}'
+
+
+def peer_name(connection) -> str:
+    try:
+        if hasattr(connection, 'get_extra_info'):
+            address = connection.get_extra_info('peername')
+        else:
+            address = connection.getpeername()
+        return '{}:{}'.format(*address[:2])
+    except (OSError, TypeError):
+        return 'unknown'
+
+
+# Counters are updated on the packet path, so every thread increments its own shard
+# without locking and the shards are summed up when the metrics are collected.
+# Shards of threads that ended are folded into one retired shard.
+# Everything that already has its own counter (dedup caches, queues) is only read then.
+class Registry:
+    def __init__(self):
+        self._shards = []
+        self._retired = collections.defaultdict(int)
+        self._local = threading.local()
+        self._collectors = []
+        self._peers = {}
+        self._lock = threading.Lock()
+        self._http = None
+        self._logging = None
+
+    def _shard(self) -> dict:
+        values = self._local.values = collections.defaultdict(int)
+        with self._lock:
+            self._retire()
+            self._shards.append((threading.current_thread(), values))
+        return values
+
+    def _retire(self):
+        alive = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                alive.append((thread, values))
+                continue
+            for key, value in values.items():
+                if key[0].endswith('_max'):
+                    self._retired[key] = max(self._retired[key], value)
+                else:
+                    self._retired[key] += value
+        self._shards = alive
+
+    def values(self) -> dict:
+        try:
+            return self._local.values
+        except AttributeError:
+            return self._shard()
+
+    def inc(self, name: str, labels=(), value=1):
+        self.values()[(name, labels)] += value
+
+    def observe(self, name: str, labels: tuple, seconds: float):
+        values = self.values()
+        values[(name + '_count', labels)] += 1
+        values[(name + '_sum', labels)] += seconds
+        key = (name + '_max', labels)
+        if seconds > values[key]:
+            values[key] = seconds
+
+    def collect(self, collector):
+        self._collectors.append(collector)
+
+    # Keys of the (packets in, bytes in, packets out, bytes out) counters of a connection.
+    def peer(self, connection) -> tuple:
+        keys = self._peers.get(connection)
+        if keys is None:
+            labels = (('peer', peer_name(connection)),)
+            keys = self._peers[connection] = tuple(
+                ('chat_connection_{}_total'.format(name), labels)
+                for name in ('packets_in', 'bytes_in', 'packets_out', 'bytes_out'))
+        return keys
+
+    # Drops the series of a closed connection, their peer labels are never seen again.
+    def forget(self, connection):
+        keys = self._peers.pop(connection, None)
+        if keys is None:
+            return
+        with self._lock:
+            for values in [self._retired] + [values for _, values in self._shards]:
+                for key in keys:
+                    values.pop(key, None)
+
+    def watch(self, daemon: utils.Daemon):
+        labels = (('daemon', daemon.name),)
+        daemon.observer = lambda seconds: self.observe('chat_daemon_loop_seconds', labels, seconds)
+
+    @staticmethod
+    def _items(shard: dict) -> list:
+        while True:
+            try:
+                return list(shard.items())
+            except RuntimeError:
+                pass
+
+    def samples(self) -> list:
+        totals = {}
+        with self._lock:
+            self._retire()
+            shards = [self._retired] + [values for _, values in self._shards]
+        for shard in shards:
+            for key, value in self._items(shard):
+                if key[0].endswith('_max'):
+                    totals[key] = max(totals.get(key, 0), value)
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        samples = [(name, labels, value) for (name, labels), value in totals.items()]
+        for collector in self._collectors:
+            samples.extend(collector())
+        return samples
+
+    def snapshot(self) -> dict:
+        return {name + format_labels(labels): value for name, labels, value in self.samples()}
+
+    def prometheus(self) -> str:
+        families = collections.defaultdict(list)
+        for name, labels, value in self.samples():
+            base = name
+            for suffix in ('_count', '_sum'):
+                if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                    base = name[:-len(suffix)]
+            families[base].append('{}{} {}'.format(name, format_labels(labels), value))
+        lines = []
+        for base in sorted(families):
+            kind, description = METRICS.get(base, ('untyped', ''))
+            lines.append('# HELP {} {}'.format(base, description))
+            lines.append('# TYPE {} {}'.format(base, kind))
+            lines.extend(sorted(families[base]))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, host='127.0.0.1'):
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._http = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(name='metrics http', target=self._http.serve_forever, daemon=True).start()
+
+    def log(self, file_name: str, interval=60):
+        def write():
+            with open(file_name, 'a') as f:
+                print(json.dumps({'time': round(time.time(), 3), 'metrics': self.snapshot()}), file=f)
+        self._logging = utils.Daemon(name='metrics log', target=write, timeout=interval)
+        self._logging.run()
+
+    def close(self):
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+        if self._logging is not None:
+            self._logging.stop()
@@ -0,0 +1,124 @@
+import itertools
+import random
+import threading
+import time
+
+from src import catchup
+from src import packet
+from src.packet import Packet, PacketType
+
+
+class Gap:
+    def __init__(self, source):
+        self.since = time.monotonic()
+        self.requests = 0
+        self.source = source
+
+
+# Hands the messages of every sequenced origin to the client in order. A message that arrives
+# ahead of its predecessors waits; gap_timeout after the first gap opened all the missing ones
+# are asked for with a catch-up WANT, first from the link that brought the early message, then
+# from other neighbors. The answer comes back as a catch-up BATCH and goes through add again.
+# After `retries` requests that filled nothing, or when max_waiting messages of an origin wait,
+# the first gap is given up. A message max_waiting or more numbers ahead gives up all the gaps
+# before it, nothing waits that long. So every missing number is within the window of the
+# received SequencedDedupCache (which must be at least max_waiting) and its repair isn't taken
+# for a duplicate. Messages with random IDs, and late ones, are delivered right away.
+class Ordering:
+    def __init__(self, server, gap_timeout=0.5, retries=3, max_waiting=1024, max_request=256):
+        self._server = server
+        self.gap_timeout = gap_timeout
+        self.retries = retries
+        self.max_waiting = max_waiting
+        self.max_request = max_request
+        self._next = {}
+        self._waiting = {}
+        self._gaps = {}
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        return sum(map(len, list(self._waiting.values())))
+
+    def add(self, message: Packet, source=None):
+        ids = packet.split_id(message.id)
+        if ids is None:
+            self._server.got_messages.put(message)
+            return
+        origin, sequence = ids
+        with self._lock:
+            expected = self._next.get(origin)
+            if expected is None or sequence == expected:
+                self._server.got_messages.put(message)
+                self._next[origin] = sequence + 1
+                self._release(origin)
+            elif sequence < expected:
+                self._server.got_messages.put(message)
+            elif sequence - expected >= self.max_waiting:
+                self._jump(origin, sequence, message)
+            else:
+                waiting = self._waiting.setdefault(origin, {})
+                waiting[sequence] = message
+                if origin not in self._gaps:
+                    self._gaps[origin] = Gap(source)
+                if len(waiting) > self.max_waiting:
+                    self._skip(origin)
+
+    # Delivers what waited for the messages up to the expected one.
+    def _release(self, origin: int):
+        waiting = self._waiting.get(origin)
+        if waiting is None:
+            return
+        expected = self._next[origin]
+        while expected in waiting:
+            self._server.got_messages.put(waiting.pop(expected))
+            expected += 1
+        self._next[origin] = expected
+        if waiting:
+            self._gaps[origin].requests = 0
+        else:
+            del self._waiting[origin]
+            del self._gaps[origin]
+
+    def _skip(self, origin: int):
+        self._server.metrics.inc('chat_sequence_gaps_skipped_total')
+        self._next[origin] = min(self._waiting[origin])
+        self._release(origin)
+
+    def _jump(self, origin: int, sequence: int, message: Packet):
+        self._server.metrics.inc('chat_sequence_gaps_skipped_total')
+        waiting = self._waiting.pop(origin, {})
+        self._gaps.pop(origin, None)
+        for waiting_sequence in sorted(waiting):
+            self._server.got_messages.put(waiting[waiting_sequence])
+        self._server.got_messages.put(message)
+        self._next[origin] = sequence + 1
+
+    def tick(self):
+        now = time.monotonic()
+        requests = []
+        with self._lock:
+            for origin, gap in list(self._gaps.items()):
+                if now - gap.since < self.gap_timeout:
+                    continue
+                if gap.requests >= self.retries:
+                    self._skip(origin)
+                    continue
+                waiting = self._waiting[origin]
+                missing = itertools.islice((sequence for sequence in range(self._next[origin], max(waiting))
+                                            if sequence not in waiting), self.max_request)
+                requests.append((gap.source if not gap.requests else None,
+                                 [packet.sequenced_id(origin, sequence) for sequence in missing]))
+                gap.since = now
+                gap.requests += 1
+        if not requests:
+            return
+        peers = [connection for connection in self._server.peers() if self._server.version(connection) >= 2]
+        for source, ids in requests:
+            if source not in peers:
+                if not peers:
+                    continue
+                source = random.choice(peers)
+            self._server.metrics.inc('chat_retransmit_requests_total')
+            want = Packet(PacketType.SYNC, '{}\n{}'.format(catchup.WANT, packet.encode_ids(ids)))
+            self._server.send_to(source, want)
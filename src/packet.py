@@ -1,5 +1,16 @@
 import enum
 import random
+import struct
+
+# 1: text headers, 2: binary headers, 3: binary headers in compressed batches (see compression.py)
+PROTOCOL_VERSION = 3
+MAX_ID = 255 ** 8
+# Random IDs stay below MAX_ID, the IDs above it hold the (origin, sequence) of sequenced messages
+ID_LIMIT = 2 ** 64
+SEQUENCE_BITS = 32
+ORIGINS = (ID_LIMIT - MAX_ID) >> SEQUENCE_BITS
+# version, type, id, payload length in bytes
+HEADER = struct.Struct('!BcQI')
 
 
 class PacketType(enum.Enum):
@@ -11,34 +22,45 @@ class PacketType(enum.Enum):
     LOGOUT = 'o'
     MESSAGE = 's'
     ONLINE = 'l'
+    PRUNE = 'r'
+    IHAVE = 'h'
+    GRAFT = 'f'
+    PRESENCE = 'p'
+    SYNC = 'a'
+    PING = 'k'
+    PEERS = 'x'
+    ROUTE = 'w'
     DATA = ''
 
 
+# v1 header digits are characters 1..255 of a base-255 number, least significant first
+DIGITS = [chr(i + 1) for i in range(255)]
+LATIN_1 = struct.Struct('8B')
+
+
 class Packet:
+    __slots__ = ('type', '_id', '_data', '_payload', 'frame_size')
+
     def __init__(self, t: PacketType, data='', msg_id=None):
         self.type = t
         if msg_id is None:
-            msg_id = random.randint(0, 2 ** 64 - 1)
+            msg_id = random.randint(0, MAX_ID - 1)
         self._id = msg_id
-        self._size = len(data)
-        self.data = data
+        self._data = None
+        self._payload = None
+        self.frame_size = None
+        if isinstance(data, str):
+            self._data = data
+        else:
+            self._payload = bytes(data)
 
     @staticmethod
     def to_bytes(x: int) -> str:
-        s = ''
-        for i in range(8):
-            s += chr(x % 255 + 1)
-            x //= 255
-        return s
+        return to_text(x)
 
     @staticmethod
     def to_int(s: str) -> int:
-        if len(s) != 8:
-            raise ValueError('Incorrect length of string')
-        x = 0
-        for i in range(8):
-            x += (ord(s[i]) - 1) * (255 ** i)
-        return x
+        return to_int(s)
 
     @staticmethod
     def get_data_size(s: bytearray) -> int:
@@ -47,18 +69,38 @@ class Packet:
             raise ValueError('Too short sequence')
         return Packet.to_int(s[9:17])
 
+    @property
+    def data(self) -> str:
+        if self._data is None:
+            self._data = self._payload.decode()
+        return self._data
+
+    @data.setter
+    def data(self, data: str):
+        self._data = data
+        self._payload = None
+
+    @property
+    def payload(self) -> bytes:
+        if self._payload is None:
+            self._payload = self._data.encode()
+        return self._payload
+
     @property
     def id(self):
         return self._id
 
     @id.setter
     def id(self, x):
-        if not 0 <= x < 2 ** 60:
-            raise ValueError('ID must satisfy this statement: 0 <= ID < 2 ** 60')
+        if not 0 <= x < ID_LIMIT:
+            raise ValueError('ID must satisfy this statement: 0 <= ID < 2 ** 64')
         self._id = x
 
     def __bytes__(self):
-        return bytes(self.type.value + (self.to_bytes(self.id) if self.id is not None else '') + self.to_bytes(self._size) + self.data, 'utf-8')
+        return self.encode()
+
+    def encode(self, version=1) -> bytes:
+        return encode(self, version)
 
     def __repr__(self):
         return '{} : {} : {}'.format(self.type, str(self.id), self.data)
@@ -68,11 +110,89 @@ class Packet:
 
     @staticmethod
     def parse(byte_string):
-        types = dict(map(lambda x: (x.value, x), PacketType))
-        byte_string = byte_string.decode()
-        t = byte_string[0]
-        t = types[t]
-        msg_id = Packet.to_int(byte_string[1:9])
-        size = Packet.to_int(byte_string[9:17])
-        data = byte_string[17:17 + size]
-        return Packet(t, data, msg_id)
+        return decode_v1(bytes(byte_string))
+
+    @staticmethod
+    def decode(frame: bytes, version=1):
+        return decode(frame, version)
+
+
+TYPES = {t.value: t for t in PacketType}
+TYPE_BYTES = {t.value.encode(): t for t in PacketType}
+
+
+def to_text(x: int) -> str:
+    digits = []
+    for _ in range(8):
+        x, digit = divmod(x, 255)
+        digits.append(DIGITS[digit])
+    return ''.join(digits)
+
+
+def to_int(s: str) -> int:
+    if len(s) != 8:
+        raise ValueError('Incorrect length of string')
+    a, b, c, d, e, f, g, h = LATIN_1.unpack(s.encode('latin-1', 'replace'))
+    return a - 1 + 255 * (b - 1 + 255 * (c - 1 + 255 * (d - 1 + 255 * (e - 1 + 255 * (
+        f - 1 + 255 * (g - 1 + 255 * (h - 1)))))))
+
+
+# Packets of a frame are built without __init__: the frame already has the ID and the type.
+def from_frame(t: PacketType, msg_id: int, data, payload, frame_size: int) -> Packet:
+    message = Packet.__new__(Packet)
+    message.type = t
+    message._id = msg_id
+    message._data = data
+    message._payload = payload
+    message.frame_size = frame_size
+    return message
+
+
+def decode_v1(frame: bytes) -> Packet:
+    text = frame.decode()
+    size = to_int(text[9:17])
+    return from_frame(TYPES[text[0]], to_int(text[1:9]), text[17:17 + size], None, len(frame))
+
+
+def decode(frame: bytes, version=1) -> Packet:
+    if version == 1:
+        return decode_v1(frame)
+    frame_version, t, msg_id, size = HEADER.unpack_from(frame)
+    if frame_version != version:
+        raise ValueError('Unexpected frame version: ' + str(frame_version))
+    return from_frame(TYPE_BYTES[t], msg_id, None, frame[HEADER.size:HEADER.size + size], len(frame))
+
+
+def encode(message: Packet, version=1) -> bytes:
+    if version == 1:
+        data = message.data
+        return (message.type.value + to_text(message.id) + to_text(len(data)) + data).encode()
+    payload = message.payload
+    return HEADER.pack(version, message.type.value.encode(), message.id, len(payload)) + payload
+
+
+def negotiate_version(offer: str, highest=PROTOCOL_VERSION) -> int:
+    try:
+        version = int(offer)
+    except ValueError:
+        return 1
+    return max(1, min(version, highest))
+
+
+def sequenced_id(origin: int, sequence: int) -> int:
+    return MAX_ID + (origin << SEQUENCE_BITS) + sequence
+
+
+# (origin, sequence) of a sequenced ID, None for a random one.
+def split_id(msg_id: int):
+    if msg_id < MAX_ID:
+        return None
+    return divmod(msg_id - MAX_ID, 1 << SEQUENCE_BITS)
+
+
+def encode_ids(ids) -> str:
+    return ','.join(map(str, ids))
+
+
+def decode_ids(data: str) -> list:
+    return [int(x) for x in data.split(',') if x]
@@ -0,0 +1,367 @@
+import concurrent.futures
+import random
+import threading
+import time
+
+from src.packet import Packet, PacketType
+
+PING = 'P'
+PONG = 'O'
+ASK = 'G'
+REPLY = 'R'
+LOCAL_HOSTS = {'', '0.0.0.0', '127.0.0.1', 'localhost'}
+
+
+def split_address(address: str) -> tuple:
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def encode_peers(peers: list) -> str:
+    return '\n'.join([REPLY] + ['{} {}'.format(address, int(age)) for address, age in peers])
+
+
+def decode_peers(data: str) -> list:
+    peers = []
+    for line in data.split('\n')[1:]:
+        address, _, age = line.partition(' ')
+        if age.isdigit():
+            peers.append((address, int(age)))
+    return peers
+
+
+# Addresses of the net with the time they were last known to be alive. When the table is full
+# the stalest entry makes room, entries nobody vouched for within ttl seconds expire.
+class PeerTable:
+    def __init__(self, capacity=256, ttl=3600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, address):
+        return address in self._seen
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._seen))
+
+    def __len__(self):
+        return len(self._seen)
+
+    def add(self, address: str, seen=None):
+        if seen is None:
+            seen = time.monotonic()
+        with self._lock:
+            if address in self._seen:
+                self._seen[address] = max(self._seen[address], seen)
+                return
+            if len(self._seen) >= self.capacity:
+                stalest = min(self._seen, key=self._seen.get)
+                if self._seen[stalest] >= seen:
+                    return
+                del self._seen[stalest]
+            self._seen[address] = seen
+
+    def expire(self) -> list:
+        deadline = time.monotonic() - self.ttl
+        with self._lock:
+            expired = [address for address, seen in self._seen.items() if seen < deadline]
+            for address in expired:
+                del self._seen[address]
+        return expired
+
+    def sample(self, count: int, exclude=()) -> list:
+        now = time.monotonic()
+        with self._lock:
+            items = [(address, now - seen) for address, seen in self._seen.items() if address not in exclude]
+        return random.sample(items, min(count, len(items)))
+
+
+class PeerStats:
+    def __init__(self):
+        self.rtt = None
+        self.failures = 0
+        self.drops = 0
+        self.retry_at = 0.0
+        self.last_seen = None
+
+    def sample(self, rtt: float):
+        self.rtt = rtt if self.rtt is None else 0.8 * self.rtt + 0.2 * rtt
+
+    def score(self, unknown_rtt: float) -> float:
+        return (unknown_rtt if self.rtt is None else self.rtt) * (1 + self.failures + self.drops)
+
+
+# Keeps the node linked to the net. Every address of ip_list has stats: RTT from PING packets on
+# protocol version 2+ links (and from the handshake of new links), failed attempts and dropped links.
+# Lower RTT and fewer failures and drops mean a better score. When the parent link drops or the node
+# has fewer than target_degree healthy links, attempts to the best candidates are started every
+# `stagger` seconds, up to `parallel` at once, and the first links to come up win. Links that come
+# up later are kept only while the node is below the target. A failed address is not tried again
+# for an exponential backoff with jitter. A link that answered pings before and then stays silent
+# for dead_after seconds is dropped, links to peers that never answer (older versions) are trusted.
+# Addresses are exchanged with neighbors only: a new outgoing link asks its peer, and every
+# exchange_interval one random neighbor is asked. The reply is one packet with a random sample
+# of at most sample_size addresses and their ages, the connected peers among them.
+class PeerManager:
+    def __init__(self, server, target_degree=3, parallel=8, stagger=0.05, ping_interval=2, dead_after=10,
+                 backoff=0.5, max_backoff=60, unknown_rtt=0.1, attempt_timeout=6, sample_size=32,
+                 exchange_interval=30):
+        self._server = server
+        self.target_degree = target_degree
+        self.parallel = parallel
+        self.stagger = stagger
+        self.ping_interval = ping_interval
+        self.dead_after = dead_after
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.unknown_rtt = unknown_rtt
+        self.attempt_timeout = attempt_timeout
+        self.sample_size = sample_size
+        self.exchange_interval = exchange_interval
+        self._stats = {}
+        self._addresses = {}
+        self._pongs = {}
+        self._dropping = set()
+        self._last_ping = 0.0
+        self._last_exchange = time.monotonic() - random.uniform(0, exchange_interval)
+        self._parent_lost = False
+        self._repair = threading.Event()
+        self._lock = threading.Lock()
+
+    def stats(self, address: str) -> PeerStats:
+        with self._lock:
+            stats = self._stats.get(address)
+            if stats is None:
+                stats = self._stats[address] = PeerStats()
+            return stats
+
+    # Two nodes that race to each other end up with two links, both of them keep
+    # the one initiated by the node with the smaller address.
+    def connected(self, connection, address: str, initiator: bool):
+        twins = [c for c, a in list(self._addresses.items()) if a == address]
+        self._addresses[connection] = address
+        stats = self.stats(address)
+        stats.failures = 0
+        stats.last_seen = time.monotonic()
+        if twins:
+            own = '{}:{}'.format(self._local_host(connection), self._server._server_port)
+            if (own < address) != initiator:
+                self._drop(connection)
+            else:
+                for twin in twins:
+                    self._drop(twin)
+
+    # Links dropped on purpose don't count against the peer.
+    def _drop(self, connection):
+        self._dropping.add(connection)
+        self._server._disconnect(connection)
+
+    # Losing the parent starts attempts even if the node still has enough links, a new parent is
+    # the first link to come up. Other drops are repaired as soon as the degree is below the target.
+    def forget(self, connection, parent=False):
+        address = self._addresses.pop(connection, None)
+        self._pongs.pop(connection, None)
+        dropped = connection in self._dropping
+        self._dropping.discard(connection)
+        if self._server._closed:
+            return
+        if address is not None and not dropped and address not in self._addresses.values():
+            self.stats(address).drops += 1
+        self._parent_lost = self._parent_lost or parent
+        self.wake()
+
+    def wake(self):
+        self._repair.set()
+
+    def handle(self, message: Packet, source) -> bool:
+        if message.type is PacketType.PEERS:
+            self._on_peers(message.data, source)
+            return True
+        if message.type is not PacketType.PING:
+            return False
+        kind, _, token = message.data.partition(' ')
+        if kind == PING and source is not None:
+            self._server.send_to(source, Packet(PacketType.PING, PONG + ' ' + token))
+        elif kind == PONG and source in self._addresses:
+            try:
+                rtt = time.monotonic() - float(token)
+            except ValueError:
+                return True
+            now = time.monotonic()
+            self._pongs[source] = now
+            stats = self.stats(self._addresses[source])
+            stats.sample(rtt)
+            stats.last_seen = now
+        return True
+
+    # Old peers get a GET_IP, which they flood, and send one IP packet per address.
+    def ask(self, connection):
+        if self._server.version(connection) > 1:
+            self._server.send_to(connection, Packet(PacketType.PEERS, ASK))
+        else:
+            self._server.send_to(connection, Packet(PacketType.GET_IP))
+
+    def _on_peers(self, data: str, source):
+        if source is None:
+            return
+        if data == ASK:
+            self._server.send_to(source, Packet(PacketType.PEERS, encode_peers(self.sample(source))))
+        elif data.startswith(REPLY):
+            now = time.monotonic()
+            for address, age in decode_peers(data):
+                self._server.ip_list.add(address, now - age)
+
+    def answer_legacy(self, message: Packet, source):
+        for address, age in self.sample(source):
+            self._server.send_to(source, Packet(PacketType.IP, '{}/{}'.format(message.data, address)))
+
+    def sample(self, asker=None) -> list:
+        exclude = {self._addresses.get(asker)}
+        linked = [(a, 0) for a in set(self._addresses.values()) if a not in exclude]
+        linked = random.sample(linked, min(len(linked), self.sample_size // 2))
+        exclude.update(address for address, age in linked)
+        return linked + self._server.ip_list.sample(self.sample_size - len(linked), exclude)
+
+    def healthy(self, connection) -> bool:
+        answered = self._pongs.get(connection)
+        return answered is None or time.monotonic() - answered < self.dead_after
+
+    def tick(self):
+        self._repair.wait(0.5)
+        self._repair.clear()
+        if self._server._closed:
+            return
+        now = time.monotonic()
+        if now - self._last_ping >= self.ping_interval:
+            self._last_ping = now
+            self._ping()
+        if now - self._last_exchange >= self.exchange_interval:
+            self._last_exchange = now
+            self._exchange()
+        healthy = [c for c in self._server.peers() if self.healthy(c)]
+        missing = self.target_degree - len(healthy)
+        if self._parent_lost:
+            self._parent_lost = False
+            missing = max(missing, 1)
+        if missing > 0:
+            self.race(missing)
+        self._adopt_parent()
+
+    def _adopt_parent(self):
+        if self._server._par_conn is not None:
+            return
+        links = [c for c in self._server.peers() if c in self._addresses and self.healthy(c)]
+        if links:
+            self._server._par_conn = min(links, key=lambda c: self.stats(self._addresses[c]).score(self.unknown_rtt))
+
+    def _exchange(self):
+        linked = set(self._addresses.values())
+        for address in linked:
+            self._server.ip_list.add(address)
+        self._server.ip_list.expire()
+        with self._lock:
+            for address in [a for a in self._stats if a not in self._server.ip_list and a not in linked]:
+                del self._stats[address]
+        links = [c for c in self._server.peers() if self._server.version(c) > 1]
+        if links:
+            self.ask(random.choice(links))
+
+    def _ping(self):
+        token = '{} {}'.format(PING, time.monotonic())
+        for connection in self._server.peers():
+            if not self.healthy(connection):
+                self._server._disconnect(connection)
+            elif self._server.version(connection) > 1:
+                self._server.send_to(connection, Packet(PacketType.PING, token))
+
+    def candidates(self) -> list:
+        now = time.monotonic()
+        connected = set(self._addresses.values())
+        local = self._local_hosts()
+        port = self._server._server_port
+        addresses = []
+        for address in list(self._server.ip_list):
+            try:
+                host, address_port = split_address(address)
+            except ValueError:
+                continue
+            if address in connected or address_port == port and host in local:
+                continue
+            if self.stats(address).retry_at <= now:
+                addresses.append(address)
+        # shuffled first, so that nodes that know nothing about the candidates don't all pick the same ones
+        random.shuffle(addresses)
+        return sorted(addresses, key=lambda a: self.stats(a).score(self.unknown_rtt))
+
+    @staticmethod
+    def _local_host(connection) -> str:
+        try:
+            if hasattr(connection, 'get_extra_info'):
+                return connection.get_extra_info('sockname')[0]
+            return connection.getsockname()[0]
+        except (OSError, TypeError):
+            return ''
+
+    def _local_hosts(self) -> set:
+        return LOCAL_HOSTS | {self._local_host(connection) for connection in self._server.peers()}
+
+    # Returns the number of links that came up before the attempts ran out or attempt_timeout passed.
+    def race(self, count: int) -> int:
+        candidates = self.candidates()
+        attempts = {}
+        established = 0
+        deadline = time.monotonic() + self.attempt_timeout
+        while (candidates or attempts) and established < count and not self._server._closed:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            if candidates and len(attempts) < self.parallel:
+                address = candidates.pop(0)
+                attempts[self._attempt(address)] = (address, time.monotonic())
+                timeout = min(timeout, self.stagger)
+            done, _ = concurrent.futures.wait(attempts, timeout, concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if self._finished(future, *attempts.pop(future)):
+                    established += 1
+        for future, (address, started) in attempts.items():
+            future.add_done_callback(lambda f, a=address, s=started: self._finished_late(f, a, s))
+        return established
+
+    def _finished_late(self, future: concurrent.futures.Future, address: str, started: float):
+        if not self._finished(future, address, started):
+            return
+        connection = future.result()
+        if connection is not self._server._par_conn and len(self._server.peers()) > self.target_degree:
+            self._drop(connection)
+
+    def _attempt(self, address: str) -> concurrent.futures.Future:
+        self._server.metrics.inc('chat_reconnect_attempts_total')
+        try:
+            return self._server._attempt(*split_address(address))
+        except (OSError, ValueError) as e:
+            future = concurrent.futures.Future()
+            future.set_exception(e)
+            return future
+
+    def _finished(self, future: concurrent.futures.Future, address: str, started: float) -> bool:
+        stats = self.stats(address)
+        try:
+            future.result()
+        except (OSError, ValueError, concurrent.futures.CancelledError, concurrent.futures.TimeoutError):
+            self._server.metrics.inc('chat_reconnect_failures_total')
+            stats.failures += 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (stats.failures - 1))
+            stats.retry_at = time.monotonic() + delay * random.uniform(0.5, 1.5)
+            return False
+        stats.sample(time.monotonic() - started)
+        return True
+
+    def samples(self) -> list:
+        samples = []
+        for connection, address in list(self._addresses.items()):
+            stats = self._stats.get(address)
+            if stats is not None and stats.rtt is not None:
+                samples.append(('chat_peer_rtt_seconds', (('peer', address),), stats.rtt))
+        return samples
@@ -0,0 +1,284 @@
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+import types
+
+from src.packet import Packet, PacketType
+
+UPDATE = 'u'
+FULL = 'f'
+FULL_REPLY = 'F'
+DIGEST = 'd'
+
+
+class Entry:
+    def __init__(self, version: int, online: bool, expires: float):
+        self.version = version
+        self.online = online
+        self.expires = expires
+        self.last_seen = time.monotonic()
+
+
+def entry_hash(nickname: str) -> int:
+    digest = hashlib.blake2b(nickname.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def encode_entry(nickname: str, entry: Entry, owned=False) -> str:
+    return '{}{}{}:{}'.format('*' if owned else '', '+' if entry.online else '-', entry.version, nickname)
+
+
+def decode_entry(line: str):
+    owned = line.startswith('*')
+    if owned:
+        line = line[1:]
+    version, nickname = line[1:].split(':', 1)
+    return nickname, int(version), line[0] == '+', owned
+
+
+# Versioned roster exchanged between neighbors instead of flooding ONLINE packets.
+# Joins and leaves travel as batched deltas, which are forwarded only when they change something.
+# In steady state each link carries one fixed-size digest (XOR of the hashes of the online
+# nicknames) per sync_interval, a full roster is exchanged only when the digests differ.
+# A node refreshes its own entries every refresh_interval, so entries of crashed nodes expire
+# after three missed refreshes. Refreshes only bump versions and travel as deltas, the digest
+# leaves versions out so that they don't make neighbors exchange full rosters.
+# Links to protocol version 1 peers get ONLINE heartbeats for the whole roster instead.
+# Expiry times are kept in a heap with lazy deletion: extending an entry pushes a new item
+# and the outdated one is skipped when it comes up, so expire() only touches what is due.
+class Presence:
+    def __init__(self, server, sync_interval=10, refresh_interval=300, tombstone_ttl=600,
+                 legacy_interval=10, legacy_ttl=30):
+        self._server = server
+        self.sync_interval = sync_interval
+        self.refresh_interval = refresh_interval
+        self.ttl = refresh_interval * 3
+        self.tombstone_ttl = tombstone_ttl
+        self.legacy_interval = legacy_interval
+        self.legacy_ttl = legacy_ttl
+        self._entries = {}
+        self._expiry = []
+        self._sequence = itertools.count()
+        self._online = {}
+        self._snapshot = None
+        self._subscribers = []
+        self._events = []
+        self._publish_lock = threading.Lock()
+        self._own = set()
+        self._owners = {}
+        self._digest = 0
+        self._pending = {}
+        self._new_links = []
+        now = time.monotonic()
+        self._last_sync = now
+        self._last_refresh = now
+        self._last_legacy = 0
+        self._lock = threading.RLock()
+
+    @property
+    def digest(self) -> int:
+        return self._digest
+
+    def online(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = types.MappingProxyType(dict(self._online))
+                snapshot = self._snapshot
+        return snapshot
+
+    def __iter__(self):
+        return iter(self.online())
+
+    def __len__(self):
+        return len(self._online)
+
+    def hosts(self, nickname: str) -> bool:
+        return nickname in self._own
+
+    def hosted(self) -> set:
+        with self._lock:
+            return set(self._own)
+
+    # callback(nickname, online) is called on every join and leave, after the table is updated.
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def _publish(self):
+        with self._publish_lock:
+            with self._lock:
+                events, self._events = self._events, []
+            for nickname, online in events:
+                for callback in self._subscribers:
+                    callback(nickname, online)
+
+    def join(self, nickname: str):
+        with self._lock:
+            entry = self._entries.get(nickname)
+            self._own.add(nickname)
+            self._set(nickname, entry.version + 1 if entry is not None else 1, True, self.ttl)
+        self._publish()
+
+    def leave(self, nickname: str):
+        with self._lock:
+            self._own.discard(nickname)
+            entry = self._entries.get(nickname)
+            if entry is not None and entry.online:
+                self._set(nickname, entry.version + 1, False, self.tombstone_ttl)
+        self._publish()
+
+    def connected(self, connection):
+        if self._server.version(connection) >= 2:
+            with self._lock:
+                self._new_links.append(connection)
+
+    def forget(self, connection):
+        with self._lock:
+            self._new_links = [link for link in self._new_links if link is not connection]
+            for nickname in self._owners.pop(connection, ()):
+                entry = self._entries.get(nickname)
+                if entry is not None and entry.online and nickname not in self._own:
+                    self._set(nickname, entry.version + 1, False, self.tombstone_ttl)
+        self._publish()
+
+    def on_online(self, nickname: str):
+        with self._lock:
+            entry = self._entries.get(nickname)
+            if entry is not None and entry.online:
+                self._extend(nickname, entry, self.legacy_ttl)
+            else:
+                self._set(nickname, entry.version + 1 if entry is not None else 1, True, self.legacy_ttl)
+        self._publish()
+
+    def _extend(self, nickname: str, entry: Entry, ttl: float):
+        now = time.monotonic()
+        entry.last_seen = now
+        self._online[nickname] = now
+        self._snapshot = None
+        if now + ttl > entry.expires:
+            entry.expires = now + ttl
+            self._schedule(nickname, entry)
+
+    def _schedule(self, nickname: str, entry: Entry):
+        heapq.heappush(self._expiry, (entry.expires, next(self._sequence), nickname, entry))
+        if len(self._expiry) > 2 * len(self._entries) + 64:
+            self._expiry = [(e.expires, next(self._sequence), n, e) for n, e in self._entries.items()]
+            heapq.heapify(self._expiry)
+
+    def _set(self, nickname: str, version: int, online: bool, ttl: float, source=None) -> bool:
+        entry = self._entries.get(nickname)
+        now = time.monotonic()
+        if entry is not None:
+            if version < entry.version or version == entry.version and (online or not entry.online):
+                if version == entry.version and online:
+                    self._extend(nickname, entry, ttl)
+                return False
+            if entry.online:
+                self._digest ^= entry_hash(nickname)
+        was_online = entry is not None and entry.online
+        entry = self._entries[nickname] = Entry(version, online, now + ttl)
+        self._schedule(nickname, entry)
+        if online:
+            self._digest ^= entry_hash(nickname)
+            self._online[nickname] = now
+        else:
+            self._online.pop(nickname, None)
+        self._snapshot = None
+        if online != was_online:
+            self._events.append((nickname, online))
+        self._pending[nickname] = source
+        return True
+
+    def handle(self, message: Packet, source) -> bool:
+        if message.type is not PacketType.PRESENCE:
+            return False
+        lines = message.data.split('\n')
+        kind = lines[0]
+        if kind == DIGEST:
+            if len(lines) < 2:
+                raise ValueError('Digest without a value')
+            if int(lines[1]) != self._digest:
+                self._server.send_to(source, self._full(FULL_REPLY))
+            return True
+        with self._lock:
+            for line in lines[1:]:
+                if line:
+                    self._merge(*decode_entry(line), source)
+        self._publish()
+        if kind == FULL_REPLY:
+            self._server.send_to(source, self._full(FULL))
+        return True
+
+    def _merge(self, nickname: str, version: int, online: bool, owned: bool, source):
+        if owned:
+            self._owners.setdefault(source, set()).add(nickname)
+        if nickname in self._own:
+            entry = self._entries[nickname]
+            if not online and version >= entry.version:
+                self._set(nickname, version + 1, True, self.ttl)
+            elif online and version > entry.version:
+                self._set(nickname, version, True, self.ttl)
+            return
+        self._set(nickname, version, online, self.ttl if online else self.tombstone_ttl, source)
+
+    def _full(self, kind: str) -> Packet:
+        with self._lock:
+            lines = [encode_entry(nickname, entry, nickname in self._own) for nickname, entry in self._entries.items()]
+        return Packet(PacketType.PRESENCE, '\n'.join([kind] + lines))
+
+    def expire(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                expires, _, nickname, entry = heapq.heappop(self._expiry)
+                if self._entries.get(nickname) is not entry or entry.expires != expires:
+                    continue
+                if nickname in self._own:
+                    continue
+                if entry.online:
+                    self._set(nickname, entry.version + 1, False, self.tombstone_ttl)
+                else:
+                    del self._entries[nickname]
+        self._publish()
+
+    def tick(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_refresh >= self.refresh_interval:
+                self._last_refresh = now
+                for nickname in self._own:
+                    self._set(nickname, self._entries[nickname].version + 1, True, self.ttl)
+            pending, self._pending = self._pending, {}
+            new_links, self._new_links = self._new_links, []
+            updates = [(encode_entry(nickname, self._entries[nickname], nickname in self._own), source)
+                       for nickname, source in pending.items() if nickname in self._entries]
+        peers = [connection for connection in self._server.peers() if self._server.version(connection) >= 2]
+        for connection in new_links:
+            self._server.send_to(connection, self._full(FULL_REPLY))
+        if updates:
+            for connection in peers:
+                if connection in new_links:
+                    continue
+                lines = [line for line, source in updates if source is not connection]
+                if lines:
+                    self._server.send_to(connection, Packet(PacketType.PRESENCE, '\n'.join([UPDATE] + lines)))
+        if now - self._last_sync >= self.sync_interval:
+            self._last_sync = now
+            for connection in peers:
+                self._server.send_to(connection, Packet(PacketType.PRESENCE, '{}\n{}'.format(DIGEST, self._digest)))
+        if now - self._last_legacy >= self.legacy_interval:
+            self._last_legacy = now
+            self._heartbeat_legacy()
+        self.expire()
+
+    def _heartbeat_legacy(self):
+        legacy = [connection for connection in self._server.peers() if self._server.version(connection) < 2]
+        if not legacy:
+            return
+        nicknames = list(self.online())
+        for connection in legacy:
+            for nickname in nicknames:
+                self._server.send_to(connection, Packet(PacketType.ONLINE, nickname))
@@ -0,0 +1,157 @@
+import collections
+import queue
+import threading
+import time
+
+from src.packet import PacketType
+
+CHAT = 'chat'
+CONTROL = 'control'
+PRESENCE = 'presence'
+GOSSIP = 'gossip'
+# highest priority first
+PRIORITIES = (CHAT, CONTROL, PRESENCE, GOSSIP)
+CLASSES = {
+    PacketType.MESSAGE: CHAT,
+    PacketType.DATA: CHAT,
+    PacketType.CONNECTION: CONTROL,
+    PacketType.CONFIRMATION: CONTROL,
+    PacketType.PRUNE: CONTROL,
+    PacketType.IHAVE: CONTROL,
+    PacketType.GRAFT: CONTROL,
+    PacketType.PING: CONTROL,
+    PacketType.ROUTE: CONTROL,
+    PacketType.LOGIN: PRESENCE,
+    PacketType.LOGOUT: PRESENCE,
+    PacketType.ONLINE: PRESENCE,
+    PacketType.PRESENCE: PRESENCE,
+    PacketType.GET_IP: GOSSIP,
+    PacketType.IP: GOSSIP,
+    PacketType.PEERS: GOSSIP,
+    PacketType.SYNC: GOSSIP,
+}
+# Priority of a frame by the type byte of its header
+FRAME_PRIORITIES = {t.value.encode(): PRIORITIES.index(c) for t, c in CLASSES.items()}
+# Frames of these classes are dropped rather than the link when a peer can't keep up
+DROPPABLE = (PRIORITIES.index(PRESENCE), PRIORITIES.index(GOSSIP))
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+
+
+def packet_class(message) -> str:
+    return CLASSES.get(message.type, GOSSIP)
+
+
+class Class:
+    def __init__(self, name: str, capacity: int, overflow: str, weight: int):
+        self.name = name
+        self.capacity = capacity
+        self.overflow = overflow
+        self.weight = weight
+        self.current = 0
+        self.dropped = 0
+        self.items = collections.deque()
+
+
+# Bounded queue of several classes with the get/put interface of queue.Queue. A full class
+# makes room by dropping its oldest item, rejects the new one, or blocks the producer for
+# up to block_timeout seconds and then rejects it, so a stuck consumer can't stall the
+# network threads for good. get takes the highest class that has items ('strict'), or
+# shares the gets by the weights of the classes that have items ('weighted', smooth round robin).
+class ClassQueue:
+    # classes: (name, capacity, overflow, weight) in priority order
+    def __init__(self, classes, classify, scheduling='strict', block_timeout=1):
+        self._classes = [Class(*c) for c in classes]
+        self._by_name = {c.name: c for c in self._classes}
+        self._classify = classify
+        self.scheduling = scheduling
+        self.block_timeout = block_timeout
+        self._count = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def qsize(self) -> int:
+        return self._count
+
+    def empty(self) -> bool:
+        return not self._count
+
+    def depths(self) -> dict:
+        return {c.name: len(c.items) for c in self._classes}
+
+    def dropped(self) -> dict:
+        return {c.name: c.dropped for c in self._classes}
+
+    # Whether a put of the item would have to wait for room.
+    def full(self, item) -> bool:
+        c = self._by_name.get(self._classify(item), self._classes[-1])
+        return c.overflow == BLOCK and len(c.items) >= c.capacity
+
+    # Returns False when the item was dropped.
+    def put(self, item, block=True, timeout=None) -> bool:
+        c = self._by_name.get(self._classify(item), self._classes[-1])
+        with self._lock:
+            if len(c.items) >= c.capacity:
+                if c.overflow == DROP_OLDEST:
+                    c.items.popleft()
+                    c.dropped += 1
+                    self._count -= 1
+                elif c.overflow == BLOCK and block:
+                    if timeout is None:
+                        timeout = self.block_timeout
+                    deadline = time.monotonic() + timeout
+                    while len(c.items) >= c.capacity:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._not_full.wait(remaining)
+                if len(c.items) >= c.capacity:
+                    c.dropped += 1
+                    return False
+            c.items.append(item)
+            self._count += 1
+            self._not_empty.notify()
+        return True
+
+    def put_nowait(self, item) -> bool:
+        return self.put(item, False)
+
+    def get(self, block=True, timeout=None):
+        with self._lock:
+            if not block:
+                if not self._count:
+                    raise queue.Empty
+            elif timeout is None:
+                while not self._count:
+                    self._not_empty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self._count:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+            item = self._pop().items.popleft()
+            self._count -= 1
+            self._not_full.notify_all()
+            return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def _pop(self) -> Class:
+        ready = [c for c in self._classes if c.items]
+        if self.scheduling == 'strict' or len(ready) == 1:
+            return ready[0]
+        total = 0
+        chosen = None
+        for c in ready:
+            c.current += c.weight
+            total += c.weight
+            if chosen is None or c.current > chosen.current:
+                chosen = c
+        chosen.current -= total
+        return chosen
@@ -1,32 +1,43 @@
 import queue
 
 from src import utils
-from src import packet
+from src import codec
+from src import framing
 
 
 class Reader(utils.Daemon):
-    def __init__(self, connection, packet_size: int):
-        super().__init__(name='reading', target=self._read)
+    def __init__(self, connection, packet_size: int, decoder=None, callback=None, closed=None):
+        super().__init__(name='reading', target=self._read, timeout=0)
         self.connection = connection
-        self._buffer = bytearray()
+        if decoder is None:
+            decoder = framing.FrameDecoder()
+        self._decoder = decoder
+        self._callback = callback
+        self._closed = closed
         self.packet_size = packet_size
         self.messages = queue.Queue()
 
     def _read(self):
-        self._buffer.extend(self.connection.recv(self.packet_size))
-        self._flush()
-
-    def _flush(self):
-        while True:
+        try:
+            data = self.connection.recv(self.packet_size)
+        except OSError:
+            data = b''
+        if data:
             try:
-                size = packet.Packet.get_data_size(self._buffer)
-            except ValueError:
-                return
-            packets = self._buffer.decode()
-            if len(self._buffer.decode()) < 1 + 8 + 8 + size:
+                self.feed(data)
                 return
-            self.messages.put(bytes(packets[:1 + 8 + 8 + size], 'utf-8'))
-            self._buffer = bytearray(packets[1 + 8 + 8 + size:], 'utf-8')
+            except ValueError:
+                pass
+        self.stop()
+        if self._closed is not None:
+            self._closed(self.connection)
+
+    def feed(self, data: bytes):
+        for message in codec.parse_many(self._decoder.feed(data), self._decoder.version):
+            if self._callback is not None:
+                self._callback(message, self.connection)
+            else:
+                self.messages.put(message)
 
     def get(self):
         if not self.messages.empty():
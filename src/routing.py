@@ -0,0 +1,161 @@
+import threading
+import time
+
+from src.packet import Packet, PacketType
+
+PRIVATE = b'p:'
+ROUTED = (('path', 'routed'),)
+FLOODED = (('path', 'flooded'),)
+LOCAL = (('path', 'local'),)
+
+
+class Route:
+    def __init__(self, connection, distance: int, expires: float):
+        self.connection = connection
+        self.distance = distance
+        self.expires = expires
+
+
+def encode_routes(routes: list) -> str:
+    return '\n'.join('{}:{}'.format(distance, nickname) for nickname, distance in routes)
+
+
+def decode_routes(data: str) -> list:
+    routes = []
+    for line in data.split('\n'):
+        distance, _, nickname = line.partition(':')
+        if distance.isdigit() and nickname:
+            routes.append((nickname, int(distance)))
+    return routes
+
+
+# Nickname -> next hop table, so private messages travel along one path instead of the whole net.
+# Distance vector: a node tells its neighbors how many hops away it is from every nickname it
+# knows, the nicknames it hosts itself are 0 hops away. Changes are sent in the next tick, the whole
+# vector every advertise_interval, and a route that is not advertised again within ttl is dropped.
+# A neighbor hears max_distance for the routes that go through it (poisoned reverse), so after
+# a link failure two nodes don't keep routing to each other. A nickname that goes offline in the
+# presence table loses its route. Without a route, or with one that leads back to where the
+# message came from, a private message is disseminated like a shared one.
+# Only protocol version 2+ links carry vectors, builds that don't know ROUTE packets skip them
+# and never become a next hop.
+class Router:
+    def __init__(self, server, advertise_interval=30, max_distance=16):
+        self._server = server
+        self.advertise_interval = advertise_interval
+        self.ttl = advertise_interval * 3
+        self.max_distance = max_distance
+        self._routes = {}
+        self._pending = set()
+        self._new_links = []
+        self._last_advertise = time.monotonic()
+        self._lock = threading.Lock()
+        server.presence.subscribe(self._on_presence)
+
+    def __len__(self):
+        return len(self._routes)
+
+    def get(self, nickname: str) -> Route:
+        return self._routes.get(nickname)
+
+    def connected(self, connection):
+        if self._server.version(connection) >= 2:
+            with self._lock:
+                self._new_links.append(connection)
+
+    def forget(self, connection):
+        with self._lock:
+            self._new_links = [link for link in self._new_links if link is not connection]
+            for nickname in [n for n, route in self._routes.items() if route.connection is connection]:
+                del self._routes[nickname]
+                self._pending.add(nickname)
+
+    def _on_presence(self, nickname: str, online: bool):
+        hosted = self._server.presence.hosts(nickname)
+        with self._lock:
+            if not online:
+                self._routes.pop(nickname, None)
+            if hosted or not online:
+                self._pending.add(nickname)
+
+    # The links a message goes to, None when it is not a private message or has no usable route.
+    def route(self, message: Packet, source, connections) -> list:
+        if message.type is not PacketType.MESSAGE or not message.payload.startswith(PRIVATE):
+            return None
+        addressee = message.data.split(':', 2)[1]
+        if self._server.presence.hosts(addressee):
+            self._server.metrics.inc('chat_private_messages_total', LOCAL)
+            return []
+        route = self._routes.get(addressee)
+        if route is None or route.connection is source or route.connection not in connections:
+            self._server.metrics.inc('chat_private_messages_total', FLOODED)
+            return None
+        self._server.metrics.inc('chat_private_messages_total', ROUTED)
+        return [route.connection]
+
+    @staticmethod
+    def private(message: Packet) -> bool:
+        return message.type is PacketType.MESSAGE and message.payload.startswith(PRIVATE)
+
+    # False for private messages that only pass through, neither of their users is hosted here.
+    def delivers(self, message: Packet) -> bool:
+        if not self.private(message):
+            return True
+        parts = message.data.split(':', 3)
+        return len(parts) < 4 or self._server.presence.hosts(parts[1]) or self._server.presence.hosts(parts[2])
+
+    def handle(self, message: Packet, source) -> bool:
+        if message.type is not PacketType.ROUTE:
+            return False
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for nickname, distance in decode_routes(message.data):
+                distance = min(distance + 1, self.max_distance)
+                route = self._routes.get(nickname)
+                if route is not None and route.connection is source:
+                    if distance >= self.max_distance:
+                        del self._routes[nickname]
+                        self._pending.add(nickname)
+                        continue
+                    route.expires = expires
+                    if distance != route.distance:
+                        route.distance = distance
+                        self._pending.add(nickname)
+                elif distance < self.max_distance and (route is None or distance < route.distance):
+                    self._routes[nickname] = Route(source, distance, expires)
+                    self._pending.add(nickname)
+        return True
+
+    def _distance(self, nickname: str, hosted: set, connection) -> int:
+        if nickname in hosted:
+            return 0
+        route = self._routes.get(nickname)
+        if route is None or route.connection is connection:
+            return self.max_distance
+        return route.distance
+
+    def tick(self):
+        now = time.monotonic()
+        hosted = self._server.presence.hosted()
+        peers = [connection for connection in self._server.peers() if self._server.version(connection) >= 2]
+        vectors = {}
+        with self._lock:
+            for nickname in [n for n, route in self._routes.items() if route.expires <= now]:
+                del self._routes[nickname]
+                self._pending.add(nickname)
+            new_links, self._new_links = self._new_links, []
+            pending, self._pending = self._pending, set()
+            everyone = now - self._last_advertise >= self.advertise_interval
+            if everyone:
+                self._last_advertise = now
+            known = hosted | set(self._routes)
+            for connection in peers:
+                if everyone or connection in new_links:
+                    routes = [(nickname, self._distance(nickname, hosted, connection)) for nickname in known]
+                    routes = [(nickname, distance) for nickname, distance in routes if distance < self.max_distance]
+                else:
+                    routes = [(nickname, self._distance(nickname, hosted, connection)) for nickname in pending]
+                if routes:
+                    vectors[connection] = routes
+        for connection, routes in vectors.items():
+            self._server.send_to(connection, Packet(PacketType.ROUTE, encode_routes(routes)))
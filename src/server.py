@@ -1,19 +1,63 @@
+import concurrent.futures
 import copy
+import functools
+import itertools
 import queue
 import random
 import threading
 import socket
-import time
 
 from src.packet import Packet, PacketType
+from src import compression
+from src import dedup
+from src import metrics
+from src import ordering
+from src import gossip
+from src import handshake
+from src import packet
+from src import peers
+from src import presence
+from src import queues
+from src import catchup
 from src import reader
+from src import routing
 from src import utils
+from src import writer
+
+LEGACY_DELAY = 1
+# Frames that disseminate chat, only these count towards the amplification
+DISSEMINATION_FRAMES = {t.value.encode() for t in (PacketType.MESSAGE, PacketType.IHAVE, PacketType.GRAFT,
+                                                   PacketType.PRUNE)}
+# What handling a malformed packet can raise, it costs the peer its link
+MALFORMED = (ValueError, IndexError, TypeError, KeyError, ZeroDivisionError)
+# (class, capacity, overflow, weight) of the queues, in priority order
+SENDING_CLASSES = (
+    (queues.CHAT, 10000, queues.BLOCK, 8),
+    (queues.CONTROL, 1000, queues.DROP_OLDEST, 4),
+    (queues.PRESENCE, 1000, queues.DROP_OLDEST, 2),
+    (queues.GOSSIP, 1000, queues.DROP_OLDEST, 1),
+)
+# readers wait for room rather than lose chat or catch-up packets, missed presence deltas are
+# repaired by the digest exchange
+RECEIVING_CLASSES = (
+    (queues.CHAT, 10000, queues.BLOCK, 8),
+    (queues.CONTROL, 1000, queues.BLOCK, 4),
+    (queues.PRESENCE, 1000, queues.DROP_OLDEST, 2),
+    (queues.GOSSIP, 1000, queues.BLOCK, 1),
+)
+# a client that doesn't read must not stall relaying, it loses its oldest messages instead
+DELIVERY_CLASSES = (
+    (queues.CHAT, 10000, queues.DROP_OLDEST, 1),
+)
 
 
 class Server:
-    def __init__(self, chat_addr=None, server_port=None):
-        self.sending_message_queue = queue.Queue()
-        self.got_messages = queue.Queue()
+    def __init__(self, chat_addr=None, server_port=None, dissemination='flood', compression=True, sequencing=False):
+        self.sending_message_queue = queues.ClassQueue(SENDING_CLASSES, lambda item: queues.packet_class(item[0]),
+                                                       'weighted')
+        self.got_messages = queues.ClassQueue(DELIVERY_CLASSES, queues.packet_class)
+        self.receiving_queue = queues.ClassQueue(RECEIVING_CLASSES, lambda item: queues.packet_class(item[0]),
+                                                 'weighted')
         self._server_host = ''
         self._server_port = server_port
         self._receive_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -21,144 +65,363 @@ class Server:
         self._receive_socket.listen(1024)
         self._readers = []
         self._connections = []
+        self._versions = {}
+        self._senders = {}
         self.packet_size = 4096
-        self._sent = utils.SafeSet()
-        self.received = utils.SafeSet()
-        self.lock = threading.Lock()
+        self.high_water = 1 << 20
+        self.overflow = 'disconnect'
+        # Offer protocol version 3 in the handshake, links to peers that accept it are compressed
+        self.compression = compression
+        self.compression_level = 6
+        self.compression_threshold = 64
+        # Shared messages of this node get (origin, sequence) IDs instead of random ones
+        self.sequencing = sequencing
+        self.origin = random.randrange(packet.ORIGINS)
+        self._sequence = itertools.count()
+        self._sent = dedup.SequencedDedupCache()
+        self.received = dedup.SequencedDedupCache()
+        self.lock = threading.RLock()
+        # bytes of DISSEMINATION_FRAMES sent and of new chat messages received
+        self.sent_bytes = 0
+        self.delivered_bytes = 0
+        self.metrics = metrics.Registry()
+        self.metrics.collect(self._collect_metrics)
+        self.dissemination = gossip.STRATEGIES[dissemination](self)
+        self._gossiping = utils.Daemon(name='gossiping', target=self.dissemination.tick, timeout=0.1)
+        self.presence = presence.Presence(self)
+        self._presence_updater = utils.Daemon(name='presence', target=self.presence.tick, timeout=1)
+        self.catchup = catchup.AntiEntropy(self)
+        self._catching_up = utils.Daemon(name='catching up', target=self.catchup.tick, timeout=1)
+        self.router = routing.Router(self)
+        self._routing = utils.Daemon(name='routing', target=self.router.tick, timeout=1)
+        self.ordering = ordering.Ordering(self)
+        self._ordering = utils.Daemon(name='ordering', target=self.ordering.tick, timeout=0.1)
+        self.peer_manager = peers.PeerManager(self)
+        self._managing = utils.Daemon(name='peers', target=self.peer_manager.tick, timeout=0)
         self._sending = utils.Daemon(name='sending', target=self._send_to_clients, timeout=0)
-        self._getting = utils.Daemon(name='getting', target=self.get)
-        self._accepting = utils.Daemon(name='accepting', target=self._accept, timeout=1)
-        self._connection_event = threading.Event()
-        self.ip_list = utils.SafeSet()
-        self._question_id = None
+        self._processing = utils.Daemon(name='processing', target=self._process_received, timeout=0)
+        self._accepting = handshake.Handshaker(self._receive_socket, server_port, self._established,
+                                               self.protocol_version)
+        for daemon in (self._gossiping, self._presence_updater, self._catching_up, self._routing, self._ordering):
+            self.metrics.watch(daemon)
+        self.ip_list = peers.PeerTable()
         self._par_conn = None
-        with self.lock:
-            if chat_addr is not None:
-                self._connect(chat_addr[0], chat_addr[1])
+        self._closed = False
+        if chat_addr is not None:
+            self._connect(chat_addr[0], chat_addr[1])
 
     def run(self):
         with self.lock:
             self._sending.run()
-            self._getting.run()
+            self._processing.run()
+            self._accepting.listen()
             self._accepting.run()
+            self._gossiping.run()
+            self._presence_updater.run()
+            self._catching_up.run()
+            self._routing.run()
+            self._ordering.run()
+            self._managing.run()
 
-    def send(self, message: Packet):
-        if message.id is None:
-            message.id = random.randint(0, 2 ** 60 - 1)
-        if message.id in self._sent:
+    def send(self, message: Packet, source=None):
+        if self._closed or message.id in self._sent:
+            return
+        # chat that finds no room reaches the peers by a catch-up exchange instead
+        if not self._queue_broadcast(message, source):
+            if message.type is PacketType.MESSAGE:
+                for connection in self.peers():
+                    if connection is not source:
+                        self.catchup.connected(connection)
             return
         self._sent.add(message.id)
-        self.sending_message_queue.put(message)
+
+    # Relays come from the processing thread, which holds the lock and must not wait for room.
+    def _queue_broadcast(self, message: Packet, source) -> bool:
+        if not self.sending_message_queue.put((message, source), source is None):
+            return False
         self._sending.run()
+        return True
+
+    # ID for a message this node originates, None leaves the random one.
+    def new_id(self):
+        if not self.sequencing:
+            return None
+        sequence = next(self._sequence)
+        if sequence >> packet.SEQUENCE_BITS:
+            self.origin = random.randrange(packet.ORIGINS)
+            self._sequence = itertools.count(1)
+            sequence = 0
+        return packet.sequenced_id(self.origin, sequence)
+
+    def send_to(self, connection, message: Packet):
+        self._write(connection, packet.encode(message, self.version(connection)))
+
+    def peers(self) -> list:
+        return copy.copy(self._connections)
+
+    def version(self, connection) -> int:
+        return self._versions.get(connection, 1)
+
+    @property
+    def protocol_version(self) -> int:
+        return packet.PROTOCOL_VERSION if self.compression else 2
+
+    def _deflater(self, version: int):
+        if version < 3:
+            return None
+        return compression.Deflater(self.compression_level, self.compression_threshold)
+
+    @property
+    def amplification(self) -> float:
+        if not self.delivered_bytes:
+            return 0.0
+        return self.sent_bytes / self.delivered_bytes
 
     def _connect(self, chat_host, chat_port: int):
-        connection = socket.socket()
-        connection.connect((chat_host, chat_port))
-        connection.send(bytes(Packet(PacketType.CONNECTION)))
-        info = b''
-        while len(info) == 0:
-            time.sleep(1)  # TODO
-            info = connection.recv(self.packet_size)
-        info = Packet.parse(info)
-        if info.type is PacketType.CONFIRMATION:
-            self._connections.append(connection)
-            connection.send(bytes(Packet(PacketType.CONFIRMATION, str(self._server_port))))
-            self._par_conn = connection
-            print('connected')
-            new_reader = reader.Reader(connection, self.packet_size)
+        try:
+            self._attempt(chat_host, chat_port).result(self._accepting.handshake_timeout + 1)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError('Handshake with {}:{} timed out'.format(chat_host, chat_port))
+
+    # The future gets the connection once it is established.
+    def _attempt(self, chat_host, chat_port: int) -> concurrent.futures.Future:
+        if self._closed:
+            raise ConnectionAbortedError('Server is closed')
+        self._accepting.run()
+        return self._accepting.connect((chat_host, chat_port)).future
+
+    # Called by the handshaker thread, readers start only after the frames that came
+    # together with the handshake are processed.
+    def _established(self, link: handshake.Handshake):
+        connection = link.connection
+        with self.lock:
+            self._add_connection(connection, link.version)
+            self.router.connected(connection)
+            new_reader = reader.Reader(connection, self.packet_size, link.decoder, self._deliver,
+                                       self._drop_connection)
             self._readers.append(new_reader)
-            new_reader.run()
-            self.ip_list.add(chat_host + ':' + str(chat_port))
-            time.sleep(1)  # TODO
-            question = Packet(PacketType.GET_IP)
-            self.send(question)
-            self.received.add(question.id)
-            self._question_id = question.id
-
-    def _accept(self):
-        conn = None
+            if link.initiator:
+                self.presence.connected(connection)
+                self.catchup.connected(connection)
+                if self._par_conn is None:
+                    self._par_conn = connection
+        if link.initiator:
+            print('connected')
+            address = '{}:{}'.format(*link.address)
+            self.ip_list.add(address)
+            self.peer_manager.connected(connection, address, True)
+            if link.version > 1:
+                self.peer_manager.ask(connection)
+            else:
+                # old peers parse the handshake with a single recv
+                threading.Timer(LEGACY_DELAY, self.peer_manager.ask, [connection]).start()
+        else:
+            host = link.address[0]
+            self.ip_list.add(host + ':' + link.port)
+            self.peer_manager.connected(connection, host + ':' + link.port, False)
+            print('accepted')
+        new_reader.feed(b'')
+        new_reader.run()
+
+    def _add_connection(self, connection, version: int):
+        sender = writer.Writer(connection, self.high_water, self.overflow, self._deflater(version),
+                               functools.partial(self._count_out, connection))
+        self._senders[connection] = sender
+        self._versions[connection] = version
+        self._connections.append(connection)
+        sender.run()
+
+    # Returns False when the peer has to be disconnected. Frames are counted when the writer
+    # sends them, so the ones dropped over high_water don't count.
+    def _write(self, connection, frame: bytes) -> bool:
+        sender = self._senders.get(connection)
+        if sender is None:
+            return False
+        return sender.put(frame, queues.FRAME_PRIORITIES.get(self._frame_type(connection, frame), 0))
+
+    def _frame_type(self, connection, frame: bytes) -> bytes:
+        return frame[0:1] if self.version(connection) == 1 else frame[1:2]
+
+    def _count_out(self, connection, frame: bytes):
+        if connection not in self._versions:
+            return
+        t = self._frame_type(connection, frame)
+        if t in DISSEMINATION_FRAMES:
+            self.sent_bytes += len(frame)
+        values = self.metrics.values()
+        values[metrics.PACKETS_OUT.get(t, metrics.PACKETS_OUT[b''])] += 1
+        values[metrics.BYTES_OUT.get(t, metrics.BYTES_OUT[b''])] += len(frame)
+        keys = self.metrics.peer(connection)
+        values[keys[2]] += 1
+        values[keys[3]] += len(frame)
+
+    def _count_in(self, message: Packet, source):
+        size = message.frame_size or 0
+        values = self.metrics.values()
+        values[metrics.PACKETS_IN[message.type]] += 1
+        values[metrics.BYTES_IN[message.type]] += size
+        if source is not None:
+            keys = self.metrics.peer(source)
+            values[keys[0]] += 1
+            values[keys[1]] += size
+
+    def _collect_metrics(self) -> list:
+        samples = self.peer_manager.samples() + [
+            ('chat_connections', (), len(self._connections)),
+            ('chat_amplification', (), self.amplification),
+            ('chat_routes', (), len(self.router)),
+            ('chat_sequence_origins', (), self.received.origins),
+            ('chat_ordering_waiting', (), self.ordering.waiting),
+        ]
+        for name, classes in (('sending', self.sending_message_queue), ('receiving', self.receiving_queue),
+                              ('got_messages', self.got_messages)):
+            for c, depth in classes.depths().items():
+                samples.append(('chat_queue_depth', (('queue', name), ('class', c)), depth))
+            for c, dropped in classes.dropped().items():
+                samples.append(('chat_queue_dropped_total', (('queue', name), ('class', c)), dropped))
+        samples.extend(('chat_queue_depth', (('queue', 'links'), ('class', c)), depth)
+                       for c, depth in self._link_depths().items())
+        for name, cache in (('received', self.received), ('sent', self._sent)):
+            stats = cache.stats()
+            for metric, key in (('chat_dedup_lookups_total', 'lookups'), ('chat_dedup_hits_total', 'hits'),
+                                ('chat_dedup_hit_rate', 'hit_rate'),
+                                ('chat_dedup_false_positive_rate', 'false_positive_rate')):
+                samples.append((metric, (('cache', name),), stats[key]))
+        return samples
+
+    def _link_depths(self) -> dict:
+        depths = dict.fromkeys(queues.PRIORITIES, 0)
+        for sender in list(self._senders.values()):
+            for c, depth in sender.depths().items():
+                depths[c] += depth
+        return depths
+
+    def _drop_connection(self, connection):
         try:
-            conn, addr = self._receive_socket.accept()
-            print(addr)
-            with self.lock:
-                info = Packet.parse(conn.recv(self.packet_size))
-                if info.type is PacketType.CONNECTION:
-                    conn.send(bytes(Packet(PacketType.CONFIRMATION)))
-                    time.sleep(2)  # TODO
-                    info = Packet.parse(conn.recv(self.packet_size))
-                    if info.type is PacketType.CONFIRMATION:
-                        self._connections.append(conn)
-                        new_reader = reader.Reader(conn, self.packet_size)
-                        self._readers.append(new_reader)
-                        new_reader.run()
-                        self.ip_list.add(addr[0] + ':' + info.data)
-                        self.send(Packet(PacketType.IP, '/' + addr[0] + ':' + info.data))
-                        print('accepted')
+            self._connections.remove(connection)
+        except ValueError:
+            return
+        self._versions.pop(connection, None)
+        self.dissemination.forget(connection)
+        self.presence.forget(connection)
+        self.catchup.forget(connection)
+        self.router.forget(connection)
+        self.metrics.forget(connection)
+        self._senders.pop(connection).stop()
+        with self.lock:
+            for r in [r for r in self._readers if r.connection is connection]:
+                r.stop()
+                self._readers.remove(r)
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
         except OSError:
-            if conn is not None:
-                conn.close()
+            pass
+        connection.close()
+        parent = connection is self._par_conn
+        if parent:
+            self._par_conn = None
+        self.peer_manager.forget(connection, parent)
+
+    # Drops a link from threads that don't serve it.
+    def _disconnect(self, connection):
+        self._drop_connection(connection)
 
     def _send_to_clients(self):
-        if self.sending_message_queue.empty():
-            self._sending.stop()
+        try:
+            current_message, source = self.sending_message_queue.get(timeout=0.5)
+        except queue.Empty:
             return
-        current_message = self.sending_message_queue.get()
+        self._broadcast(current_message, source)
+
+    def _broadcast(self, message: Packet, source=None):
         bad_connections = []
-        connections = copy.copy(self._connections)
+        frames = {}
+        connections = self.router.route(message, source, self._connections)
+        if connections is None:
+            connections = self.dissemination.route(message, source, copy.copy(self._connections))
         for connection in connections:
-            try:
-                connection.sendall(bytes(current_message))
-            except BrokenPipeError or ConnectionResetError:
-                self._connection_event.clear()
-                if connection is self._par_conn:
-                    self._repair_net()
-                    # self._par_conn.sendall(bytes(current_message))
+            version = self.version(connection)
+            if version not in frames:
+                frames[version] = packet.encode(message, version)
+            if not self._write(connection, frames[version]):
                 bad_connections.append(connection)
         for connection in bad_connections:
-            self._connections.remove(connection)
+            self._drop_connection(connection)
 
-    def get(self):
-        with self.lock:
-            for reader in self._readers:
-                data = reader.get()
-                if data is not None:
-                    self._process(data)
+    # Readers only queue what they decode, one thread processes it by priority class,
+    # so chat doesn't wait behind the presence and gossip that arrived before it.
+    # A chat packet that found no room is counted as dropped and fetched again by a catch-up
+    # exchange with its link.
+    def _deliver(self, message: Packet, source=None):
+        if not self.receiving_queue.put((message, source)) and message.type is PacketType.MESSAGE \
+                and source is not None:
+            self.catchup.connected(source)
 
-    def _process(self, data: bytes):
-        message = Packet.parse(data)
+    def _process_received(self):
+        try:
+            message, source = self.receiving_queue.get(timeout=0.5)
+        except queue.Empty:
+            return
+        # what is still queued from a dropped link goes with it
+        if source is not None and source not in self._connections:
+            return
+        try:
+            with self.lock:
+                self._process(message, source)
+        except MALFORMED:
+            if source is not None:
+                self._drop_connection(source)
+
+    def _process(self, message: Packet, source=None):
+        self._count_in(message, source)
+        if source is not None and self.version(source) == 1:
+            message.id = self.received.unfold(message.id)
+        if self.dissemination.handle(message, source) or self.presence.handle(message, source) or \
+                self.catchup.handle(message, source) or self.peer_manager.handle(message, source) or \
+                self.router.handle(message, source):
+            return
         if message.id in self.received:
+            self.dissemination.on_duplicate(message, source)
             return
         self.received.add(message.id)
-        if message.type is PacketType.MESSAGE or message.type is PacketType.ONLINE:
-            self.got_messages.put(message)
-            self.send(message)
+        if message.type is PacketType.MESSAGE:
+            self.delivered_bytes += len(message.payload)
+            self.catchup.add(message)
+            if self.router.delivers(message):
+                self.ordering.add(message, source)
+            self.send(message, source)
+        if message.type is PacketType.ONLINE:
+            self.presence.on_online(message.data)
+            for connection in self.peers():
+                if connection is not source and self.version(connection) < 2:
+                    self.send_to(connection, message)
+        # Old peers announce addresses and ask for them network-wide, neither is passed on.
         if message.type is PacketType.IP:
-            cur_id, addr = message.data.split('/')
-            self.ip_list.add(addr)
-            self.send(message)
-        if message.type is PacketType.GET_IP:
-            self.send(message)
-            for ip in self.ip_list:
-                self.send(Packet(PacketType.IP, '{}/{}'.format(message.data, ip)))
-        # print(self.ip_list)
-
-    def _repair_net(self):
-        for addr in self.ip_list:
-            addr = addr.split(':')
-            try:
-                self._connect(addr[0], int(addr[1]))
-                break
-            except ConnectionError:
-                pass
+            self.ip_list.add(message.data.split('/')[-1])
+        if message.type is PacketType.GET_IP and source is not None:
+            self.peer_manager.answer_legacy(message, source)
 
     def close(self):
+        self._closed = True
+        self.metrics.close()
+        self._presence_updater.stop()
+        self._catching_up.stop()
+        self._routing.stop()
+        self._ordering.stop()
+        self._managing.stop()
+        self._gossiping.stop()
         self._sending.stop()
-        self._getting.stop()
+        self._processing.stop()
         self._accepting.stop()
         self._receive_socket.shutdown(2)
         self._receive_socket.close()
         for r in self._readers:
             r.stop()
-        for connection in self._connections:
-            connection.shutdown(socket.SHUT_RDWR)
+        for sender in list(self._senders.values()):
+            sender.stop()
+        for connection in copy.copy(self._connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             connection.close()
@@ -0,0 +1,200 @@
+import bisect
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+COUNT = struct.Struct('!Q')
+ENTRY = struct.Struct('!QdQI')
+
+Record = collections.namedtuple('Record', ['id', 'time', 'data'])
+
+
+# One segment is a pair of files: NNNNNNNN.log with the payloads appended one after another
+# and NNNNNNNN.idx, a preallocated memory-mapped array of (id, time, offset, length) entries
+# behind an entry counter. Opening a store only maps the indexes, nothing is scanned.
+class Segment:
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        self._data = open(path + '.log', 'a+b')
+        fd = os.open(path + '.idx', os.O_RDWR | os.O_CREAT)
+        try:
+            size = os.fstat(fd).st_size
+            if size > COUNT.size:
+                capacity = (size - COUNT.size) // ENTRY.size
+            self.capacity = capacity
+            index_size = COUNT.size + capacity * ENTRY.size
+            if size < index_size:
+                os.ftruncate(fd, index_size)
+            self._index = mmap.mmap(fd, index_size)
+        finally:
+            os.close(fd)
+        self.count = min(COUNT.unpack_from(self._index, 0)[0], capacity)
+        self._recover()
+
+    # A crash may leave the counter ahead of the data or the data ahead of the counter.
+    def _recover(self):
+        size = os.fstat(self._data.fileno()).st_size
+        while self.count and self.end(self.count - 1) > size:
+            self.count -= 1
+        COUNT.pack_into(self._index, 0, self.count)
+        end = self.end(self.count - 1) if self.count else 0
+        if size > end:
+            self._data.truncate(end)
+        self.size = end
+
+    def entry(self, i: int) -> tuple:
+        return ENTRY.unpack_from(self._index, COUNT.size + i * ENTRY.size)
+
+    def end(self, i: int) -> int:
+        entry = self.entry(i)
+        return entry[2] + entry[3]
+
+    def time(self, i: int) -> float:
+        return self.entry(i)[1]
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def append(self, msg_id: int, timestamp: float, data: bytes):
+        self._data.seek(0, os.SEEK_END)
+        self._data.write(data)
+        self._data.flush()
+        ENTRY.pack_into(self._index, COUNT.size + self.count * ENTRY.size, msg_id, timestamp, self.size, len(data))
+        self.count += 1
+        self.size += len(data)
+        COUNT.pack_into(self._index, 0, self.count)
+
+    def read(self, start: int, stop: int) -> list:
+        if start >= stop:
+            return []
+        entries = [self.entry(i) for i in range(start, stop)]
+        self._data.seek(entries[0][2])
+        chunk = self._data.read(entries[-1][2] + entries[-1][3] - entries[0][2])
+        base = entries[0][2]
+        return [Record(msg_id, timestamp, chunk[offset - base:offset - base + length].decode('utf-8', 'replace'))
+                for msg_id, timestamp, offset, length in entries]
+
+    def bisect_time(self, timestamp: float) -> int:
+        return bisect.bisect_left(_TimeView(self), timestamp)
+
+    def flush(self):
+        self._index.flush()
+        os.fsync(self._data.fileno())
+
+    def close(self):
+        self._index.close()
+        self._data.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path + '.log')
+        os.remove(self.path + '.idx')
+
+
+class _TimeView:
+    def __init__(self, segment: Segment):
+        self._segment = segment
+
+    def __len__(self):
+        return self._segment.count
+
+    def __getitem__(self, i: int) -> float:
+        return self._segment.time(i)
+
+
+# Append-only local history. Arrival times never go backwards, so both the segments
+# and the entries inside them are sorted by time and range scans are binary searches.
+class MessageStore:
+    def __init__(self, directory: str, segment_capacity=1 << 16, max_segments=None):
+        self.directory = directory
+        self.segment_capacity = segment_capacity
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        names = sorted(name[:-4] for name in os.listdir(directory) if name.endswith('.idx'))
+        self._segments = [Segment(os.path.join(directory, name), segment_capacity) for name in names]
+        self._next = int(names[-1]) + 1 if names else 0
+        self._last_time = 0
+        for segment in reversed(self._segments):
+            if segment.count:
+                self._last_time = segment.time(segment.count - 1)
+                break
+        self._count = sum(segment.count for segment in self._segments)
+
+    def __len__(self):
+        return self._count
+
+    def _new_segment(self) -> Segment:
+        segment = Segment(os.path.join(self.directory, '{:08d}'.format(self._next)), self.segment_capacity)
+        self._next += 1
+        self._segments.append(segment)
+        return segment
+
+    def append(self, msg_id: int, data: str, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            timestamp = max(timestamp, self._last_time)
+            self._last_time = timestamp
+            if not self._segments or self._segments[-1].full:
+                self._new_segment()
+                if self.max_segments is not None and len(self._segments) > self.max_segments:
+                    self._drop(len(self._segments) - self.max_segments)
+            self._segments[-1].append(msg_id, timestamp, data.encode('utf-8', 'surrogateescape'))
+            self._count += 1
+
+    def last(self, n: int) -> list:
+        records = []
+        with self._lock:
+            for segment in reversed(self._segments):
+                if len(records) >= n:
+                    break
+                records = segment.read(max(0, segment.count - (n - len(records))), segment.count) + records
+        return records
+
+    def since(self, timestamp: float, until=None) -> list:
+        records = []
+        with self._lock:
+            for segment in self._segments:
+                if not segment.count or segment.time(segment.count - 1) < timestamp:
+                    continue
+                if until is not None and segment.time(0) >= until:
+                    break
+                stop = segment.count if until is None else bisect.bisect_left(_TimeView(segment), until)
+                records.extend(segment.read(segment.bisect_time(timestamp), stop))
+        return records
+
+    # Whole segments are the unit of compaction: the ones whose newest record is older
+    # than `before` are deleted, the active segment is always kept.
+    def compact(self, before: float) -> int:
+        with self._lock:
+            old = 0
+            for segment in self._segments[:-1]:
+                if segment.count and segment.time(segment.count - 1) >= before:
+                    break
+                old += 1
+            return self._drop(old)
+
+    def _drop(self, n: int) -> int:
+        removed = 0
+        for segment in self._segments[:n]:
+            removed += segment.count
+            segment.remove()
+        del self._segments[:n]
+        self._count -= removed
+        return removed
+
+    def flush(self):
+        with self._lock:
+            if self._segments:
+                self._segments[-1].flush()
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+            self._segments = []
@@ -0,0 +1,113 @@
+import collections
+import threading
+
+from src import queues
+from src import utils
+
+
+# Frames of one link, queued by priority (see queues.PRIORITIES) up to high_water bytes.
+# A batch takes chat first, up to batch_bytes, and then at most bulk_bytes of the lower
+# classes (one frame if it is larger), so chat that comes in while a batch is being sent
+# waits for a few KiB of bulk, not for everything that was queued before it.
+class LinkQueue:
+    def __init__(self, high_water=1 << 20, overflow='disconnect', batch_bytes=1 << 16, bulk_bytes=1 << 12):
+        self.high_water = high_water
+        self.overflow = overflow
+        self.batch_bytes = batch_bytes
+        self.bulk_bytes = bulk_bytes
+        self.queued_bytes = 0
+        self.dropped = 0
+        self._frames = [collections.deque() for _ in queues.PRIORITIES]
+        self._lock = threading.Lock()
+
+    def depths(self) -> dict:
+        return {name: len(frames) for name, frames in zip(queues.PRIORITIES, self._frames)}
+
+    # Returns False when the peer has to be disconnected.
+    def put(self, frame: bytes, priority=0) -> bool:
+        with self._lock:
+            if self.queued_bytes + len(frame) > self.high_water and not self._make_room(len(frame), priority):
+                if self.overflow == 'disconnect' and priority not in queues.DROPPABLE:
+                    return False
+                self.dropped += 1
+                return True
+            self._frames[priority].append(frame)
+            self.queued_bytes += len(frame)
+        return True
+
+    # Drops the oldest frames of droppable classes below or at the priority of the new frame.
+    def _make_room(self, size: int, priority: int) -> bool:
+        for dropping in reversed(queues.DROPPABLE):
+            frames = self._frames[dropping]
+            while frames and dropping >= priority and self.queued_bytes + size > self.high_water:
+                self.queued_bytes -= len(frames.popleft())
+                self.dropped += 1
+        return self.queued_bytes + size <= self.high_water
+
+    def batch(self) -> list:
+        frames = []
+        size = 0
+        with self._lock:
+            chat = self._frames[0]
+            while chat and size < self.batch_bytes:
+                frame = chat.popleft()
+                frames.append(frame)
+                size += len(frame)
+            bulk = 0
+            for queued in self._frames[1:]:
+                while queued and size < self.batch_bytes and (not bulk or bulk + len(queued[0]) <= self.bulk_bytes):
+                    frame = queued.popleft()
+                    frames.append(frame)
+                    size += len(frame)
+                    bulk += len(frame)
+            self.queued_bytes -= size
+        return frames
+
+
+# With a deflater every batch goes out as one compression block. sent(frame) is called for
+# every frame that was handed to the socket, frames dropped over high_water never get there.
+class Writer(utils.Daemon):
+    def __init__(self, connection, high_water=1 << 20, overflow='disconnect', deflater=None, sent=None):
+        super().__init__(name='writing', target=self._write, timeout=0)
+        self.connection = connection
+        self.deflater = deflater
+        self.sent = sent
+        self.frames = LinkQueue(high_water, overflow)
+        self.broken = False
+        self._pending = threading.Event()
+
+    def depths(self) -> dict:
+        return self.frames.depths()
+
+    # Returns False when the peer has to be disconnected.
+    def put(self, frame: bytes, priority=0) -> bool:
+        if self.broken:
+            return False
+        if not self.frames.put(frame, priority):
+            self.broken = True
+            return False
+        self._pending.set()
+        return True
+
+    def _write(self):
+        if not self._pending.wait(0.5):
+            return
+        self._pending.clear()
+        while not self.broken and not self._stopped.is_set():
+            frames = self.frames.batch()
+            if not frames:
+                return
+            data = b''.join(frames)
+            try:
+                self.connection.sendall(data if self.deflater is None else self.deflater.pack(data))
+            except OSError:
+                self.broken = True
+                self.stop()
+                return
+            if self.sent is not None:
+                for frame in frames:
+                    self.sent(frame)
+
+    def stop(self):
+        super().stop()
+        self._pending.set()